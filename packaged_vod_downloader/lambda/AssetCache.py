@@ -0,0 +1,125 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AssetCache.py
+# Cache of the parsed resource table of an asset stored alongside the output at the
+# destination. The cache also records the size and ETag of each resource copied, so
+# objects which have been truncated or replaced at the destination are copied again.
+# Unlike the checkpoint (see ProgressJournal) the cache is kept once a download
+# completes, so later downloads of the same asset to the same destination (e.g. a
+# re-run to confirm a download is complete) skip fetching and parsing the manifests.
+#
+# The cache records the 'ETag' and 'Last-Modified' headers returned with the master
+# manifest. Before the cache is used the master manifest is requested again with
+# 'If-None-Match'/'If-Modified-Since' headers and the cache is only used if origin
+# responds with '304 Not Modified'.
+
+import gzip
+import json
+import logging
+import urllib3
+from botocore.exceptions import ClientError
+from ResourceTable import ResourceTable, ResourceSizes
+from ProgressJournal import JournalVodAsset
+
+logger = logging.getLogger()
+
+CACHE_VERSION = 3
+
+# Returns a tuple of ( vodAsset, vodAssetType ) from the cached asset for destPath or
+# None if there is no cache or it cannot be confirmed the master manifest is unchanged
+def loadAssetCache( writer, destBucket, destPath, sourceUrl, http, authHeaders ):
+
+  key = getAssetCacheKey(destPath)
+  body = writer.getObject( destBucket, key )
+  if body is None:
+    return None
+
+  data = json.loads( gzip.decompress( body ) )
+  if data.get('version') != CACHE_VERSION or data.get('sourceUrl') != sourceUrl:
+    logger.info("Ignoring asset cache %s as it does not match this download" % writer.getLocation(destBucket, key))
+    return None
+
+  if not isMasterManifestUnchanged( http, sourceUrl, authHeaders, data['validators'] ):
+    logger.info("Master manifest has changed since asset cache %s was saved" % writer.getLocation(destBucket, key))
+    return None
+
+  vodAsset = JournalVodAsset( data['masterManifest'], data['commonPrefix'],
+                              ResourceTable.fromDict( data['resources'] ), ResourceSizes.fromDict( data['resourceSizes'] ),
+                              data['rangedResources'], data['validators'] )
+  logger.info("Loaded asset cache %s (%d resources)" % (writer.getLocation(destBucket, key), len(vodAsset.allResources)))
+  return ( vodAsset, data['vodAssetType'] )
+
+
+# Saves the parsed asset. Nothing is saved if origin did not return any validators for
+# the master manifest as there would be no way to tell whether the cache is stale.
+def saveAssetCache( writer, destBucket, destPath, sourceUrl, vodAssetType, vodAsset ):
+
+  key = getAssetCacheKey(destPath)
+  validators = getattr(vodAsset, 'masterManifestValidators', None)
+  if not validators:
+    logger.info("Not caching asset as master manifest has no 'ETag' or 'Last-Modified' header")
+    return
+
+  data = {
+    'version': CACHE_VERSION,
+    'sourceUrl': sourceUrl,
+    'validators': validators,
+    'vodAssetType': vodAssetType,
+    'masterManifest': vodAsset.masterManifest,
+    'commonPrefix': vodAsset.commonPrefix,
+    'resources': vodAsset.allResources.toDict(),
+    'resourceSizes': vodAsset.resourceSizes.toDict(),
+    'rangedResources': vodAsset.rangedResources
+  }
+  body = gzip.compress( json.dumps(data, separators=(',', ':')).encode('utf-8') )
+
+  # The cache is an optimisation so failing to save it does not fail the download
+  try:
+    writer.putStateObject( destBucket, key, body )
+  except (ClientError, OSError) as e:
+    logger.warning("Unable to save asset cache to %s: %s" % (writer.getLocation(destBucket, key), repr(e)))
+    return
+  logger.info("Saved asset cache to %s (%d bytes)" % (writer.getLocation(destBucket, key), len(body)))
+
+
+def isMasterManifestUnchanged( http, url, authHeaders, validators ):
+
+  headers = dict(authHeaders) if authHeaders else {}
+  if 'ETag' in validators:
+    headers['If-None-Match'] = validators['ETag']
+  if 'Last-Modified' in validators:
+    headers['If-Modified-Since'] = validators['Last-Modified']
+
+  try:
+    response = http.request("GET", url, headers=headers)
+  except urllib3.exceptions.HTTPError as e:
+    print('I/O error validating asset cache', url)
+    print(repr(e))
+    return False
+
+  if response.status == 304:
+    return True
+
+  # Some servers ignore conditional requests. A full response with the same ETag
+  # also confirms the manifest has not changed.
+  return response.status == 200 and 'ETag' in validators and response.headers.get('ETag') == validators['ETag']
+
+
+def getAssetCacheKey( destPath ):
+  # Stored next to (not inside) the destination path so it is not counted as one of
+  # the downloaded objects
+  return "%s.asset.json.gz" % destPath
@@ -0,0 +1,219 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# AsyncDownloader.py
+# asyncio based alternative to the thread/queue workers in DownloadVod.py.
+# A single event loop keeps up to 'concurrency' origin GETs and S3 PUTs in flight
+# at once. This suits assets with a large number of small segments where the
+# runtime is dominated by per-request latency rather than bandwidth.
+#
+# S3 PUTs are sent over aiohttp using presigned URLs. Presigning is a local
+# operation so no blocking boto3 network calls are made from the event loop.
+#
+# Failed origin requests and S3 PUTs are retried using the RetryPolicy of the
+# download. Each resource is fetched with a single GET, so assets with files
+# referenced using byte ranges (which the thread engine copies using parallel ranged
+# requests) are not supported. Nor is adaptive concurrency, the number of transfers
+# in flight is fixed.
+
+import os
+import time
+import asyncio
+import logging
+import boto3
+import aiohttp
+from botocore.config import Config
+from RetryPolicy import RetryPolicy, CONNECTION_ERROR, LENGTH_MISMATCH
+from PerformanceMetrics import recordMetric
+
+logger = logging.getLogger()
+
+PRESIGNED_URL_EXPIRY = 3600 # seconds
+
+class AsyncDownloader:
+  def __init__(self, baseUrl, destBucket, destPrefix, acl, authHeaders, concurrency=100, rateLimiter=None, minTimeRemaining=0, retryPolicy=None):
+    self.baseUrl = baseUrl
+    self.destBucket = destBucket
+    self.destPrefix = destPrefix
+    self.acl = acl
+    self.authHeaders = authHeaders
+    self.concurrency = concurrency
+    self.rateLimiter = rateLimiter
+    self.minTimeRemaining = minTimeRemaining
+    self.retryPolicy = retryPolicy if retryPolicy else RetryPolicy()
+    self.downloadedSegments = []
+    self.skippedSegments = []
+
+    # SigV4 is required so the presigned URL carries the signed Content-Type and ACL headers
+    self.s3Client = boto3.client('s3', config=Config(signature_version='s3v4'))
+
+  # Downloads every resource the journal does not record as complete and returns
+  # a tuple of ( stopBeforeTimeout, result ) where result has the same format as
+  # the result of the fetchSegments worker threads in DownloadVod.py
+  def run( self, journal, context ):
+
+    stopBeforeTimeout = asyncio.run( self.fetchAll( journal, context ) )
+
+    result = {
+      "downloadedSegments": self.downloadedSegments,
+      "totalDownloadedSegments": len(self.downloadedSegments),
+      "skippedSegments": self.skippedSegments,
+      "totalSkippedSegments": len(self.skippedSegments)
+    }
+    return ( stopBeforeTimeout, result )
+
+  async def fetchAll( self, journal, context ):
+
+    stopBeforeTimeout = False
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=60)
+    originConnector = aiohttp.TCPConnector(limit=self.concurrency)
+    s3Connector = aiohttp.TCPConnector(limit=self.concurrency)
+
+    async with aiohttp.ClientSession(connector=originConnector, timeout=timeout) as originSession, \
+               aiohttp.ClientSession(connector=s3Connector, timeout=timeout) as s3Session:
+
+      # The semaphore bounds the number of transfers in flight (and therefore the
+      # number of segment bodies held in memory at any one time)
+      inFlight = asyncio.Semaphore(self.concurrency)
+      tasks = set()
+
+      for index in journal.pendingIndexes():
+
+        if context:
+          if context.get_remaining_time_in_millis() < self.minTimeRemaining:
+            stopBeforeTimeout = True
+            break
+
+        # The checkpoint is saved from a thread so transfers continue meanwhile
+        if journal.isSaveDue():
+          await asyncio.get_running_loop().run_in_executor( None, journal.saveIfDue )
+
+        await inFlight.acquire()
+        task = asyncio.ensure_future( self.fetchSegment( originSession, s3Session, journal, index ) )
+        task.add_done_callback( lambda t: inFlight.release() )
+        task.add_done_callback( tasks.discard )
+        tasks.add(task)
+
+        # Next invocation continues from the first resource which has not been started
+        journal.cursor = index + 1
+
+      # Wait for the transfers still in flight
+      if tasks:
+        await asyncio.gather(*tasks)
+
+    return stopBeforeTimeout
+
+  async def fetchSegment( self, originSession, s3Session, journal, index ):
+
+    segment = journal.vodAsset.allResources[index]
+    segmentBase = segment.split('?')[0]   # Strip off any query params
+    segmentBase = '/' + segmentBase.replace(self.baseUrl, "")
+
+    attempt = 0
+    while True:
+      (segmentData, contentType, failure) = await self.loadUrl( originSession, segment )
+      if segmentData != None:
+        eTag = await self.writeBucket( s3Session, segmentBase, segmentData, contentType )
+        journal.markComplete( index, len(segmentData), eTag )
+        self.downloadedSegments.append(segment)
+        return
+      attempt += 1
+      (reason, retryAfter) = failure
+      retryDelay = self.retryPolicy.getRetryDelay( reason, attempt, retryAfter )
+      if retryDelay is None:
+        break
+      await asyncio.sleep(retryDelay)
+
+    print('AsyncDownloader failed to load after', attempt, 'attempts: ', segment)
+    logger.debug("'%s' fetch attempt failed; skipping" % segmentBase)
+    self.skippedSegments.append(segment)
+
+  async def loadUrl( self, originSession, url ):
+
+    # Wait for the shared rate limiter before every request sent to origin (including retries)
+    if self.rateLimiter:
+      delay = self.rateLimiter.reserveRequest()
+      if delay > 0:
+        await asyncio.sleep(delay)
+
+    requestStart = time.time()
+    try:
+      async with originSession.get( url, headers=self.authHeaders ) as response:
+        if response.status != 200:
+          logger.info("Failed to download '%s'" % url)
+          print('http error', response.status, 'fetching', url)
+          return (None, None, (response.status, response.headers.get('Retry-After')))
+
+        urlPayload = await response.read()
+        recordMetric( 'originGet', time.time() - requestStart, len(urlPayload) )
+        contentType = response.headers.get('Content-Type')
+        if self.rateLimiter:
+          delay = self.rateLimiter.reserveBytes(len(urlPayload))
+          if delay > 0:
+            await asyncio.sleep(delay)
+
+        # Not all servers return a 'Content-Length' header. If available it is worth checking
+        if 'Content-Length' in response.headers:
+          expectedLen = int(response.headers['Content-Length'])
+          if len(urlPayload) != expectedLen:
+            print('AsyncDownloader:', url, 'expected', expectedLen, '; received', len(urlPayload))
+            return (None, None, (LENGTH_MISMATCH, None))
+
+    except (aiohttp.ClientError, asyncio.TimeoutError) as urlErr:
+      print('I/O error fetching', url)
+      print(repr(urlErr))
+      return (None, None, (CONNECTION_ERROR, None))
+
+    return (urlPayload, contentType, None)
+
+  async def writeBucket( self, s3Session, objectName, content, contentType ):
+  # Writes content to prefix+objectName in the destination bucket.  Failures are fatal.
+  # Returns the ETag of the object written.
+
+    key = self.destPrefix + objectName
+    params = { 'Bucket': self.destBucket, 'Key': key, 'ACL': self.acl }
+    headers = { 'x-amz-acl': self.acl }
+    if contentType:
+      params['ContentType'] = contentType
+      headers['Content-Type'] = contentType
+
+    logger.debug("DEBUG: Writing segment to: s3://%s/%s" % (self.destBucket, key))
+    attempt = 0
+    while True:
+      presignedUrl = self.s3Client.generate_presigned_url( 'put_object', Params=params, ExpiresIn=PRESIGNED_URL_EXPIRY )
+      putStart = time.time()
+      try:
+        async with s3Session.put( presignedUrl, data=content, headers=headers ) as response:
+          if response.status == 200:
+            recordMetric( 's3Put', time.time() - putStart, len(content) )
+            return response.headers.get('ETag')
+          s3Err = "HTTP %d: %s" % (response.status, await response.text())
+          failure = ( response.status, response.headers.get('Retry-After') )
+      except (aiohttp.ClientError, asyncio.TimeoutError) as err:
+        s3Err = repr(err)
+        failure = ( CONNECTION_ERROR, None )
+
+      # S3 occasionally returns 500/503 (SlowDown) under load. These are retried with
+      # the same backoff (and from the same retry budget) as origin requests.
+      attempt += 1
+      (reason, retryAfter) = failure
+      retryDelay = self.retryPolicy.getRetryDelay( reason, attempt, retryAfter )
+      if retryDelay is None:
+        print('Fatal:  error writing to S3')
+        print('Bucket: ', self.destBucket, ' Asset ID:', self.destPrefix, ' Object:', objectName, ' ACL:', self.acl)
+        print(s3Err)
+        os._exit(3)
+      await asyncio.sleep(retryDelay)
@@ -0,0 +1,165 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# BatchDownloader.py
+# Downloads a batch of assets in one process, used by the '-J' command line option of
+# DownloadVod.py (see fetchBatch). Each job is an event for fetchStream (normally
+# just 'source_url' and the destination) with the options of the batch applied as
+# defaults.
+#
+# Jobs share the origin connection pools, the request/byte rate limits and the S3
+# writer, so the limits apply to the batch as a whole and connections are reused
+# between assets. Only one job runs at a time and it has all the workers of the batch.
+#
+# Jobs are scheduled round robin in time slices of sliceSeconds. A job which has not
+# completed by the end of its slice stops as it would at the Lambda deadline (saving
+# its checkpoint) and goes to the back of the queue, so a large asset does not hold
+# up the assets behind it. A sliceSeconds of 0 runs each job to completion. Transfers
+# in progress at the end of a slice are allowed to finish, so a file which takes
+# longer than a slice to copy is not restarted by every slice. A job which copies
+# nothing in MAX_SLICES_WITHOUT_PROGRESS consecutive slices is finished as INCOMPLETE.
+#
+# A result line is written for each job once it has finished (see JOB_RESULT_FIELDS).
+
+import json
+import time
+import logging
+from collections import deque
+
+logger = logging.getLogger()
+
+DEFAULT_SLICE_SECONDS = 60
+MAX_SLICES_WITHOUT_PROGRESS = 3
+BATCH_OPTIONS = ( 'jobs', 'jobsFile', 'resultsFile', 'sliceSeconds' )
+JOB_RESULT_FIELDS = ( 'status', 'objectsAtS3Dest', 'totalPendingResources', 'progressPercentage' )
+
+class SliceContext:
+  # Stands in for the Lambda context passed to fetchStream so the job stops at the end
+  # of its time slice (or at the deadline of the batch, if that is sooner).
+  # 'reserveMs' is the time remaining at which fetchStream stops starting new work.
+  # Transfers already in progress only stop at the deadline of 'invocationContext'
+  # (the Lambda context of the batch, None from the command line).
+  def __init__(self, sliceSeconds, reserveMs, parent=None):
+    self.sliceEnd = time.time() + sliceSeconds if sliceSeconds else None
+    self.reserveMs = reserveMs
+    self.parent = parent
+    self.invocationContext = parent
+    self.aws_request_id = getattr( parent, 'aws_request_id', None )
+
+  def get_remaining_time_in_millis( self ):
+    remaining = float('inf')
+    if self.sliceEnd:
+      remaining = ( self.sliceEnd - time.time() ) * 1000 + self.reserveMs
+    if self.parent:
+      remaining = min( remaining, self.parent.get_remaining_time_in_millis() )
+    return remaining
+
+
+# Returns the list of jobs in a JSONL file, one job per line
+def loadJobs( path ):
+
+  jobs = []
+  with open( path, 'r' ) as jobsFile:
+    for line in jobsFile:
+      if line.strip():
+        jobs.append( json.loads(line) )
+  return jobs
+
+
+# Runs each job using 'fetchStream' and returns a summary of the batch. The result of
+# each job is passed to 'writeResult' once the job has finished. 'shared' holds the
+# resources fetchStream shares between jobs.
+def runBatch( jobs, defaults, fetchStream, writeResult, sliceSeconds, reserveMs, context=None, shared=None ):
+
+  queue = deque()
+  for index, job in enumerate(jobs):
+    queue.append({
+      'job': job.get( 'id', index ),
+      'source_url': job.get('source_url'),
+      'event': dict( defaults, **job ),
+      'slices': 0,
+      'slicesWithoutProgress': 0,
+      'elapsedSeconds': 0.0,
+      'totalDownloadedSegments': 0,
+      'totalSkippedSegments': 0,
+      'totalUnchangedSegments': 0
+    })
+
+  numComplete = 0
+  numFinished = 0
+  while queue:
+    if context and context.get_remaining_time_in_millis() < reserveMs:
+      # The batch is out of time, the remaining jobs are left for another invocation
+      break
+
+    jobState = queue.popleft()
+    logger.info( "Running job %s (slice %d, %d jobs queued)" % (jobState['job'], jobState['slices'] + 1, len(queue)) )
+    sliceStart = time.time()
+    try:
+      output = fetchStream( jobState['event'], SliceContext(sliceSeconds, reserveMs, context), shared )
+    except Exception as e:
+      logger.error( "Job %s failed: %s" % (jobState['job'], repr(e)) )
+      output = { 'status': 500, 'message': repr(e), 'result': { 'status': 'FAILED' } }
+    jobState['slices'] += 1
+    jobState['elapsedSeconds'] += time.time() - sliceStart
+
+    result = output['result']
+    for key in ( 'totalDownloadedSegments', 'totalSkippedSegments', 'totalUnchangedSegments' ):
+      jobState[key] += result.get(key, 0)
+    if result.get('totalDownloadedSegments') or result.get('totalUnchangedSegments'):
+      jobState['slicesWithoutProgress'] = 0
+    else:
+      jobState['slicesWithoutProgress'] += 1
+    status = result['status']
+    message = output['message'] if output['status'] != 200 else None
+    if status == 'LAMBDA_TIMEOUT':
+      if jobState['slicesWithoutProgress'] < MAX_SLICES_WITHOUT_PROGRESS:
+        queue.append( jobState )
+        continue
+      # e.g. every resource left fails before it can be copied. Other jobs would wait
+      # for the job for ever.
+      logger.warning( "Job %s copied nothing in %d slices, giving up" % (jobState['job'], jobState['slicesWithoutProgress']) )
+      status = 'INCOMPLETE'
+      message = "No resources copied in %d consecutive slices" % jobState['slicesWithoutProgress']
+
+    jobResult = { key: jobState[key] for key in ( 'job', 'source_url', 'slices', 'totalDownloadedSegments',
+                                                  'totalSkippedSegments', 'totalUnchangedSegments' ) }
+    jobResult['elapsedSeconds'] = round( jobState['elapsedSeconds'], 3 )
+    for key in JOB_RESULT_FIELDS:
+      if key in result:
+        jobResult[key] = result[key]
+    jobResult['status'] = status
+    if message:
+      jobResult['message'] = message
+    if 'asset' in output:
+      jobResult['location'] = output['asset']['s3Location']
+    writeResult( jobResult )
+
+    numFinished += 1
+    if status == 'COMPLETE':
+      numComplete += 1
+
+  if not queue:
+    status = 'COMPLETE' if numComplete == len(jobs) else 'INCOMPLETE'
+  else:
+    status = 'LAMBDA_TIMEOUT'
+  return {
+    'status': status,
+    'totalJobs': len(jobs),
+    'completeJobs': numComplete,
+    'finishedJobs': numFinished,
+    'pendingJobs': [ jobState['job'] for jobState in queue ]
+  }
@@ -0,0 +1,127 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ByteBudgetBuffer.py
+# FIFO buffer of downloaded bodies between the download and upload stages of
+# DownloadVod.py. The buffer is limited by the total size of the bodies it holds
+# rather than by the number of bodies, so the memory used does not depend on the
+# segment size.
+#
+# Bodies count against the memory budget from when they are added until the consumer
+# calls 'release' (i.e. while they are being uploaded as well as while they are
+# queued). When the memory budget is used up bodies are written to files in spillDir
+# (e.g. /tmp), up to spillBytes in total. Producers block once both budgets are used
+# up. A body larger than the memory budget is accepted once nothing else is held in
+# memory, so a single large body cannot stop the download. Memory use can exceed the
+# budget by the spilled bodies being uploaded (at most one per upload worker).
+
+import os
+import tempfile
+import threading
+from collections import deque
+
+class ByteBudgetBuffer:
+  def __init__(self, memoryBytes, spillDir=None, spillBytes=0):
+    self.memoryLimit = memoryBytes
+    self.spillDir = spillDir
+    self.spillLimit = spillBytes if spillDir else 0
+    self.entries = deque()   # ( item, body or None, spill file path or None, size )
+    self.memoryBytes = 0
+    self.spilledBytes = 0
+    self.closed = False
+    self.condition = threading.Condition()
+    # Statistics reported by getSummary
+    self.peakMemoryBytes = 0
+    self.numSpilled = 0
+    self.totalSpilledBytes = 0
+
+  def fitsInMemory( self, size ):
+    return self.memoryBytes == 0 or self.memoryBytes + size <= self.memoryLimit
+
+  # Adds 'body' to the buffer, blocking until there is room. 'item' is returned
+  # with the body by 'get'.
+  def put( self, item, body ):
+
+    size = len(body)
+    with self.condition:
+      while not self.fitsInMemory(size) and self.spilledBytes + size > self.spillLimit:
+        self.condition.wait()
+      if self.fitsInMemory(size):
+        self.addMemoryBytes(size)
+        self.entries.append( ( item, body, None, size ) )
+        self.condition.notify_all()
+        return
+      # Reserve the space on disk, the file is written without holding the lock
+      self.spilledBytes += size
+
+    ( fd, path ) = tempfile.mkstemp( dir=self.spillDir, prefix='upload-' )
+    with os.fdopen(fd, 'wb') as spillFile:
+      spillFile.write(body)
+    with self.condition:
+      self.numSpilled += 1
+      self.totalSpilledBytes += size
+      self.entries.append( ( item, None, path, size ) )
+      self.condition.notify_all()
+
+  # Returns the oldest ( item, body ) or None once the buffer has been closed and
+  # is empty. The caller must call 'release' with the size of the body once the
+  # body is no longer needed.
+  def get( self ):
+
+    with self.condition:
+      while not self.entries and not self.closed:
+        self.condition.wait()
+      if not self.entries:
+        return None
+      ( item, body, path, size ) = self.entries.popleft()
+      if path is None:
+        return ( item, body )
+      # A spilled body is read back into memory without waiting for room in the memory
+      # budget, as the memory may be held by bodies queued behind it. Producers cannot
+      # add to memory until it has been released.
+      self.addMemoryBytes(size)
+
+    with open(path, 'rb') as spillFile:
+      body = spillFile.read()
+    os.remove(path)
+    with self.condition:
+      self.spilledBytes -= size
+      self.condition.notify_all()
+    return ( item, body )
+
+  def release( self, size ):
+    with self.condition:
+      self.memoryBytes -= size
+      self.condition.notify_all()
+
+  # Called once nothing more will be added. Consumers receive None from 'get' once
+  # the remaining bodies have been taken.
+  def close( self ):
+    with self.condition:
+      self.closed = True
+      self.condition.notify_all()
+
+  def addMemoryBytes( self, size ):
+    self.memoryBytes += size
+    self.peakMemoryBytes = max( self.peakMemoryBytes, self.memoryBytes )
+
+  def getSummary( self ):
+    with self.condition:
+      return {
+        'uploadBufferPeakBytes': self.peakMemoryBytes,
+        'uploadBufferSpilledObjects': self.numSpilled,
+        'uploadBufferSpilledBytes': self.totalSpilledBytes
+      }
@@ -0,0 +1,133 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ConcurrencyController.py
+# Additive-increase/multiplicative-decrease (AIMD) control of the number of
+# concurrent origin requests. Workers call 'acquire' before fetching a resource
+# (or before each request of a ranged transfer) and 'release' when done, and report
+# the outcome of every origin request.
+#
+# - After each full window of healthy samples (p95 latency under target and error
+#   rate under threshold) the limit is increased by one. If either is over its
+#   threshold the limit is reduced by one.
+# - On a congestion signal (HTTP 5xx, HTTP 429 or a timeout/connection error) the
+#   limit is multiplied by 'decreaseFactor'. Further congestion signals only count
+#   towards the error rate until a new window has been collected, so requests which
+#   were already in flight do not collapse the limit. Under sustained congestion the
+#   limit is therefore reduced again after every window.
+
+import time
+import math
+import threading
+
+MAX_TRAJECTORY_LENGTH = 500
+
+class AimdConcurrencyController:
+  def __init__(self, minConcurrency=2, maxConcurrency=20, initialConcurrency=None,
+               latencyTargetMs=1000, errorRateThreshold=0.05, decreaseFactor=0.5):
+    self.minConcurrency = max(1, minConcurrency)
+    self.maxConcurrency = max(self.minConcurrency, maxConcurrency)
+    if initialConcurrency is None:
+      initialConcurrency = self.minConcurrency
+    self.limit = min(self.maxConcurrency, max(self.minConcurrency, initialConcurrency))
+    self.latencyTargetMs = latencyTargetMs
+    self.errorRateThreshold = errorRateThreshold
+    self.decreaseFactor = decreaseFactor
+
+    self.active = 0
+    self.latencies = []
+    self.errors = 0
+    self.backedOff = False
+    self.startTime = time.time()
+    self.trajectory = []
+    self.maxConcurrencyReached = self.limit
+    self.condition = threading.Condition()
+
+    self.recordTrajectory('start')
+
+  # Blocks until the number of active transfers is below the current limit. Returns
+  # False if no slot became free within 'timeout' seconds (None waits indefinitely).
+  def acquire( self, timeout=None ):
+    with self.condition:
+      if not self.condition.wait_for( lambda: self.active < self.limit, timeout ):
+        return False
+      self.active += 1
+      return True
+
+  def release( self ):
+    with self.condition:
+      self.active -= 1
+      self.condition.notify()
+
+  # Records the outcome of an origin request. 'status' is the HTTP status code
+  # or None if the request failed with a timeout or connection error.
+  def recordResult( self, latencySeconds, status ):
+
+    congestion = status is None or status == 429 or status >= 500
+    with self.condition:
+      if congestion and not self.backedOff:
+        # Only back off once per window
+        self.setLimit( max(self.minConcurrency, int(math.floor(self.limit * self.decreaseFactor))), 'congestion' )
+        self.backedOff = True
+        return
+
+      self.latencies.append(latencySeconds * 1000)
+      if congestion or status not in (200, 206, 304):
+        self.errors += 1
+
+      # Evaluate once enough samples have been collected at the current limit
+      if len(self.latencies) >= max(10, 2 * self.limit):
+        p95 = sorted(self.latencies)[int(0.95 * (len(self.latencies) - 1))]
+        errorRate = self.errors / float(len(self.latencies))
+        self.backedOff = False
+        if p95 > self.latencyTargetMs:
+          self.setLimit( max(self.minConcurrency, self.limit - 1), 'latency' )
+        elif errorRate > self.errorRateThreshold:
+          self.setLimit( max(self.minConcurrency, self.limit - 1), 'errors' )
+        else:
+          self.setLimit( min(self.maxConcurrency, self.limit + 1), 'healthy' )
+
+  def setLimit( self, limit, reason ):
+    # Must be called with the condition held
+    changed = limit != self.limit
+    self.limit = limit
+    self.resetWindow()
+    if changed:
+      self.maxConcurrencyReached = max(self.maxConcurrencyReached, limit)
+      self.recordTrajectory(reason)
+      self.condition.notify_all()
+
+  def resetWindow( self ):
+    self.latencies = []
+    self.errors = 0
+
+  def recordTrajectory( self, reason ):
+    self.trajectory.append({
+      'elapsedSeconds': round(time.time() - self.startTime, 2),
+      'concurrency': self.limit,
+      'reason': reason
+    })
+    # Keep the first entry and the most recent changes
+    if len(self.trajectory) > MAX_TRAJECTORY_LENGTH:
+      del self.trajectory[1]
+
+  def getSummary( self ):
+    with self.condition:
+      return {
+        'finalConcurrency': self.limit,
+        'maxConcurrencyReached': self.maxConcurrencyReached,
+        'concurrencyTrajectory': list(self.trajectory)
+      }
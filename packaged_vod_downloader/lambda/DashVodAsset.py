@@ -16,14 +16,15 @@
 
 from mpegdash.parser import MPEGDASHParser
 import os
-import urllib3
+import time
 from isodate import parse_duration
 from datetime import datetime
 from pprint import pprint
 from urllib.parse import urlparse
 import re
-
-http = urllib3.PoolManager()
+from ResourceTable import ResourceTable, ResourceSizes
+from PerformanceMetrics import recordMetric, timeMetric
+from HttpTransport import HttpTransport, MANIFEST_RETRIES
 
 # Supported Manifest
 # Compact Time/Number with Timeline
@@ -37,25 +38,61 @@ http = urllib3.PoolManager()
 #  - Each representations contains Segment Template
 
 class DashVodAsset:
-  def __init__(self, masterManifest, authHeaders=None):
+  def __init__(self, masterManifest, authHeaders=None, deferParse=False, http=None):
     self.masterManifest = masterManifest
     self.masterManifestContentType = None
-    self.mediaSegmentList  = []
+    # ETag and Last-Modified of the master manifest, used to validate cached copies of the asset
+    self.masterManifestValidators = {}
     self.commonPrefix = None
-    self.allResource = None
+    self.allResources = ResourceTable()
+    # Size in bytes of each resource once it has been written to the destination (see
+    # ResourceSizes). Used to detect truncated objects at the destination.
+    self.resourceSizes = ResourceSizes()
+    # Resources fetched using parallel ranged requests (not used for DASH)
+    self.rangedResources = {}
     self.authHeaders = authHeaders
-
-    self.parseDashVodAsset()
+    # HTTP transport for manifest requests, normally shared with the segment downloads
+    self.http = http if http else HttpTransport()
+    self.mpd = None
+
+    # With deferParse only the manifest is retrieved by the constructor. The caller
+    # then consumes 'iterResourceBatches' to receive the segments of each adaptation
+    # set as soon as they have been listed.
+    if deferParse:
+      self.parseManifest()
+    else:
+      self.parseDashVodAsset()
 
   # Function will parse variant manifest and extract a list of all media and init segments
-  # media and init segments will store absolute URLs for segments in mediaSegmentList
+  # media and init segments are added to the allResources resource table
   def parseDashVodAsset( self ):
 
-    mediaSegments = []
+    self.parseManifest()
+    for newIndexes in self.iterResourceBatches():
+      pass
+
+    return
+
+  def parseManifest( self ):
 
     # Retrieve Manifest
-    (masterManifestBody, self.masterManifestContentType) = getManifest( self.masterManifest, self.authHeaders )
-    mpd = MPEGDASHParser.parse(masterManifestBody)
+    (masterManifestBody, self.masterManifestContentType) = getManifest( self.http, self.masterManifest, self.authHeaders, self.masterManifestValidators )
+    with timeMetric('manifestParse'):
+      self.mpd = MPEGDASHParser.parse(masterManifestBody)
+
+    # Provisional common prefix based on the manifest only. Segments are normally found
+    # below this prefix, in which case it is the same as the final common prefix.
+    self.commonPrefix = getCommonPrefix( [ self.masterManifest ] )
+
+  # Generator adding resources to allResources: first the manifest, then the segments of
+  # each adaptation set. Yields the range of indexes of the resources added by each step.
+  # Once all adaptation sets have been processed the final commonPrefix is set.
+  def iterResourceBatches( self ):
+
+    self.allResources.add( self.masterManifest )
+    yield range( 0, len(self.allResources) )
+
+    mpd = self.mpd
     mpdBaseUrl = os.path.dirname(self.masterManifest)
 
     # loop over periods
@@ -70,8 +107,10 @@ class DashVodAsset:
 
         print("Starting processing AdaptationSet %d with MimeType '%s'" % (adaptationSetCounter, adaptationSet.mime_type))
         
-        listOfSegments = getAdaptationSetSegmentList(mpdBaseUrl, adaptationSet, period)
-        mediaSegments.extend(listOfSegments)
+        firstIndex = len(self.allResources)
+        with timeMetric('manifestParse'):
+          addAdaptationSetSegments(self.allResources, mpdBaseUrl, adaptationSet, period)
+        yield range( firstIndex, len(self.allResources) )
       
         print("Finished processing AdaptationSet %d." % adaptationSetCounter)
 
@@ -83,40 +122,36 @@ class DashVodAsset:
       # Increment Period Counter
       periodCounter = periodCounter + 1
 
-    # Identify common base URL for all resources
-    allSegments = list(mediaSegments)
-    allSegments.append(self.masterManifest)
-
-    # Duplicates need to be removed from the list of all segments. Duplicate can occur when processing multiperiod DASH
-    # streams where the init file does not change across period boundaries. To do this the list of segments will be
-    # converted to a set and then back to a list.
-    allSegmentsSet = set(allSegments)
-    uniqueSegments = list(allSegmentsSet)
-
-    # Set common prefix
-    # The common prefix must end with '/' to indicate this is a path and does not include
-    # the start of the name of the files. For example, if all the resources of an asset start
-    # with 'asset1' and the content is stored in 'my/asset/path' the common prefix should be
-    # 'my/asset/path.' not 'my/asset/path/asset1'
-    commonPrefix = os.path.commonprefix( uniqueSegments )
-    if not commonPrefix.endswith('/'):
-      # Strip off anything to the right of the last '/' because this component represents
-      # the common string at the start of the filenames
-      unwantedPathSuffix = os.path.basename(commonPrefix)
-      pathSuffix = re.compile( unwantedPathSuffix + '$' )
-      commonPrefix = pathSuffix.sub('', commonPrefix)
-    self.commonPrefix = commonPrefix
-
-    self.mediaSegmentList = mediaSegments
-    self.allResources = uniqueSegments
+    # Duplicates are not added to the resource table. Duplicate can occur when processing multiperiod DASH
+    # streams where the init file does not change across period boundaries.
+    self.allResources.compact()
 
-    return
+    # Identify common base URL for all resources. The directory prefixes interned by the
+    # resource table give the same result as considering every resource.
+    self.commonPrefix = getCommonPrefix( self.allResources.prefixes )
+
+
+# The common prefix must end with '/' to indicate this is a path and does not include
+# the start of the name of the files. For example, if all the resources of an asset start
+# with 'asset1' and the content is stored in 'my/asset/path' the common prefix should be
+# 'my/asset/path.' not 'my/asset/path/asset1'
+def getCommonPrefix( resources ):
 
-def getManifest( url, authHeaders ):
+  commonPrefix = os.path.commonprefix( resources )
+  if not commonPrefix.endswith('/'):
+    # Strip off anything to the right of the last '/' because this component represents
+    # the common string at the start of the filenames
+    unwantedPathSuffix = os.path.basename(commonPrefix)
+    pathSuffix = re.compile( unwantedPathSuffix + '$' )
+    commonPrefix = pathSuffix.sub('', commonPrefix)
+  return commonPrefix
+
+def getManifest( http, url, authHeaders, validators=None ):
 
   contentType = None
+  requestStart = time.time()
   try:
-    response = http.request( "GET", url, headers=authHeaders )
+    response = http.request( "GET", url, headers=authHeaders, retries=MANIFEST_RETRIES )
   except IOError as urlErr:
     print("Exception occurred while attempting to get: %s" % url )
     print(repr(urlErr))
@@ -128,7 +163,13 @@ def getManifest( url, authHeaders ):
     print('http error', response.status, 'fetching', url)
   else:
     urlPayload = response.data
+    recordMetric( 'manifestFetch', time.time() - requestStart, len(urlPayload) )
     contentType = response.headers['Content-Type']
+    # Record the cache validators of the manifest if requested
+    if validators is not None:
+      for header in ( 'ETag', 'Last-Modified' ):
+        if header in response.headers:
+          validators[header] = response.headers[header]
     expectedLen = int(response.headers['Content-Length'])
     receivedLen = len(urlPayload)
     if receivedLen != expectedLen:
@@ -150,10 +191,9 @@ def normaliseUrl( url ):
   return absUrl
 
 
-def getAdaptationSetSegmentList(mpdBaseUrl, adaptationSet, period):
+# Adds the init and media segments of all the representations in an adaptation set to resourceTable
+def addAdaptationSetSegments(resourceTable, mpdBaseUrl, adaptationSet, period):
 
-  mediaSegments = []
-  
   for representation in adaptationSet.representations:
     print("Processing Representation %s:" % representation.id)
 
@@ -193,7 +233,7 @@ def getAdaptationSetSegmentList(mpdBaseUrl, adaptationSet, period):
     else:
       mediaSegmentTimes = getInferredSegmentTimeline( segmentTemplate.start_number, segmentTemplate.timescale, segmentTemplate.duration, period.duration )
 
-    mediaSegmentsForRepresentation = getMediaSegmentList( mediaSegmentTemplate, segmentTemplate.start_number, mediaSegmentTimes, mpdBaseUrl )
+    addMediaSegments( resourceTable, mediaSegmentTemplate, segmentTemplate.start_number, mediaSegmentTimes, mpdBaseUrl )
 
     ############################
     # Process Init File (it exists for this rendition)
@@ -208,62 +248,56 @@ def getAdaptationSetSegmentList(mpdBaseUrl, adaptationSet, period):
       # Add init file to resource list
       absInitSegmentTemplate = normaliseUrl(mpdBaseUrl + '/' + initSegmentTemplate)
 
-      # Append init files to list of media files to be downloaded
-      mediaSegmentsForRepresentation.append(absInitSegmentTemplate)
+      # Add init file to list of files to be downloaded
+      resourceTable.add(absInitSegmentTemplate)
     else:
       print("Skipping init file as there is no init for '%s' representation" % representation.id)
 
-    # Append list of files to be downloaded as part of this adaptation set
-    mediaSegments.extend(mediaSegmentsForRepresentation)
-
-  return mediaSegments
+# Add media segments to the resource table
+# The segments are stored as the template and a run length encoded timeline so memory
+# used scales with the number of entries in the timeline rather than number of segments
+def addMediaSegments( resourceTable, mediaSegmentTemplate, startNumber, mediaSegmentTimes, mpdBaseUrl ):
 
-# Generate list of media segments
-def getMediaSegmentList( mediaSegmentTemplate, startNumber, mediaSegmentTimes, mpdBaseUrl ):
-  mediaSegments = []
+  # Placeholders do not contain '/' so the template can be normalised before the
+  # placeholder is replaced
+  absMediaSegmentTemplate = normaliseUrl(mpdBaseUrl + '/' + mediaSegmentTemplate)
 
-  for t in mediaSegmentTimes:
-    resource = mediaSegmentTemplate
-
-    # Handle both Time with Timeline and Number with timeline mpd formats
-    if "$Time$" in resource:
-      # Time with Timeline mpd
-      resource = resource.replace("$Time$", str(t))
-    else:
-      # Number with Timeline mpd
-      resource = resource.replace("$Number$", str(startNumber))
-      startNumber = startNumber + 1
-
-    absResource = normaliseUrl(mpdBaseUrl + '/' + resource)
-    mediaSegments.append(absResource)
-
-  return mediaSegments
+  # Handle both Time with Timeline and Number with timeline mpd formats
+  if "$Time$" in mediaSegmentTemplate:
+    # Time with Timeline mpd
+    return resourceTable.addTemplate( absMediaSegmentTemplate, "$Time$", mediaSegmentTimes )
+  else:
+    # Number with Timeline mpd
+    segmentNumbers = ( startNumber + i for i, t in enumerate(mediaSegmentTimes) )
+    return resourceTable.addTemplate( absMediaSegmentTemplate, "$Number$", segmentNumbers )
 
-# Uses the segment template to generate a list of segment times
+# Uses the segment template to generate the segment times
+# Times are generated one at a time rather than being expanded into a list
 def getSegmentTimeline( segmentTemplate ):
 
   segmentTimelines = segmentTemplate.segment_timelines
 
-  # Iterate over the segment components to create a list of the times for segments to download 
-  mediaSegmentTimes = []
+  # Iterate over the segment components to generate the times for segments to download
   segmentTimelineComponents = segmentTimelines[0].Ss
+  t = 0
   for segmentTimelineComponent in segmentTimelineComponents:
 
-    t = segmentTimelineComponent.t # time
+    # The time is optional after the first component, in which case the segment
+    # follows on from the previous segment
+    if segmentTimelineComponent.t is not None:
+      t = segmentTimelineComponent.t # time
     d = segmentTimelineComponent.d # duration
     r = segmentTimelineComponent.r # repeats
 
     # add first segment
-    # print("MediaSegmentTime: %d" % t)
-    mediaSegmentTimes.append(t)
+    yield t
 
     # add any repeat segments
     if not (r is None):
       for x in range(1,r+1):
-        # print("MediaSegmentTime (r): %s" % str(t + x*d))
-        mediaSegmentTimes.append(t + x*d)
+        yield t + x*d
 
-  return mediaSegmentTimes
+    t = t + ((r or 0) + 1) * d
 
 # Infers a segment timeline if not explicitly defined
 def getInferredSegmentTimeline( startNumber, timescale, segmentTemplateDuration, periodDuration ):
@@ -280,7 +314,7 @@ def getInferredSegmentTimeline( startNumber, timescale, segmentTemplateDuration,
   # Calculcate number of segments in period
   numberSegments = int(periodDuration / segmentSize)
 
-  # Create array listing the segment numbers
-  segmentTimelineNumbers = list(range(startNumber, startNumber+numberSegments))
+  # Create range of the segment numbers
+  segmentTimelineNumbers = range(startNumber, startNumber+numberSegments)
 
   return segmentTimelineNumbers
\ No newline at end of file
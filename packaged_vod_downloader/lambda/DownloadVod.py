@@ -30,13 +30,25 @@ import time
 import urllib3
 import concurrent.futures
 import queue
+import threading
 import random
-import boto3
 import json
+import zlib
 from pprint import pprint
 from urllib.parse import urlparse
-from HlsVodAsset import HlsVodAsset
+from HlsVodAsset import HlsVodAsset, DEFAULT_MANIFEST_CONCURRENCY
 from DashVodAsset import DashVodAsset
+from RateLimiter import RateLimiter
+from RetryPolicy import RetryPolicy, CONNECTION_ERROR, LENGTH_MISMATCH
+from ConcurrencyController import AimdConcurrencyController
+from ProgressJournal import ProgressJournal, DEFAULT_SAVE_INTERVAL
+from AssetCache import loadAssetCache, saveAssetCache
+from SyncIndex import SyncIndex, NotModifiedError
+from ByteBudgetBuffer import ByteBudgetBuffer
+from HttpTransport import HttpTransport, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from S3Writer import S3Writer, DEFAULT_MAX_POOL_CONNECTIONS, TRANSFER_MAX_CONCURRENCY
+from LocalWriter import LocalWriter
+from PerformanceMetrics import PerformanceMetrics, setActiveMetrics, recordMetric, timeMetric
 import logging
 
 logger = logging.getLogger()
@@ -54,39 +66,126 @@ logging.getLogger('urllib3').setLevel(logging.INFO)
 # Constants
 LAMBDA_MIN_TIME_REMAINING_TRIGGER = 1 * 120 * 1000 # ms
 MAX_NUMBER_THREAD = 20
-
-poolManager = None
-s3 = boto3.resource('s3')
+STREAM_PART_SIZE = 8 * 1024 * 1024 # bytes, must be at least 5 MiB to satisfy S3 multipart limits
+DEFAULT_RANGE_THRESHOLD = 16 * 1024 * 1024 # bytes
+QUEUE_POLL_INTERVAL = 0.5 # seconds
+QUEUE_LOOKAHEAD = 5 # seconds of work to keep queued, based on measured throughput
+MAX_QUEUE_SIZE = 1000
+MAX_SHARD_PENDING_RANGES = 100 # keeps the result of a shard well below the 256 KB Step Functions limit
+DEFAULT_METRICS_NAMESPACE = 'PackagedVodDownloader'
+S3_STATE_CONNECTIONS = 4
+SPILL_DIR = '/tmp'
+DEFAULT_SPILL_BYTES = 256 * 1024 * 1024 # bytes, Lambda provides at least 512 MB of /tmp
+DEFAULT_UPLOAD_BUFFER_BYTES = 256 * 1024 * 1024 # bytes, used when the function memory size is unknown
+
+httpTransport = None
+rateLimiter = None
+retryPolicy = None
+concurrencyController = None
+rangeSlots = None
+syncIndex = None
+performanceMetrics = None
+s3Writer = None
+destWriter = None
 
 #TODO: Progress update
 #TODO: Add support for CDN Auth headers
 #TODO: Potentially send SNS before any fatal exit (this could provide a more human readable error)
 
 
-def loadUrlWorker(caller, url, authHeaders):
-
+def recordOriginResult(requestStart, status):
+  # Reports the latency and status of an origin request to the adaptive
+  # concurrency controller (if enabled). A status of None indicates the
+  # request failed with a timeout or connection error.
+  if concurrencyController:
+    concurrencyController.recordResult( time.time() - requestStart, status )
+
+def acquireOriginSlot(context):
+  # In adaptive mode waits for the concurrency controller to allow another transfer
+  # from origin. Returns False if the Lambda deadline is reached first.
+  if not concurrencyController:
+    return True
+  return concurrencyController.acquire( getSecondsToDeadline(context) )
+
+def releaseOriginSlot():
+  if concurrencyController:
+    concurrencyController.release()
+
+class LargeResourceError(Exception):
+  # Raised by loadUrlWorker and streamUrlWorker when origin reports a resource larger
+  # than rangeThreshold. The body has not been read, the caller copies the resource
+  # using ranged requests instead (see rangedStreamUrl).
+  def __init__(self, url, size):
+    super().__init__(url, size)
+    self.size = size
+
+def getLargeResourceSize(response, rangeThreshold):
+  # Returns the size of the resource from the 'Content-Length' of a response if it is
+  # larger than rangeThreshold, otherwise None. Not all servers return the header.
+  if rangeThreshold and 'Content-Length' in response.headers.keys():
+    size = int(response.headers['Content-Length'])
+    if size > rangeThreshold:
+      return size
+  return None
+
+def loadUrlWorker(caller, url, authHeaders, rangeThreshold=0, index=None):
+  # In sync mode the validators returned by origin are staged for resource 'index'.
+
+  # Wait for the shared rate limiter before every request sent to origin (including retries)
+  if rateLimiter:
+    rateLimiter.acquireRequest()
+
+  # The body is only read once the headers have been checked, so a resource larger
+  # than rangeThreshold is not loaded into memory
+  requestStart = time.time()
   try:
-    response = poolManager.request( "GET", url, headers=authHeaders )
-  except IOError as urlErr:
+    response = httpTransport.request( "GET", url, headers=authHeaders, preload_content=False )
+  except (IOError, urllib3.exceptions.HTTPError) as urlErr:
+    recordOriginResult(requestStart, None)
     urlPayload = None
     print('I/O error fetching', url)
     print(urlErr)
-    return (urlPayload, None)
+    return (urlPayload, None, (CONNECTION_ERROR, None))
+  recordOriginResult(requestStart, response.status)
+  if response.status == 304:
+    response.release_conn()
+    raise NotModifiedError(url)
 
 # Here if urlopen succeeded.  Check http result code.  Anything other than
 # 200 (success) is returned to caller as an error.
 
+  failure = None
   if response.status != 200:
     logger.info("Failed to download '%s'" % url)
     urlPayload = None
     contentType = None
     print('http error', response.status, 'fetching', url)
+    failure = (response.status, response.headers.get('Retry-After'))
+    response.drain_conn()
+    response.release_conn()
   else:
 
+    largeSize = getLargeResourceSize(response, rangeThreshold)
+    if largeSize is not None:
+      # The unread body is discarded with the connection
+      response.close()
+      raise LargeResourceError(url, largeSize)
+
 # Get the payload.
-    urlPayload = response.data
+    try:
+      urlPayload = response.data
+    except (IOError, urllib3.exceptions.HTTPError) as urlErr:
+      recordOriginResult(requestStart, None)
+      print('I/O error fetching', url)
+      print(urlErr)
+      return (None, None, (CONNECTION_ERROR, None))
+    finally:
+      response.release_conn()
     receivedLen = len(urlPayload)
+    recordMetric('originGet', time.time() - requestStart, receivedLen)
     contentType = response.headers['Content-Type']
+    if rateLimiter:
+      rateLimiter.acquireBytes(receivedLen)
 
     # Not all servers return a 'Content-Length' header. If available it is worth checking
     if 'Content-Length' in response.headers.keys():
@@ -95,74 +194,515 @@ def loadUrlWorker(caller, url, authHeaders):
         print(caller+':', url, 'expected', expectedLen, '; received', receivedLen)
         urlPayload = None
         contentType = None
+        failure = (LENGTH_MISMATCH, None)
 
-  return (urlPayload, contentType)
+  if syncIndex and index is not None and failure is None:
+    syncIndex.stageValidators(index, url, response.headers, len(urlPayload))
 
-def loadUrl(caller, url, authHeaders):
+  return (urlPayload, contentType, failure)
 
-  retryCount = 3
-  retryInterval = 2
-  attempt = 0
+def loadUrl(caller, url, authHeaders, rangeThreshold=0, index=None):
 
-  while attempt < retryCount:
-    (urlPayload, contentType) = loadUrlWorker(caller, url, authHeaders)
+  attempt = 0
+  while True:
+    (urlPayload, contentType, failure) = loadUrlWorker(caller, url, authHeaders, rangeThreshold, index)
     if urlPayload != None:
       return (urlPayload, contentType)
     attempt += 1
-    time.sleep(retryInterval)
+    (reason, retryAfter) = failure
+    retryDelay = retryPolicy.getRetryDelay(reason, attempt, retryAfter)
+    if retryDelay is None:
+      break
+    time.sleep(retryDelay)
+
+  print(caller, 'failed to load after', attempt, 'attempts: ', url)
+  return (None, None)
+
+class OriginReadError(Exception):
+  # Raised by readChunk when the connection to origin fails part way through a body.
+  # Errors writing to the destination (which can also be an IOError, e.g. a full disk)
+  # are therefore not mistaken for origin failures and retried.
+  pass
+
+def readChunk(response, size):
+  # Reads up to 'size' bytes from a streamed response. Depending on the urllib3 version
+  # 'read' can return less than was requested before the end of the body, so keep
+  # reading until the chunk is full or the body is exhausted.
+
+  chunk = bytearray()
+  while len(chunk) < size:
+    try:
+      data = response.read(size - len(chunk))
+    except (IOError, urllib3.exceptions.HTTPError) as urlErr:
+      raise OriginReadError(urlErr)
+    if not data:
+      break
+    chunk.extend(data)
+    if rateLimiter:
+      rateLimiter.acquireBytes(len(data))
+
+  return bytes(chunk)
+
+def streamUrlWorker(caller, url, authHeaders, destWriter, destBucket, destPrefix, objectName, acl, rangeThreshold=0, index=None):
+  # Streams a resource from origin into S3 without holding the whole body in memory.
+  # The body is read in STREAM_PART_SIZE chunks. If the whole body fits in the first chunk
+  # it is written with a single PUT, otherwise each chunk is uploaded as a part of an
+  # S3 multipart upload. Peak memory per thread is therefore bounded by STREAM_PART_SIZE.
+  # Raises LargeResourceError if origin reports a size larger than rangeThreshold.
+  # In sync mode the validators returned by origin are staged for resource 'index'.
+  # Returns a tuple of ( number of bytes written, ETag of the object written, None ) or
+  # ( None, None, ( failure reason, Retry-After ) ) if the resource could not be fetched.
+
+  # Wait for the shared rate limiter before every request sent to origin (including retries)
+  if rateLimiter:
+    rateLimiter.acquireRequest()
+
+  requestStart = time.time()
+  try:
+    response = httpTransport.request( "GET", url, headers=authHeaders, preload_content=False )
+  except (IOError, urllib3.exceptions.HTTPError) as urlErr:
+    recordOriginResult(requestStart, None)
+    print('I/O error fetching', url)
+    print(urlErr)
+    return (None, None, (CONNECTION_ERROR, None))
+  recordOriginResult(requestStart, response.status)
+
+  if response.status == 304:
+    response.release_conn()
+    raise NotModifiedError(url)
+
+  if response.status != 200:
+    logger.info("Failed to download '%s'" % url)
+    print('http error', response.status, 'fetching', url)
+    retryAfter = response.headers.get('Retry-After')
+    response.release_conn()
+    return (None, None, (response.status, retryAfter))
+
+  largeSize = getLargeResourceSize(response, rangeThreshold)
+  if largeSize is not None:
+    # The unread body is discarded with the connection
+    response.close()
+    raise LargeResourceError(url, largeSize)
+
+  contentType = response.headers.get('Content-Type')
+  expectedLen = None
+  # Not all servers return a 'Content-Length' header. If available it is worth checking
+  if 'Content-Length' in response.headers.keys():
+    expectedLen = int(response.headers['Content-Length'])
+  if syncIndex and index is not None:
+    syncIndex.stageValidators(index, url, response.headers, expectedLen)
+
+  key = destPrefix + objectName
+  uploadId = None
+  parts = []
+  receivedLen = 0
+  # Reading the body is interleaved with uploading it, so the time spent uploading
+  # is excluded from the time recorded for the origin GET
+  uploadSeconds = 0.0
+  try:
+    chunk = readChunk(response, STREAM_PART_SIZE)
+    receivedLen = len(chunk)
+    nextChunk = readChunk(response, STREAM_PART_SIZE) if len(chunk) == STREAM_PART_SIZE else b''
+
+    if not nextChunk:
+      # Small object, a single PUT is sufficient
+      if expectedLen is not None and receivedLen != expectedLen:
+        print(caller+':', url, 'expected', expectedLen, '; received', receivedLen)
+        return (None, None, (LENGTH_MISMATCH, None))
+      recordMetric('originGet', time.time() - requestStart, receivedLen)
+      eTag = writeBucket(destWriter, destBucket, destPrefix, objectName, chunk, contentType, acl)
+      return (receivedLen, eTag, None)
+
+    # Large object, pipe the body into a multipart upload one chunk at a time
+    logger.debug("Streaming '%s' to %s using multipart upload" % (url, destWriter.getLocation(destBucket, key)))
+    uploadId = destWriter.createMultipartUpload( destBucket, key, contentType, acl )
+
+    partNumber = 1
+    partOffset = 0
+    while chunk:
+      uploadStart = time.time()
+      parts.append( destWriter.uploadPart( destBucket, key, uploadId, partNumber, chunk, partOffset ) )
+      uploadSeconds += time.time() - uploadStart
+      partNumber += 1
+      partOffset += len(chunk)
+      chunk = nextChunk
+      receivedLen += len(chunk)
+      nextChunk = readChunk(response, STREAM_PART_SIZE) if chunk else b''
+
+    if expectedLen is not None and receivedLen != expectedLen:
+      print(caller+':', url, 'expected', expectedLen, '; received', receivedLen)
+      destWriter.abortMultipartUpload( destBucket, key, uploadId )
+      return (None, None, (LENGTH_MISMATCH, None))
+    recordMetric('originGet', time.time() - requestStart - uploadSeconds, receivedLen)
+
+    eTag = destWriter.completeMultipartUpload( destBucket, key, uploadId, parts )
+
+  except OriginReadError as urlErr:
+    # Origin connection failed part way through the body
+    recordOriginResult(requestStart, None)
+    print('I/O error streaming', url)
+    print(urlErr)
+    if uploadId:
+      destWriter.abortMultipartUpload( destBucket, key, uploadId )
+    return (None, None, (CONNECTION_ERROR, None))
+  except Exception as s3Err:
+    # Failures writing to the destination are fatal, as they are for writeBucket
+    print('Fatal:  error writing to S3')
+    print('Bucket: ', destBucket, ' Asset ID:', destPrefix, ' Object:', objectName, ' ACL:', acl)
+    print(s3Err)
+    os._exit(3)
+  finally:
+    response.release_conn()
+
+  return (receivedLen, eTag, None)
+
+def streamUrl(caller, url, authHeaders, destWriter, destBucket, destPrefix, objectName, acl, rangeThreshold=0, index=None):
+
+  attempt = 0
+  while True:
+    (writtenLen, eTag, failure) = streamUrlWorker(caller, url, authHeaders, destWriter, destBucket, destPrefix, objectName, acl, rangeThreshold, index)
+    if writtenLen != None:
+      return (writtenLen, eTag)
+    attempt += 1
+    (reason, retryAfter) = failure
+    retryDelay = retryPolicy.getRetryDelay(reason, attempt, retryAfter)
+    if retryDelay is None:
+      break
+    time.sleep(retryDelay)
 
   print(caller, 'failed to load after', attempt, 'attempts: ', url)
   return (None, None)
 
-def fetchSegments(n, baseUrl, fetchQ, s3, destBucket, destPrefix, acl, authHeaders):
+def loadRangeWorker(caller, url, authHeaders, firstByte, lastByte, index=None):
+  # Fetches bytes firstByte to lastByte (inclusive) of a resource using a ranged GET.
+  # Returns a tuple of ( payload, contentType, total size of the resource, failure ).
+  # In sync mode the validators returned for the first range are staged for resource 'index'.
+
+  # Wait for the shared rate limiter before every request sent to origin (including retries)
+  if rateLimiter:
+    rateLimiter.acquireRequest()
+
+  headers = dict(authHeaders) if authHeaders else {}
+  headers['Range'] = 'bytes=%d-%d' % (firstByte, lastByte)
+
+  requestStart = time.time()
+  try:
+    response = httpTransport.request( "GET", url, headers=headers )
+  except (IOError, urllib3.exceptions.HTTPError) as urlErr:
+    recordOriginResult(requestStart, None)
+    print('I/O error fetching', url, headers['Range'])
+    print(urlErr)
+    return (None, None, None, (CONNECTION_ERROR, None))
+  recordOriginResult(requestStart, response.status)
+
+  if response.status == 304:
+    raise NotModifiedError(url)
+  elif response.status == 206:
+    # e.g. Content-Range: bytes 0-8388607/1073741824
+    totalSize = response.headers.get('Content-Range', '').rpartition('/')[2]
+    totalSize = int(totalSize) if totalSize.isdigit() else None
+  elif response.status == 200 and firstByte == 0:
+    # Origin ignored the Range header and returned the whole resource
+    totalSize = None
+  else:
+    logger.info("Failed to download '%s' %s" % (url, headers['Range']))
+    print('http error', response.status, 'fetching', url, headers['Range'])
+    return (None, None, None, (response.status, response.headers.get('Retry-After')))
+
+  urlPayload = response.data
+  receivedLen = len(urlPayload)
+  recordMetric('originGet', time.time() - requestStart, receivedLen)
+  contentType = response.headers.get('Content-Type')
+  if rateLimiter:
+    rateLimiter.acquireBytes(receivedLen)
+  if response.status == 200:
+    totalSize = receivedLen
+
+  # Not all servers return a 'Content-Length' header. If available it is worth checking
+  expectedLen = None
+  if 'Content-Length' in response.headers.keys():
+    expectedLen = int(response.headers['Content-Length'])
+  elif response.status == 206 and totalSize is not None:
+    expectedLen = min(lastByte, totalSize - 1) - firstByte + 1
+  if expectedLen is not None and receivedLen != expectedLen:
+    print(caller+':', url, headers['Range'], 'expected', expectedLen, '; received', receivedLen)
+    return (None, None, None, (LENGTH_MISMATCH, None))
+
+  if syncIndex and index is not None and firstByte == 0 and totalSize is not None:
+    syncIndex.stageValidators(index, url, response.headers, totalSize)
+
+  return (urlPayload, contentType, totalSize, None)
+
+def loadRange(caller, url, authHeaders, firstByte, lastByte, context=None, index=None):
+
+  attempt = 0
+  while True:
+    # Every range request takes a slot of the adaptive concurrency controller, so the
+    # ranges of large files count towards the concurrency limit like whole resources
+    if not acquireOriginSlot(context):
+      print(caller, 'reached the deadline waiting to load bytes', firstByte, '-', lastByte, ': ', url)
+      return (None, None, None)
+    try:
+      (urlPayload, contentType, totalSize, failure) = loadRangeWorker(caller, url, authHeaders, firstByte, lastByte, index)
+    finally:
+      releaseOriginSlot()
+    if urlPayload != None:
+      return (urlPayload, contentType, totalSize)
+    attempt += 1
+    (reason, retryAfter) = failure
+    retryDelay = retryPolicy.getRetryDelay(reason, attempt, retryAfter)
+    if retryDelay is None:
+      break
+    time.sleep(retryDelay)
+
+  print(caller, 'failed to load bytes', firstByte, '-', lastByte, 'after', attempt, 'attempts: ', url)
+  return (None, None, None)
+
+def rangedStreamUrl(caller, url, authHeaders, destWriter, destBucket, destPrefix, objectName, acl, rangeConcurrency, firstRangeSize, context, conditionalHeaders=None, index=None):
+  # Copies a large resource (e.g. a single file HLS rendition referenced using
+  # EXT-X-BYTERANGE) to S3 using parallel ranged GETs so a single connection to origin
+  # is not the bottleneck. The first range (of firstRangeSize bytes) also returns the
+  # size of the resource, so resources no larger than firstRangeSize only need a single
+  # request. The remaining ranges are fetched by up to rangeConcurrency threads and each
+  # range is uploaded as a part of an S3 multipart upload as soon as it has been
+  # received. Each range held in memory takes one of the rangeSlots shared by all
+  # workers, so peak memory across all ranged transfers is bounded by rangeBufferBytes.
+  # Any conditionalHeaders are only sent with the first request, which also stages the
+  # validators of resource 'index' in sync mode.
+  # Returns a tuple of ( number of bytes written, ETag of the object written ) or
+  # ( None, None ) if the resource could not be fetched.
+
+  firstRequestHeaders = authHeaders
+  if conditionalHeaders:
+    firstRequestHeaders = dict(authHeaders) if authHeaders else {}
+    firstRequestHeaders.update(conditionalHeaders)
+  key = destPrefix + objectName
+
+  def uploadPart(partNumber, body, offset):
+    try:
+      return destWriter.uploadPart( destBucket, key, uploadId, partNumber, body, offset )
+    except Exception as s3Err:
+      print('Fatal:  error writing to S3')
+      print('Bucket: ', destBucket, ' Asset ID:', destPrefix, ' Object:', objectName, ' ACL:', acl)
+      print(s3Err)
+      os._exit(3)
+
+  # Stop fetching ranges once one range has failed or the Lambda deadline is reached.
+  # The ranges already copied would be lost if the transfer stopped, so in a batch the
+  # transfer carries on past the end of the job's time slice (see BatchDownloader.py).
+  deadlineContext = getattr( context, 'invocationContext', context )
+  failed = threading.Event()
+  def transferRange(partNumber, firstByte, lastByte):
+    if failed.is_set() or isDeadlineReached(deadlineContext):
+      failed.set()
+      return None
+    with rangeSlots:
+      (body, rangeContentType, rangeTotalSize) = loadRange(caller, url, authHeaders, firstByte, lastByte, deadlineContext)
+      if body is None or rangeTotalSize != totalSize:
+        failed.set()
+        return None
+      return uploadPart(partNumber, body, firstByte)
+
+  # The first range holds a slot until it has been written
+  with rangeSlots:
+    (firstPart, contentType, totalSize) = loadRange(caller, url, firstRequestHeaders, 0, firstRangeSize - 1, deadlineContext, index)
+    if firstPart is None:
+      return (None, None)
+
+    if totalSize is not None and len(firstPart) >= totalSize:
+      eTag = writeBucket(destWriter, destBucket, destPrefix, objectName, firstPart, contentType, acl)
+      return (totalSize, eTag)
+
+    if totalSize is not None:
+      logger.debug("Copying '%s' (%d bytes) to %s using ranged requests" % (url, totalSize, destWriter.getLocation(destBucket, key)))
+      try:
+        uploadId = destWriter.createMultipartUpload( destBucket, key, contentType, acl )
+      except Exception as s3Err:
+        print('Fatal:  error writing to S3')
+        print('Bucket: ', destBucket, ' Asset ID:', destPrefix, ' Object:', objectName, ' ACL:', acl)
+        print(s3Err)
+        os._exit(3)
+      firstPartLen = len(firstPart)
+      parts = [ uploadPart(1, firstPart, 0) ]
+    firstPart = None
+
+  if totalSize is None:
+    # Size is unknown so the resource cannot be split into ranges
+    if not acquireOriginSlot(deadlineContext):
+      return (None, None)
+    try:
+      return streamUrl(caller, url, authHeaders, destWriter, destBucket, destPrefix, objectName, acl, index=index)
+    finally:
+      releaseOriginSlot()
+
+  ranges = [ ( partNumber, firstByte, min(firstByte + STREAM_PART_SIZE, totalSize) - 1 )
+             for partNumber, firstByte in enumerate(range(firstPartLen, totalSize, STREAM_PART_SIZE), start=2) ]
+  with concurrent.futures.ThreadPoolExecutor(max_workers=rangeConcurrency) as executor:
+    parts.extend( executor.map( lambda r: transferRange(*r), ranges ) )
+
+  if failed.is_set():
+    destWriter.abortMultipartUpload( destBucket, key, uploadId )
+    return (None, None)
+
+  eTag = destWriter.completeMultipartUpload( destBucket, key, uploadId, parts )
+  return (totalSize, eTag)
+
+def fetchSegments(n, baseUrl, fetchQ, queueDone, destWriter, destBucket, destPrefix, acl, authHeaders, transferMode, rangeConcurrency, rangeThreshold, journal, context, uploadBuffer=None):
 # This is the function invoked for each thread created.
 
-# Reads a segment name from the queue, and calls loadUrl to fetch
+# Reads a segment index from the queue, and calls loadUrl to fetch
 # it.  If no success, skips the segment and moves on to the next.
-# The fetch rate is determined by the queue fill rate.
+# The thread exits once the producer has set 'queueDone' and the queue
+# is empty, or when the Lambda deadline is reached. At the deadline the
+# thread stops taking new work so in-flight writes can finish before the
+# function times out.
 #
 # If the fetch succeeds, writes the segment to the specifed S3 bucket.
+# In 'stream' transfer mode the segment is piped from origin to S3 in chunks
+# rather than being fully loaded into memory first. Files referenced using byte
+# ranges, and when a rangeThreshold is set any resource larger than rangeThreshold,
+# are copied using parallel ranged requests. The size is known from an earlier copy
+# (see ResourceSizes) or from the 'Content-Length' of the first response.
+# Successfully copied segments are marked as complete in the journal.
+# In sync mode segments which have not changed at origin are also marked as complete.
+#
+# When an uploadBuffer is given, segments fetched in 'buffered' transfer mode are
+# added to the buffer instead of being written to S3. The uploadSegments workers
+# write them to S3 and mark them as complete.
 
   downloadedSegments = []
-  segment = ''
   skippedSegments = []
-  while segment != '#QUIT':
-    segment = fetchQ.get()
-
-    if segment != '#QUIT':
-
-      # fetch segment here
-      segmentBase = segment.split('?')[0]   # Strip off any query params
-      segmentBase = '/' + segmentBase.replace(baseUrl, "")
-      
-      t = time.time()
-      logger.debug("Attempting to download: %s" % segment)
-      (segmentData, contentType) = loadUrl('fetchSegments', segment, authHeaders)
-      if segmentData == None:
-        logger.debug("No segment data downloaded")
-        logger.debug("'%s' fetch attempt failed; skipping" % segmentBase)
-        skippedSegments.append(segment)
+  unchangedSegments = []
+  while not isDeadlineReached(context):
+    try:
+      index = fetchQ.get(timeout=QUEUE_POLL_INTERVAL)
+    except queue.Empty:
+      if queueDone.is_set():
+        break
+      continue
+
+    segment = journal.vodAsset.allResources[index]
+
+    # fetch segment here
+    segmentBase = segment.split('?')[0]   # Strip off any query params
+    segmentBase = '/' + segmentBase.replace(baseUrl, "")
+
+    logger.debug("Attempting to download: %s" % segment)
+
+    # In sync mode resources already at the destination are re-fetched with a
+    # conditional GET, so only resources which have changed at origin are copied
+    knownSize = journal.vodAsset.resourceSizes.get(index)
+    conditionalHeaders = None
+    if syncIndex:
+      conditionalHeaders = syncIndex.getConditionalHeaders( index, segment, getObjectKey(segment, baseUrl), journal.vodAsset.resourceSizes )
+    requestHeaders = authHeaders
+    if conditionalHeaders:
+      requestHeaders = dict(authHeaders) if authHeaders else {}
+      requestHeaders.update(conditionalHeaders)
+
+    # In adaptive mode only the number of workers allowed by the controller fetch at once.
+    # Ranged transfers take a slot for each of their range requests instead (see loadRange).
+    ranged = segment in journal.vodAsset.rangedResources or ( rangeThreshold and knownSize is not None and knownSize > rangeThreshold )
+    if not ranged and not acquireOriginSlot(context):
+      # Deadline reached while waiting, the resource is left for the next invocation
+      fetchQ.task_done()
+      break
+
+    # The slot is released (and the queue entry completed) even if the transfer fails
+    # with an unexpected exception, so other workers are not blocked
+    try:
+      handedToUploader = False
+      try:
+        if not ranged:
+          # The size of a resource which has not been copied before is unknown. When origin
+          # reports it is larger than rangeThreshold the GET is abandoned before the body
+          # is read and the resource is copied using ranged requests instead.
+          try:
+            if transferMode == 'stream':
+              (writtenLen, eTag) = streamUrl('fetchSegments', segment, requestHeaders, destWriter, destBucket, destPrefix, segmentBase, acl, rangeThreshold, index)
+            else:
+              (writtenLen, eTag) = (None, None)
+              (segmentData, contentType) = loadUrl('fetchSegments', segment, requestHeaders, rangeThreshold, index)
+              if segmentData == None:
+                logger.debug("No segment data downloaded")
+              elif uploadBuffer:
+                # Blocks while the buffer is full, i.e. when uploads are behind downloads
+                uploadBuffer.put( ( index, segment, segmentBase, contentType ), segmentData )
+                handedToUploader = True
+              else:
+                eTag = writeBucket(destWriter, destBucket, destPrefix, segmentBase, segmentData, contentType, acl)
+                writtenLen = len(segmentData)
+          except LargeResourceError as largeResource:
+            logger.debug("'%s' is %d bytes, copying it using ranged requests" % (segmentBase, largeResource.size))
+            releaseOriginSlot()
+            ranged = True
+        if ranged:
+          (writtenLen, eTag) = rangedStreamUrl('fetchSegments', segment, authHeaders, destWriter, destBucket, destPrefix, segmentBase, acl, rangeConcurrency, STREAM_PART_SIZE, context, conditionalHeaders, index)
+      except NotModifiedError:
+        # Resource has not changed at origin since it was copied to the destination
+        logger.debug("'%s' not modified at origin" % segmentBase)
+        journal.markComplete(index)
+        unchangedSegments.append(segment)
       else:
-        writeBucket(s3, destBucket, destPrefix, segmentBase, segmentData, contentType, acl)
-        downloadedSegments.append(segment)
-        # if verbose:
-        #   print('Thread', n, segmentBase, contentType, '{:2.2f}'.format(time.time() - t), 's')
-    fetchQ.task_done()
+        if handedToUploader:
+          # Marked as complete by the uploadSegments worker once written to S3
+          pass
+        elif writtenLen == None:
+          logger.debug("'%s' fetch attempt failed; skipping" % segmentBase)
+          skippedSegments.append(segment)
+        else:
+          journal.markComplete( index, writtenLen, eTag )
+          downloadedSegments.append(segment)
+        if syncIndex and not handedToUploader:
+          syncIndex.recordValidators( index, commit=writtenLen is not None )
+    finally:
+      if not ranged:
+        releaseOriginSlot()
+      fetchQ.task_done()
 
   return {
     "downloadedSegments": downloadedSegments,
     "totalDownloadedSegments": len(downloadedSegments),
     "skippedSegments": skippedSegments,
-    "totalSkippedSegments": len(skippedSegments)
+    "totalSkippedSegments": len(skippedSegments),
+    "unchangedSegments": unchangedSegments,
+    "totalUnchangedSegments": len(unchangedSegments)
+  }
+
+def uploadSegments(n, uploadBuffer, destWriter, destBucket, destPrefix, acl, journal):
+# Upload stage used when 'uploadThreads' is set. Takes the segments fetched by the
+# fetchSegments workers from the upload buffer, writes them to S3 and marks them as
+# complete in the journal. The thread exits once the buffer has been closed and is
+# empty, so every segment which has been fetched is written even after the deadline.
+
+  downloadedSegments = []
+  while True:
+    entry = uploadBuffer.get()
+    if entry is None:
+      break
+    ( ( index, segment, segmentBase, contentType ), segmentData ) = entry
+    eTag = writeBucket(destWriter, destBucket, destPrefix, segmentBase, segmentData, contentType, acl)
+    uploadBuffer.release( len(segmentData) )
+    journal.markComplete( index, len(segmentData), eTag )
+    downloadedSegments.append(segment)
+    if syncIndex:
+      syncIndex.recordValidators( index )
+
+  return {
+    "downloadedSegments": downloadedSegments,
+    "totalDownloadedSegments": len(downloadedSegments),
+    "skippedSegments": [],
+    "totalSkippedSegments": 0
   }
 
 
-def writeBucket(s3, destBucket, destPrefix, objectName, content, contentType, acl):
+def writeBucket(destWriter, destBucket, destPrefix, objectName, content, contentType, acl):
 # Writes content to prefix+objectName in bucketName.  Failures are fatal.
+# Returns the ETag of the object written, if the writer knows it.
 
  try:
-  logger.debug("DEBUG: Writing segment to: s3://%s/%s" % (destBucket, destPrefix+objectName))
-  s3.Bucket(destBucket).put_object(Key=destPrefix+objectName, Body=content, ContentType=contentType, ACL=acl)
+  logger.debug("DEBUG: Writing segment to: %s" % destWriter.getLocation(destBucket, destPrefix+objectName))
+  return destWriter.putObject(destBucket, destPrefix+objectName, content, contentType, acl)
  except Exception as s3Err:
    print('Fatal:  error writing to S3')
    print('Bucket: ', destBucket, ' Asset ID:', destPrefix, ' Object:', objectName, ' ACL:', acl)
@@ -170,15 +710,19 @@ def writeBucket(s3, destBucket, destPrefix, objectName, content, contentType, ac
    os._exit(3)
 
 
-def fetchStream(event, context):
+def fetchStream(event, context, shared=None):
 
   # - Validate input
   # - Identify all the files in the asset to be copied
   # - Identify what (if any) files have already been copied to the destination
-  # - Copy missing files to destination
+  # - Copy missing files to destination. In 'sync' mode files already at the
+  #   destination are also copied again if they have changed at origin.
   # - Return result containing:
   #   - Number of assets copied
   #   - State: Complete | Incomplete
+  #
+  # When called by fetchBatch 'shared' holds the resources shared by all the jobs
+  # of the batch.
 
   logger.info("Event:")
   pprint(event)
@@ -194,119 +738,412 @@ def fetchStream(event, context):
       'result': { "status": "FAILED" }
     }
 
+  # Profile the invocation if requested. The profiled invocation runs with the
+  # 'profile' option removed.
+  if event.get('profile'):
+    return profileInvocation(event, context)
+
   # Setup variables
   masterManifestUrl           = event['source_url']
-  destBucket                  = event['destination_bucket']
+  destBucket                  = event.get('destination_bucket')
   packaging_group_auth_header = None
   if 'packaging_group_auth_header' in event.keys():
     packaging_group_auth_header = event['packaging_group_auth_header']
-  rpsLimit          = event['rpsLimit']
+  rpsLimit          = event.get('rpsLimit', 0)   # 0 disables the request rate limit
+  rpsBurst          = 1
+  bytesPerSecondLimit = 0
+  bytesBurst        = None
   acl               = 'private'
   numThreads        = 5
+  transferMode      = 'buffered'
+  engine            = 'threads'
+  concurrencyMode   = 'fixed'
+  asyncConcurrency  = 100
+  manifestConcurrency = DEFAULT_MANIFEST_CONCURRENCY
+  pipelineManifests = True
+  rangeConcurrency  = 8
+  rangeThreshold    = DEFAULT_RANGE_THRESHOLD
+  useAssetCache     = True
+  mode              = 'copy'
+  shardCount        = 1
+  shardIndex        = 0
+  uploadThreads     = 0
+  uploadBufferBytes = getDefaultUploadBufferBytes()
+  rangeBufferBytes  = getDefaultUploadBufferBytes()
+  spillBytes        = DEFAULT_SPILL_BYTES
+  emitMetrics       = True
+  metricsNamespace  = DEFAULT_METRICS_NAMESPACE
   destPath          = None
   if 'destination_path' in event.keys():
     destPath   = event['destination_path']
   if 'numThreads' in event.keys():
     numThreads = event['numThreads']
+  if 'transferMode' in event.keys():
+    transferMode = event['transferMode']
+  if 'engine' in event.keys():
+    engine = event['engine']
+  if 'rpsBurst' in event.keys():
+    rpsBurst = event['rpsBurst']
+  if 'bytesPerSecondLimit' in event.keys():
+    bytesPerSecondLimit = event['bytesPerSecondLimit']
+  if 'bytesBurst' in event.keys():
+    bytesBurst = event['bytesBurst']
+  if 'asyncConcurrency' in event.keys():
+    asyncConcurrency = event['asyncConcurrency']
+  if 'concurrencyMode' in event.keys():
+    concurrencyMode = event['concurrencyMode']
+  if 'manifestConcurrency' in event.keys():
+    manifestConcurrency = event['manifestConcurrency']
+  if 'pipelineManifests' in event.keys():
+    pipelineManifests = event['pipelineManifests']
+  if 'rangeConcurrency' in event.keys():
+    rangeConcurrency = event['rangeConcurrency']
+  if 'rangeThreshold' in event.keys():
+    # Zero disables ranged requests, except for files referenced using byte ranges
+    rangeThreshold = event['rangeThreshold']
+  if 'rangeBufferBytes' in event.keys():
+    rangeBufferBytes = event['rangeBufferBytes']
+  if 'assetCache' in event.keys():
+    useAssetCache = event['assetCache']
+  if 'mode' in event.keys():
+    mode = event['mode']
+  if 'shardCount' in event.keys():
+    shardCount = event['shardCount']
+  if 'shardIndex' in event.keys():
+    shardIndex = event['shardIndex']
+  if 'uploadThreads' in event.keys():
+    uploadThreads = event['uploadThreads']
+  if 'uploadBufferBytes' in event.keys():
+    uploadBufferBytes = event['uploadBufferBytes']
+  if 'spillBytes' in event.keys():
+    # Zero disables spilling to SPILL_DIR
+    spillBytes = event['spillBytes']
+  if 'emitMetrics' in event.keys():
+    emitMetrics = event['emitMetrics']
+  if 'metricsNamespace' in event.keys():
+    metricsNamespace = event['metricsNamespace']
+  if engine == 'async' and event.get('destination_dir'):
+    # The async engine uploads to S3 using presigned URLs
+    logger.warning("Async engine does not support a local destination, using thread engine")
+    engine = 'threads'
+  if mode == 'sync' and engine == 'async':
+    # Resources are only checked for changes by the thread engine
+    logger.warning("Async engine does not support sync mode, using thread engine")
+    engine = 'threads'
+  if concurrencyMode == 'adaptive' and engine == 'async':
+    logger.warning("Async engine does not support adaptive concurrency, %d transfers are kept in flight" % asyncConcurrency)
+    concurrencyMode = 'fixed'
 
   # Parse passed in Auth Header
   authHeaders = None
   if packaging_group_auth_header:
     authHeaders = parseAuthHeaders(packaging_group_auth_header)
 
-  # Initialize urllib3 Pool Manager
-  global poolManager
-  poolManager = urllib3.PoolManager( maxsize=numThreads )
-
-  # Parse origin asset manifests
-  vodAsset = None
-  vodAssetType = None
-  try:
-    ( vodAsset, vodAssetType ) = parseVodAssetManifests( masterManifestUrl, authHeaders )
-  except IOError as urlErr:
-    return {
-      'status': 500,
-      'message': "%s: Unable access manifest." % repr(urlErr),
-      'result': { "status": "FAILED" }
-    }
-  except Exception as e:
-    print(repr(e))
-    return {
-      'status': 500,
-      'message': "Unhandled Exception. Check logs",
-      'result': { "status": "FAILED" }
-    }
+  # Latency and throughput of each phase of the download are measured for the
+  # whole invocation, including the manifest fetches made by the asset parsers
+  global performanceMetrics
+  performanceMetrics = PerformanceMetrics()
+  setActiveMetrics( performanceMetrics )
+
+  # In adaptive mode enough workers for the maximum concurrency are started and
+  # the controller decides how many of them may fetch from origin at once
+  global concurrencyController
+  concurrencyController = None
+  if concurrencyMode == 'adaptive':
+    concurrencyController = AimdConcurrencyController(
+      minConcurrency=event.get('minThreads', 2),
+      maxConcurrency=event.get('maxThreads', MAX_NUMBER_THREAD),
+      latencyTargetMs=event.get('latencyTargetMs', 1000),
+      errorRateThreshold=event.get('errorRateThreshold', 0.05)
+    )
+    numThreads = concurrencyController.maxConcurrency
+
+  # Ranges held in memory by ranged transfers (see rangedStreamUrl) are limited across
+  # all workers, each range taking up to STREAM_PART_SIZE bytes
+  global rangeSlots
+  rangeSlots = threading.BoundedSemaphore( max( 1, rangeBufferBytes // STREAM_PART_SIZE ) )
+
+  # Initialize the HTTP transport shared by all requests to origin
+  # Failed requests are retried by the retry policy, so urllib3 only follows redirects
+  global httpTransport
+  originRetries = urllib3.Retry( total=None, connect=0, read=0, status=0, other=0, redirect=3,
+                                 respect_retry_after_header=False )
+  # Each worker may have up to rangeConcurrency requests in flight when copying a large
+  # file using ranged requests, while variant manifests are still being fetched
+  httpTransport = getSharedResource( shared, 'httpTransport', lambda: HttpTransport(
+    maxConnectionsPerHost=numThreads * rangeConcurrency + manifestConcurrency,
+    connectTimeout=event.get('connectTimeout', DEFAULT_CONNECT_TIMEOUT),
+    readTimeout=event.get('readTimeout', DEFAULT_READ_TIMEOUT),
+    retries=originRetries ) )
+
+  # Initialize the destination writer. For S3 each worker may have up to
+  # rangeConcurrency part uploads in flight (or TRANSFER_MAX_CONCURRENCY when uploading
+  # a large body), as may each upload thread, and a few more connections are used to
+  # save the checkpoint and other state.
+  global destWriter
+  destWriter = getDestWriter( event, numThreads * max(rangeConcurrency, TRANSFER_MAX_CONCURRENCY) +
+                                     uploadThreads * TRANSFER_MAX_CONCURRENCY + S3_STATE_CONNECTIONS )
+
+  # Initialize rate limiter shared by all workers (and by all the jobs of a batch)
+  global rateLimiter
+  rateLimiter = getSharedResource( shared, 'rateLimiter',
+                                   lambda: RateLimiter( rpsLimit, rpsBurst, bytesPerSecondLimit, bytesBurst ) )
+
+  # Initialize retry policy shared by all workers. The retry budget applies to the
+  # whole invocation rather than to each resource.
+  global retryPolicy
+  retryPolicy = RetryPolicy(
+    maxAttempts=event.get('retryMaxAttempts', 3),
+    baseDelay=event.get('retryBaseDelay', 0.5),
+    maxDelay=event.get('retryMaxDelay', 20),
+    retryableStatuses=event.get('retryableStatuses'),
+    retryBudget=event.get('retryBudget', 1000)
+  )
+
+  # The workflow parses a sharded asset once and saves it to the asset cache before the
+  # shards are downloaded, rather than every shard fetching and parsing the manifests
+  if event.get('prepareAsset'):
+    return prepareAsset( destBucket, destPath, masterManifestUrl, authHeaders, manifestConcurrency, mode )
+
+  # When an asset is split into shards each shard is downloaded by a separate invocation
+  # and keeps its own checkpoint and sync index
+  statePath = destPath
+  if shardCount > 1:
+    statePath = "%s.shard-%d-of-%d" % (destPath, shardIndex, shardCount)
+
+  # Origin validators of the resources copied to the destination. These are only loaded
+  # and recorded in sync mode. The first sync of an asset falls back to the time each
+  # object was written to the destination (see SyncIndex.getConditionalHeaders).
+  global syncIndex
+  syncIndex = None
+  if mode == 'sync':
+    syncIndex = SyncIndex.load( destWriter, destBucket, statePath )
+
+  # Continuation invocations (e.g. after LAMBDA_TIMEOUT) resume from the checkpoint
+  # written by the previous invocation rather than re-parsing the asset manifests
+  # and re-listing the destination. Verification always starts from the destination.
+  journal = None
+  if mode != 'verify':
+    journal = ProgressJournal.load( destWriter, destBucket, statePath, masterManifestUrl, mode )
+
+  # The checkpoint is kept beside the destination path rather than in it. If the objects
+  # it records as copied have since been removed from the destination it is discarded
+  # and the download starts again.
+  if journal and journal.numCompleted and next( destWriter.listObjects( destBucket, destPath + '/' ), None ) is None:
+    logger.info("Destination is empty, discarding checkpoint of %d copied resources" % journal.numCompleted)
+    journal.delete()
+    journal = None
+  resumedFromCheckpoint = journal is not None
+  cachedAsset = None
+
+  # Sync mode needs the destination index to decide which resources to check for changes
+  preExistingObjects = None
+  if mode == 'sync':
+    preExistingObjects = listObjectsAtDestination( destWriter, destBucket, destPath )
+    syncIndex.existingObjects = preExistingObjects
+
+  if not resumedFromCheckpoint:
+    # Inspect destination to check which (if any) files have already been copied)
+    if preExistingObjects is None:
+      preExistingObjects = listObjectsAtDestination( destWriter, destBucket, destPath )
+
+    # Reuse the resources parsed by an earlier download of the asset if the master
+    # manifest has not changed since. Only the master manifest is validated, so sync
+    # mode always parses the manifests to find resources added to a variant, unless
+    # they were parsed for the shards by the 'prepareAsset' step (see prepareAsset).
+    vodAsset = None
+    vodAssetType = None
+    assetPrepared = shardCount > 1 and event.get('assetPrepared', False)
+    if useAssetCache and ( mode != 'sync' or assetPrepared ):
+      cachedAsset = loadAssetCache( destWriter, destBucket, destPath, masterManifestUrl, httpTransport, authHeaders )
+      if cachedAsset:
+        ( vodAsset, vodAssetType ) = cachedAsset
+
+    # The thread engine can start fetching the segments of the first variants while the
+    # remaining variant manifests are still being fetched and parsed. This is limited to
+    # new downloads as the keys of objects from an earlier download are only known once
+    # all the manifests have been parsed. Shards also depend on the final object keys.
+    pipelined = ( pipelineManifests and engine != 'async' and mode != 'verify' and shardCount == 1
+                  and not preExistingObjects and vodAsset is None )
+
+    # Parse origin asset manifests
+    if vodAsset is None:
+      try:
+        ( vodAsset, vodAssetType ) = parseVodAssetManifests( masterManifestUrl, authHeaders, manifestConcurrency, pipelined, httpTransport )
+      except Exception as e:
+        return getManifestFailureResult(e)
+      else:
+        if vodAssetType == "UnsupportedFormat":
+          return {
+            'status': 500,
+            'message': "Manifest is of an unsupported format",
+            'result': { "status": "FAILED" }
+          }
+
+    # Record the resolved resources and those already at the destination in a checkpoint
+    # so continuation invocations do not need to repeat the steps above. When pipelined
+    # the resources are added to the checkpoint as the variant manifests are parsed.
+    journal = ProgressJournal( destWriter, destBucket, statePath, masterManifestUrl, vodAssetType, vodAsset, mode )
+    if not pipelined:
+      # In sync mode every resource is checked so nothing is marked as complete yet
+      if mode != 'sync':
+        markObjectsAtDestination( journal, preExistingObjects )
+      if mode != 'verify':
+        journal.save()
+      # Shards only read the asset cache, so they do not race to write it
+      if useAssetCache and not cachedAsset and shardCount == 1:
+        saveAssetCache( destWriter, destBucket, destPath, masterManifestUrl, vodAssetType, vodAsset )
   else:
-    if vodAssetType == "UnsupportedFormat":
-      return {
-        'status': 500,
-        'message': "Manifest is of an unsupported format",
-        'result': { "status": "FAILED" }
-      }
-
-
-  # Inspect destination to check which (if any) files have already been copied)
-  preExistingObjects = listObjectsAtDestination( s3, destBucket, destPath )
-
-  logger.info( "Source asset contains %d resources" % len(vodAsset.allResources) )
-  logger.info( "%d resources need to be downloaded" % (len(vodAsset.allResources)-len(preExistingObjects)) )
+    pipelined = False
+
+  # Resources belonging to other shards are treated as complete by this invocation
+  numOtherShardResources = 0
+  if shardCount > 1:
+    numOtherShardResources = markResourcesInOtherShards( journal, shardCount, shardIndex )
+    logger.info( "Shard %d of %d contains %d resources" %
+                 (shardIndex, shardCount, len(journal.vodAsset.allResources) - numOtherShardResources) )
+
+  # Save the checkpoint periodically while resources are copied. When pipelined the
+  # resource table is only complete once every manifest has been parsed.
+  checkpointInterval = event.get('checkpointInterval', DEFAULT_SAVE_INTERVAL)
+  if mode != 'verify' and not pipelined:
+    journal.saveInterval = checkpointInterval
+
+  if not pipelined:
+    logger.info( "Source asset contains %d resources" % len(journal.vodAsset.allResources) )
+    logger.info( "%d resources need to be downloaded" % (len(journal.vodAsset.allResources) - journal.numCompleted) )
+
+  # Files referenced using byte ranges can be several GB, the async engine would fetch
+  # each of them with a single request
+  if engine == 'async' and journal.vodAsset.rangedResources:
+    logger.warning("Async engine does not support files referenced using byte ranges, using thread engine")
+    engine = 'threads'
 
   #TODO: Could possible default the number of threads to a minimum of one thread per variant
 
-  # Create queue
-  fetchQ = queue.Queue()
-
   # Main processing loop starts here.
   numQueuedObject = 0
   fetchStart = time.time()
 
-  # We can use a with statement to ensure threads are cleaned up promptly
-  threadResults = {}
-  with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_NUMBER_THREAD) as executor:
-
-    # Start the load operations and mark each future with its thread number
-    logger.info('Starting %d threads' % numThreads)
-    threadNumbers = list(range(1, numThreads+1))
-    threads = {executor.submit(fetchSegments, n, vodAsset.commonPrefix, fetchQ, s3, destBucket, destPath, acl, authHeaders): n for n in threadNumbers}
-
-    ( stopBeforeTimeout, numberQueuedObjects ) = queueObjectsToFetch(preExistingObjects, vodAsset.allResources, vodAsset.commonPrefix, fetchQ, rpsLimit, context)
-
-    # All media segments have been queued.  Now send QUIT token to worker threads, 
-    # and wait for them to complete
-    for t in range(numThreads):
-      fetchQ.put('#QUIT')
+  threadResults = []
+  if mode == 'verify':
+    # Nothing is copied, the result reports any resources missing from the destination
+    stopBeforeTimeout = False
+  elif engine == 'async':
+    # Imported here so aiohttp is only required when the async engine is selected
+    from AsyncDownloader import AsyncDownloader
+    logger.info('Starting async engine with up to %d transfers in flight' % asyncConcurrency)
+    downloader = AsyncDownloader( journal.vodAsset.commonPrefix, destBucket, destPath, acl, authHeaders,
+                                  asyncConcurrency, rateLimiter, LAMBDA_MIN_TIME_REMAINING_TRIGGER,
+                                  retryPolicy )
+    ( stopBeforeTimeout, asyncResult ) = downloader.run( journal, context )
+    threadResults.append( asyncResult )
+  elif pipelined:
+    # Segments are keyed relative to the provisional common prefix determined from the
+    # manifests. Resources found outside it are held back until parsing completes.
+    # Variant manifests which fail to load are reported in the same way as when the
+    # manifests are parsed before fetching.
+    provisionalPrefix = vodAsset.commonPrefix
+    deferredIndexes = []
+    resourceBatches = vodAsset.iterResourceBatches()
+    pipelinedIndexes = iterPipelinedIndexes( vodAsset, resourceBatches, journal, preExistingObjects, provisionalPrefix, deferredIndexes )
+    try:
+      ( stopBeforeTimeout, results ) = runFetchWorkers( pipelinedIndexes, provisionalPrefix, journal, numThreads,
+                                                        destBucket, destPath, acl, authHeaders, transferMode, rangeConcurrency, rangeThreshold,
+                                                        uploadThreads, uploadBufferBytes, spillBytes, context )
+      threadResults.extend( results )
+
+      # Finish parsing the manifests if the workers stopped before all resources were
+      # queued, so the checkpoint contains every resource of the asset. The resources
+      # added here are left pending for the next invocation.
+      for newIndexes in resourceBatches:
+        journal.resourcesAdded()
+    except Exception as e:
+      return getManifestFailureResult(e)
+    journal.vodAsset.commonPrefix = vodAsset.commonPrefix
+
+    if vodAsset.commonPrefix != provisionalPrefix:
+      # Some resources are outside the provisional prefix. Objects written so far need
+      # to move to the key they would have had with the final common prefix.
+      logger.warning( "Common prefix changed from '%s' to '%s' after parsing all manifests" %
+                      (provisionalPrefix, vodAsset.commonPrefix) )
+      downloadedResources = []
+      for result in results:
+        downloadedResources.extend( result['downloadedSegments'] )
+      relocateObjects( downloadedResources, provisionalPrefix, vodAsset.commonPrefix, destBucket, destPath, acl )
+
+      journal.reset()
+      markObjectsAtDestination( journal, listObjectsAtDestination( destWriter, destBucket, destPath ) )
+      journal.saveInterval = checkpointInterval
+      if not stopBeforeTimeout:
+        ( stopBeforeTimeout, results ) = runFetchWorkers( journal.pendingIndexes(), vodAsset.commonPrefix, journal, numThreads,
+                                                          destBucket, destPath, acl, authHeaders, transferMode, rangeConcurrency, rangeThreshold,
+                                                          uploadThreads, uploadBufferBytes, spillBytes, context )
+        threadResults.extend( results )
+
+    logger.info( "Source asset contains %d resources" % len(journal.vodAsset.allResources) )
+    journal.save()
+  else:
+    ( stopBeforeTimeout, results ) = runFetchWorkers( journal.pendingIndexes(), journal.vodAsset.commonPrefix, journal, numThreads,
+                                                      destBucket, destPath, acl, authHeaders, transferMode, rangeConcurrency, rangeThreshold,
+                                                      uploadThreads, uploadBufferBytes, spillBytes, context )
+    threadResults.extend( results )
 
-    for thread in concurrent.futures.as_completed(threads):
-      threadNumber = threads[thread]
-      logger.info("Getting result for thread %d" % threadNumber)
-      try:
-        threadResults[threadNumber] = thread.result()
-      except Exception as e:
-        logger.error('Failed to get a result for thread %d: %s' % (threadNumber, e))
-      else:
-        logger.info("Thread %s complete" % (threadNumber))
-        # pprint(threadResults[threadNumber])
+  vodAsset = journal.vodAsset
+  vodAssetType = journal.vodAssetType
 
   # Aggregate results
   aggResults = {
+    'mode'                    : mode,
     'downloadedSegments'      : [],
     'skippedSegments'         : [],
     'totalDownloadedSegments' : 0,
-    'totalSkippedSegments'    : 0
+    'totalSkippedSegments'    : 0,
+    'totalUnchangedSegments'  : 0
   }
-  for threadNumber, threadResult in threadResults.items():
+  for threadResult in threadResults:
     # aggResults['downloadedSegments'].extend(threadResult['downloadedSegments'])
     aggResults['skippedSegments'].extend(threadResult['skippedSegments'])
     aggResults['totalDownloadedSegments'] = aggResults['totalDownloadedSegments'] + threadResult['totalDownloadedSegments']
     aggResults['totalSkippedSegments'] = aggResults['totalSkippedSegments'] + threadResult['totalSkippedSegments']
+    aggResults['totalUnchangedSegments'] = aggResults['totalUnchangedSegments'] + threadResult.get('totalUnchangedSegments', 0)
   
-  # Set status on result
-  finalExistingObjects = listObjectsAtDestination( s3, destBucket, destPath )
-  aggResults['objectsAtS3Dest'] = len(finalExistingObjects)
+  # Report how the adaptive concurrency evolved over the invocation
+  if concurrencyController:
+    aggResults.update( concurrencyController.getSummary() )
+
+  # Report the number of retries for each failure reason (e.g. HTTP status code)
+  aggResults.update( retryPolicy.getSummary() )
+
+  # Report how much of the upload buffer was used when uploads are decoupled from downloads
+  for threadResult in threadResults:
+    if 'uploadBuffer' in threadResult:
+      for key, value in threadResult['uploadBuffer'].items():
+        if key == 'uploadBufferPeakBytes':
+          aggResults[key] = max( aggResults.get(key, 0), value )
+        else:
+          aggResults[key] = aggResults.get(key, 0) + value
+
+  # Report how many origin connections were opened and how many requests reused one.
+  # The connections of a batch are reported by fetchBatch.
+  if shared is None:
+    aggResults.update( httpTransport.getSummary() )
 
-  logger.info("Objects found at destination = %d" % len(finalExistingObjects))
-  logger.info("VOD All Resources = %d" % len(vodAsset.allResources))
-  if len(finalExistingObjects) == len(vodAsset.allResources):
+  # Set status on result
+  # The checkpoint tracks every resource copied to the destination so there is no
+  # need to list the destination again
+  numCompleteObjects = journal.numCompleted - numOtherShardResources
+  numResources = len(vodAsset.allResources) - numOtherShardResources
+  aggResults['objectsAtS3Dest'] = numCompleteObjects
+  aggResults['resumedFromCheckpoint'] = resumedFromCheckpoint
+  if shardCount > 1:
+    aggResults['shardIndex'] = shardIndex
+    aggResults['shardCount'] = shardCount
+    aggResults['shardResources'] = numResources
+
+  logger.info("Objects found at destination = %d" % numCompleteObjects)
+  logger.info("VOD All Resources = %d" % numResources)
+  if journal.isAllComplete():
     # Stream successfully copied
     aggResults['status'] = "COMPLETE"
   elif stopBeforeTimeout == True:
@@ -318,8 +1155,46 @@ def fetchStream(event, context):
     # Some resources may have failed to be copied an been skipped
     aggResults['status'] = "INCOMPLETE"
 
+  # Report exactly which resources (by index in the resource table) are still pending.
+  # Resources are assigned to shards by a hash, so the pending resources of a shard are
+  # scattered across the resource table and only the first few ranges are reported.
+  aggResults['totalPendingResources'] = numResources - numCompleteObjects
+  if shardCount > 1:
+    pendingRanges = journal.getPendingRanges( MAX_SHARD_PENDING_RANGES + 1 )
+    aggResults['pendingResourceRangesTruncated'] = len(pendingRanges) > MAX_SHARD_PENDING_RANGES
+    pendingRanges = pendingRanges[:MAX_SHARD_PENDING_RANGES]
+  else:
+    pendingRanges = journal.getPendingRanges()
+  aggResults['pendingResourceRanges'] = pendingRanges
+
   # Calculate the percentage of files which have been copied to destination
-  aggResults['progressPercentage'] = str(round((len(finalExistingObjects)/len(vodAsset.allResources))*100,2))
+  # (a shard of a small asset may not contain any resources)
+  if numResources:
+    aggResults['progressPercentage'] = str(round((numCompleteObjects/numResources)*100,2))
+  else:
+    aggResults['progressPercentage'] = str(100.0)
+
+  # Keep the checkpoint for the next invocation unless the download has completed
+  if mode == 'verify':
+    pass
+  elif aggResults['status'] == "COMPLETE":
+    journal.delete()
+  else:
+    journal.save()
+  if syncIndex:
+    syncIndex.save()
+
+  # Save the asset again with the size of the resources copied by this invocation, so a
+  # later download can tell if an object at the destination has been truncated. Shards
+  # only know the sizes of their own resources so do not save the asset.
+  if useAssetCache and mode != 'verify' and shardCount == 1 and vodAsset.resourceSizes.changed:
+    saveAssetCache( destWriter, destBucket, destPath, masterManifestUrl, vodAssetType, vodAsset )
+
+  # Report the latency and throughput of each phase and write them to the log in
+  # CloudWatch Embedded Metric Format
+  aggResults['performance'] = performanceMetrics.getSummary()
+  if emitMetrics:
+    performanceMetrics.emitEmf( metricsNamespace, { 'Engine': engine, 'Mode': mode }, aggResults['performance'] )
 
   returnVal = {
       'status': 200,
@@ -333,82 +1208,423 @@ def fetchStream(event, context):
 
   return returnVal
 
+def profileInvocation(event, context):
+  # Runs fetchStream with cProfile and/or tracemalloc enabled and saves the reports
+  # to 'profileOutput' (an S3 prefix or local directory). By default the reports are
+  # saved next to (not inside) the destination path so they are not counted as one
+  # of the downloaded objects.
+
+  # Imported here so the profiler is only loaded when profiling is requested
+  from Profiler import InvocationProfiler, saveProfileReports, getProfileRunId
+
+  profileMode = 'all' if event['profile'] is True else event['profile']
+  location = event.get('profileOutput')
+  if not location:
+    location = getDestWriter(event).getLocation( event.get('destination_bucket'), event.get('destination_path') + '.profile/' )
+
+  profiler = InvocationProfiler(profileMode)
+  profiler.start()
+  try:
+    result = fetchStream( dict(event, profile=None), context )
+  finally:
+    profiler.stop()
+    s3Client = getS3Writer().client if location.startswith('s3://') else None
+    location = saveProfileReports( profiler.getReports(), location, getProfileRunId(context), s3Client )
+    logger.info("Saved profile reports to %s" % location)
+
+  result['result']['profileLocation'] = location
+  return result
+
+def fetchBatch(event, context):
+  # Downloads each of the jobs in 'jobs' (or the JSONL file 'jobsFile') in turn. Used by
+  # the '-J' command line option, see BatchDownloader.py. The other options in the event apply to every job. The
+  # result of each job is written as a line of the JSONL file 'resultsFile' (a local
+  # path or s3://bucket/key) or, if no file is given, returned in the result.
+
+  # Imported here so the batch scheduler is only loaded in batch mode
+  from BatchDownloader import runBatch, loadJobs, BATCH_OPTIONS, DEFAULT_SLICE_SECONDS
+
+  jobs = event.get('jobs')
+  if jobs is None and event.get('jobsFile'):
+    jobs = loadJobs( event['jobsFile'] )
+  sliceSeconds = event.get('sliceSeconds', DEFAULT_SLICE_SECONDS)
+  if not jobs or not isinstance(sliceSeconds, (int, float)) or sliceSeconds < 0:
+    message = "Fatal: A batch needs 'jobs' or 'jobsFile' and 'sliceSeconds' must be at least 0"
+    logger.error(message)
+    return {
+      'status': 500,
+      'message': message,
+      'result': { "status": "FAILED" }
+    }
+  defaults = { key: value for key, value in event.items() if key not in BATCH_OPTIONS }
+
+  resultsFile = event.get('resultsFile')
+  jobResults = []
+  resultsOutput = None
+  if resultsFile and not resultsFile.startswith('s3://'):
+    resultsOutput = open( resultsFile, 'a' )
+  def writeResult(jobResult):
+    # Local results are written as each job finishes so they survive the process
+    # being stopped part way through the batch
+    if resultsOutput:
+      resultsOutput.write( json.dumps(jobResult, default=str) + "\n" )
+      resultsOutput.flush()
+    else:
+      jobResults.append( jobResult )
+
+  shared = {}
+  try:
+    batchResult = runBatch( jobs, defaults, fetchStream, writeResult, sliceSeconds,
+                            LAMBDA_MIN_TIME_REMAINING_TRIGGER, context, shared )
+  finally:
+    if resultsOutput:
+      resultsOutput.close()
+
+  if resultsFile and resultsFile.startswith('s3://'):
+    ( bucket, separator, key ) = resultsFile[len('s3://'):].partition('/')
+    body = "".join( json.dumps(jobResult, default=str) + "\n" for jobResult in jobResults )
+    getS3Writer().client.put_object( Bucket=bucket, Key=key, Body=body.encode('utf-8'), ContentType='application/x-ndjson' )
+  if resultsFile:
+    batchResult['resultsFile'] = resultsFile
+  else:
+    batchResult['jobs'] = jobResults
+
+  # Connections to origin are shared by all the jobs
+  if 'httpTransport' in shared:
+    batchResult.update( shared['httpTransport'].getSummary() )
+
+  return {
+    'status': 200,
+    'message': batchResult['status'],
+    'result': batchResult
+  }
+
+def getSharedResource(shared, name, create):
+  # Resources in a batch are created by the first job and used by every later job
+  if shared is None:
+    return create()
+  if name not in shared:
+    shared[name] = create()
+  return shared[name]
+
+def getS3Writer(maxPoolConnections=DEFAULT_MAX_POOL_CONNECTIONS):
+  # Returns the S3 writer shared by all workers. The writer (and its open connections)
+  # is reused by later invocations of a warm Lambda unless they need a larger pool.
+  global s3Writer
+  if s3Writer is None or s3Writer.maxPoolConnections < maxPoolConnections:
+    s3Writer = S3Writer(maxPoolConnections)
+  return s3Writer
+
+def getDestWriter(event, maxPoolConnections=DEFAULT_MAX_POOL_CONNECTIONS):
+  # Objects are written to S3 unless a local 'destination_dir' is specified
+  if event.get('destination_dir'):
+    return LocalWriter(event['destination_dir'])
+  return getS3Writer(maxPoolConnections)
+
+def getDefaultUploadBufferBytes():
+  # A quarter of the memory configured for the Lambda function, leaving the rest for
+  # the bodies being downloaded and uploaded
+  memorySize = os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE')
+  if memorySize:
+    return int(memorySize) * 1024 * 1024 // 4
+  return DEFAULT_UPLOAD_BUFFER_BYTES
+
+def getManifestFailureResult(err):
+  # Result returned when the asset manifests could not be fetched or parsed
+  if isinstance(err, IOError):
+    return {
+      'status': 500,
+      'message': "%s: Unable access manifest." % repr(err),
+      'result': { "status": "FAILED" }
+    }
+  print(repr(err))
+  return {
+    'status': 500,
+    'message': "Unhandled Exception. Check logs",
+    'result': { "status": "FAILED" }
+  }
+
 def getMasterManifestLocation(vodAsset, destBucket, destPath):
   # Determine the location of the master manifest for the asset
   masterManifest = vodAsset.masterManifest
-  s3Prefix = "s3://%s/%s/" % (destBucket, destPath)
-  s3MasterManifest = masterManifest.replace( vodAsset.commonPrefix, s3Prefix )
-  return s3MasterManifest
+  destPrefix = destWriter.getLocation( destBucket, destPath + '/' )
+  return masterManifest.replace( vodAsset.commonPrefix, destPrefix )
+
+def runFetchWorkers(indexes, baseUrl, journal, numThreads, destBucket, destPath, acl, authHeaders, transferMode, rangeConcurrency, rangeThreshold,
+                    uploadThreads, uploadBufferBytes, spillBytes, context):
+
+  # Starts the fetchSegments worker threads and queues the resources in 'indexes' for
+  # them. Returns a tuple of ( stopBeforeTimeout, list of worker thread results ).
+  #
+  # When uploadThreads is set, buffered transfers are split into a download stage
+  # (the fetchSegments workers) and an upload stage (uploadThreads uploadSegments
+  # workers) connected by a buffer holding up to uploadBufferBytes of segments in
+  # memory and spillBytes of segments in SPILL_DIR.
+
+  # Create a bounded queue. The producer resizes it to hold roughly QUEUE_LOOKAHEAD
+  # seconds of work so no more is queued than can be completed before the deadline.
+  fetchQ = queue.Queue(maxsize=numThreads)
+  queueDone = threading.Event()
+  threadResults = []
+  uploadBuffer = None
+  uploaders = {}
+  if uploadThreads:
+    uploadBuffer = ByteBudgetBuffer( uploadBufferBytes, SPILL_DIR, spillBytes )
+
+  # We can use a with statement to ensure threads are cleaned up promptly
+  with concurrent.futures.ThreadPoolExecutor(max_workers=max(MAX_NUMBER_THREAD, numThreads) + uploadThreads) as executor:
+
+    # Start the upload stage first so segments are uploaded as soon as they are fetched
+    if uploadBuffer:
+      logger.info('Starting %d upload threads with a %d byte buffer' % (uploadThreads, uploadBufferBytes))
+      uploaders = {executor.submit(uploadSegments, n, uploadBuffer, destWriter, destBucket, destPath, acl, journal): n for n in range(1, uploadThreads+1)}
+
+    # Start the load operations and mark each future with its thread number
+    logger.info('Starting %d threads' % numThreads)
+    threadNumbers = list(range(1, numThreads+1))
+    threads = {executor.submit(fetchSegments, n, baseUrl, fetchQ, queueDone, destWriter, destBucket, destPath, acl, authHeaders, transferMode, rangeConcurrency, rangeThreshold, journal, context, uploadBuffer): n for n in threadNumbers}
+
+    # 'indexes' may be a generator parsing manifests as it goes (see iterPipelinedIndexes).
+    # If it raises the workers are still stopped, and the error is raised once they have exited.
+    producerError = None
+    try:
+      ( stopBeforeTimeout, numberQueuedObjects ) = queueObjectsToFetch(journal, fetchQ, numThreads, context, indexes)
+    except Exception as e:
+      producerError = e
+      stopBeforeTimeout = False
+    finally:
+      # All media segments have been queued.  Now signal the worker threads to exit
+      # once the queue is empty, and wait for them to complete
+      queueDone.set()
+
+    # Keep saving the checkpoint while the workers copy the resources left in the queue
+    while concurrent.futures.wait( threads, timeout=QUEUE_POLL_INTERVAL ).not_done:
+      journal.saveIfDue()
+
+    for thread in concurrent.futures.as_completed(threads):
+      threadNumber = threads[thread]
+      logger.info("Getting result for thread %d" % threadNumber)
+      try:
+        threadResults.append(thread.result())
+      except Exception as e:
+        logger.error('Failed to get a result for thread %d: %s' % (threadNumber, e))
+      else:
+        logger.info("Thread %s complete" % (threadNumber))
+
+    # Once the download stage has finished nothing more is added to the buffer. The
+    # upload threads exit when every segment in the buffer has been written.
+    if uploadBuffer:
+      uploadBuffer.close()
+      for uploader in concurrent.futures.as_completed(uploaders):
+        try:
+          threadResults.append(uploader.result())
+        except Exception as e:
+          logger.error('Failed to get a result for upload thread %d: %s' % (uploaders[uploader], e))
+      threadResults.append({ "downloadedSegments": [], "totalDownloadedSegments": 0,
+                             "skippedSegments": [], "totalSkippedSegments": 0,
+                             "uploadBuffer": uploadBuffer.getSummary() })
+
+  if producerError:
+    raise producerError
+
+  # Workers stop taking work at the deadline, anything left in the queue is still pending.
+  # Transfers abandoned at the deadline (e.g. ranged copies of large files) are also
+  # still pending.
+  if not fetchQ.empty() or isDeadlineReached(context):
+    stopBeforeTimeout = True
+
+  return (stopBeforeTimeout, threadResults)
+
+def iterPipelinedIndexes(vodAsset, resourceBatches, journal, preExistingObjects, provisionalPrefix, deferredIndexes):
+
+  # Generator growing the journal as the resources of the asset are parsed and yielding
+  # the index of each resource which needs to be fetched. 'resourceBatches' is the
+  # iterator returned by vodAsset.iterResourceBatches().
+  #
+  # Destination keys depend on the common prefix of all resources, which is only known
+  # once every manifest has been parsed. Resources are yielded while they are below the
+  # provisional prefix. Once a resource outside the provisional prefix is found the
+  # common prefix will change, so this and all later resources are deferred instead.
+
+  # The journal shares the resource table of the asset
+  for newIndexes in resourceBatches:
+    journal.resourcesAdded()
+    for index in newIndexes:
+      object = vodAsset.allResources[index]
+      if deferredIndexes or not object.startswith(provisionalPrefix):
+        deferredIndexes.append(index)
+      elif not objectNeedsFetch( preExistingObjects, getObjectKey(object, provisionalPrefix), vodAsset.resourceSizes, index ):
+        journal.markComplete(index)
+      else:
+        yield index
 
-def queueObjectsToFetch(preExistingObjects, allResources, commonPrefix, fetchQ, rpsLimit, context):
+def prepareAsset(destBucket, destPath, masterManifestUrl, authHeaders, manifestConcurrency, mode):
+  # Parses the asset and saves it to the asset cache for the shards of the asset to
+  # read. An asset cache which is still valid is kept, except in sync mode where the
+  # manifests are always parsed to find resources added to a variant.
 
-  # Adds objects to be downloaded to the queue at a throttled rate to ensure
-  # origin is not overloaded.
-  # Function receives a list of objects to be stored on S3 and will skip any
-  # objects which already exists. Objects are identified as already existing
-  # if they are in the 'preExistingObjects' list
+  if mode != 'sync':
+    cachedAsset = loadAssetCache( destWriter, destBucket, destPath, masterManifestUrl, httpTransport, authHeaders )
+    if cachedAsset:
+      return getPreparedResult( cachedAsset[0] )
+
+  try:
+    ( vodAsset, vodAssetType ) = parseVodAssetManifests( masterManifestUrl, authHeaders, manifestConcurrency, False, httpTransport )
+  except Exception as e:
+    return getManifestFailureResult(e)
+  if vodAssetType == "UnsupportedFormat":
+    return {
+      'status': 500,
+      'message': "Manifest is of an unsupported format",
+      'result': { "status": "FAILED" }
+    }
+
+  saveAssetCache( destWriter, destBucket, destPath, masterManifestUrl, vodAssetType, vodAsset )
+  return getPreparedResult( vodAsset )
+
+def getPreparedResult(vodAsset):
+  return {
+    'status': 200,
+    'message': "PREPARED",
+    'result': { "status": "PREPARED", "totalResources": len(vodAsset.allResources) }
+  }
+
+def markResourcesInOtherShards(journal, shardCount, shardIndex):
+  # Resources are assigned to shards by a hash of the object key, so every invocation
+  # assigns each resource to the same shard. Marks the resources belonging to other
+  # shards as complete in the journal and returns the number of them.
+  vodAsset = journal.vodAsset
+  numOtherShardResources = 0
+  for index, object in enumerate(vodAsset.allResources):
+    if getShardIndex( getObjectKey(object, vodAsset.commonPrefix), shardCount ) != shardIndex:
+      journal.markComplete(index)
+      numOtherShardResources += 1
+  return numOtherShardResources
+
+def getShardIndex( objectKey, shardCount ):
+  # crc32 is stable across processes (unlike hash() of a str)
+  return zlib.crc32( objectKey.encode('utf-8') ) % shardCount
+
+def markObjectsAtDestination(journal, preExistingObjects):
+  # Marks the resources already copied to the destination as complete in the journal
+  vodAsset = journal.vodAsset
+  for index, object in enumerate(vodAsset.allResources):
+    if not objectNeedsFetch( preExistingObjects, getObjectKey(object, vodAsset.commonPrefix), vodAsset.resourceSizes, index ):
+      journal.markComplete(index)
+
+def relocateObjects(resources, fromPrefix, toPrefix, destBucket, destPath, acl):
+  # Moves objects written relative to 'fromPrefix' to the key they have relative to
+  # 'toPrefix'. The objects are moved at the destination so they are not fetched from
+  # origin again.
+  for resource in resources:
+    oldKey = destPath + '/' + getObjectKey(resource, fromPrefix)
+    newKey = destPath + '/' + getObjectKey(resource, toPrefix)
+    logger.info("Moving %s to %s" % (destWriter.getLocation(destBucket, oldKey), destWriter.getLocation(destBucket, newKey)))
+    try:
+      destWriter.moveObject( destBucket, oldKey, newKey, acl )
+    except Exception as s3Err:
+      print('Fatal:  error writing to S3')
+      print('Bucket: ', destBucket, ' Object:', newKey, ' ACL:', acl)
+      print(s3Err)
+      os._exit(3)
+
+def queueObjectsToFetch(journal, fetchQ, numThreads, context, indexes):
+
+  # Adds objects to be downloaded to the queue. The request rate to origin is
+  # enforced by the shared rateLimiter consulted by the workers.
+  # Only the resources in 'indexes' are queued, normally the resources which the
+  # journal does not record as complete.
+  # Objects are queued by their index in the journal resource table.
+  #
+  # The queue is bounded. While the queue is full the producer waits, periodically
+  # checking the LAMBDA_MIN_TIME_REMAINING_TRIGGER, and resizes the queue to hold
+  # QUEUE_LOOKAHEAD seconds of work at the throughput measured so far.
 
   stopBeforeTimeout = False
   numQueuedObject = 0
-  for object in allResources:
-    
-    # Strip commonPrefix from URL to compare with S3 Key
-    objectKey = object.replace(commonPrefix, "")
-
-    if context:
-      if context.get_remaining_time_in_millis() < LAMBDA_MIN_TIME_REMAINING_TRIGGER:
+  sampleTime = time.time()
+  sampleCompleted = journal.numCompleted
+  for index in indexes:
+
+    logger.debug("Adding resource to queue: %s" % journal.vodAsset.allResources[index])
+    queued = False
+    while not queued:
+      if isDeadlineReached(context):
         stopBeforeTimeout = True
         break
-    
-    # Add object to fetch queue
-    if objectKey not in preExistingObjects:
-
-      # TODO: Add logic here to prevent too many objects being added to the queue rapidly
-      # to the point where they will not be processed before the lambda timeout
-      # Suggest setting a max queue size (say 20). If the queue is larger then the max
-      # size the process should sleep. While in this loop periodic checks will be required
-      # to take not of the LAMBDA_MIN_TIME_REMAINING_TRIGGER and break the loop if required
-      # to prevent a timeout
-      # fetchQ.qsize()
-
-      logger.debug("Adding resource to queue: %s" % objectKey)
-      fetchQ.put(object)
-      numQueuedObject += 1
-
-      if rpsLimit > 0:
-        time.sleep(1/float(rpsLimit))
-
-    # else:
-    #   logger.debug("Not added to queue: %s" % objectKey)
-  
+
+      try:
+        fetchQ.put(index, timeout=QUEUE_POLL_INTERVAL)
+        queued = True
+      except queue.Full:
+        pass
+
+      journal.saveIfDue()
+
+      # Resize the queue based on the measured throughput
+      now = time.time()
+      if now - sampleTime >= 1:
+        throughput = (journal.numCompleted - sampleCompleted) / (now - sampleTime)
+        fetchQ.maxsize = min( MAX_QUEUE_SIZE, max( numThreads, int(throughput * QUEUE_LOOKAHEAD) ) )
+        sampleTime = now
+        sampleCompleted = journal.numCompleted
+
+    if stopBeforeTimeout:
+      break
+    numQueuedObject += 1
+
+    # Next invocation continues from the first resource which has not been queued
+    journal.cursor = index + 1
+
   return (stopBeforeTimeout, numQueuedObject)
 
+def isDeadlineReached(context):
+  # True when the Lambda function is close enough to its timeout that no new work
+  # should be started. Always False when run from the command line.
+  if context:
+    return context.get_remaining_time_in_millis() < LAMBDA_MIN_TIME_REMAINING_TRIGGER
+  return False
+
+def getSecondsToDeadline(context):
+  # Seconds until isDeadlineReached becomes True, None when there is no deadline
+  # (e.g. when run from the command line)
+  if context:
+    remainingMs = context.get_remaining_time_in_millis()
+    if remainingMs != float('inf'):
+      return max( 0, (remainingMs - LAMBDA_MIN_TIME_REMAINING_TRIGGER) / 1000.0 )
+  return None
 
-def parseVodAssetManifests( assetUrl, authHeaders ):
+
+def parseVodAssetManifests( assetUrl, authHeaders, manifestConcurrency=DEFAULT_MANIFEST_CONCURRENCY, deferParse=False, http=None ):
   # Process the passed in manifest file and return a vodAsset object
   # with all the data necessary to download all the parts of the stream
   # Returns a data structure containing the parse information and
   # the type of asset
+  # With deferParse only the top level manifest is parsed. The resources of the asset
+  # are then obtained from the 'iterResourceBatches' generator of the vodAsset.
 
   parsedUrl = urlparse(assetUrl)
   vodAsset                  = None
   if parsedUrl.path.endswith('.m3u8') or "format=m3u8-aapl" in parsedUrl.path:
     vodAssetType = 'hls'
-    vodAsset = HlsVodAsset(assetUrl, authHeaders)
+    vodAsset = HlsVodAsset(assetUrl, authHeaders, manifestConcurrency, deferParse, http)
 
   elif parsedUrl.path.endswith('.mpd') or "format=mpd-time-csf" in parsedUrl.path:
     vodAssetType = 'dash'
-    vodAsset = DashVodAsset(assetUrl, authHeaders)
+    vodAsset = DashVodAsset(assetUrl, authHeaders, deferParse, http)
 
   else:
     vodAssetType = 'UnsupportedFormat'
 
   return ( vodAsset, vodAssetType )
 
-def listObjectsAtDestination( s3Resource, destBucket, destPath ):
-  # Populates a list of all objects in destination path.  This is used to know
+def listObjectsAtDestination( writer, destBucket, destPath ):
+  # Builds an index of all objects in destination path.  This is used to know
   # which assets we can skip in the event of a restart or when using the 
-  # 'continue' feature when hosted by Lambda
+  # 'continue' feature when hosted by Lambda.
+  # The index is a dict mapping each object name (relative to destPath) to a
+  # tuple of ( size, ETag, LastModified ) so lookups are O(1) and truncated objects
+  # can be detected.
 
   # Need to add a '/' to the end of destPath to ensure objects being counted are all under the
   # same directly. Without this the method could count objected from another packaging
@@ -416,18 +1632,36 @@ def listObjectsAtDestination( s3Resource, destBucket, destPath ):
   # dash_compact_time_iframeonly )
   destPath = destPath + '/'
 
-  existingObjects = []
+  existingObjects = {}
 
-  logger.info("Checking for object with prefix: s3://%s/%s" % (destBucket, destPath))
+  logger.info("Checking for object with prefix: %s" % writer.getLocation(destBucket, destPath))
 
-  for obj in s3Resource.Bucket(destBucket).objects.filter(Prefix=destPath):
-    name = obj.key[len(destPath):]
-    existingObjects.append(name)
+  with timeMetric('destinationListing'):
+    for ( key, size, eTag, lastModified ) in writer.listObjects( destBucket, destPath ):
+      existingObjects[key[len(destPath):]] = ( size, eTag, lastModified )
 
   logger.info("Found %d objects exist with '%s' prefix" % ( len(existingObjects), destPath) )
 
   return existingObjects
 
+def getObjectKey( url, commonPrefix ):
+  # Returns the name of the object at the destination for a resource URL.
+  # This matches the names returned by listObjectsAtDestination.
+  return url.split('?')[0].replace(commonPrefix, "")
+
+def objectNeedsFetch( existingObjects, objectKey, resourceSizes=None, index=None ):
+  # An object needs to be fetched if it is not in the destination index or its size or
+  # ETag does not match the object recorded when resource 'index' was copied (see
+  # ResourceSizes), e.g. a truncated object left behind by an earlier run.
+  existingObject = existingObjects.get(objectKey)
+  if existingObject is None:
+    return True
+  ( size, eTag, lastModified ) = existingObject
+  if resourceSizes is not None and not resourceSizes.matches( index, size, eTag ):
+    logger.info("'%s' at destination (%d bytes, ETag %s) does not match the object copied" % (objectKey, size, eTag))
+    return True
+  return False
+
 def parseAuthHeaders( input ):
   logger.info("Parsing Auth Headers:")
   pprint(input)
@@ -453,8 +1687,11 @@ def parseAuthHeaders( input ):
 
 def validateInputs(event, context):
 
-  # Check URL, bucket and Asset ID are specified (and not blank)
-  mandatoryParams = ['source_url', 'destination_bucket', 'destination_path']
+  # Check URL, bucket and Asset ID are specified (and not blank). A local
+  # 'destination_dir' can be specified instead of a bucket.
+  mandatoryParams = ['source_url', 'destination_path']
+  if not event.get('destination_dir'):
+    mandatoryParams.append('destination_bucket')
   for param in mandatoryParams:
     if (param not in event.keys()) or (event[param] is None) or (event[param] == ''):
       message = "Fatal: Parameter '%s' must be specified" % param
@@ -464,16 +1701,55 @@ def validateInputs(event, context):
         'message': message
       }
 
-  # Check S3 Bucket exists
-  client = boto3.client('s3')
-  destBucket = event['destination_bucket']
+  # Check S3 Bucket exists (or the local directory can be written to)
+  destBucket = event.get('destination_bucket')
   try:
-    response = client.list_objects_v2(
-      Bucket=destBucket,
-      MaxKeys=1
-    )
+    getDestWriter(event).checkDestination(destBucket)
   except Exception as s3Err:
     message = "Fatal: Unable to verify '%s' bucket exists" % destBucket
+    if event.get('destination_dir'):
+      message = "Fatal: Unable to write to '%s' directory: %s" % (event['destination_dir'], s3Err)
+    logger.error(message)
+    return {
+      'status': 500,
+      'message': message
+    }
+
+  # Check the mode is supported
+  if event.get('mode', 'copy') not in ( 'copy', 'sync', 'verify' ):
+    message = "Fatal: Unsupported mode '%s'. Mode must be 'copy', 'sync' or 'verify'" % event['mode']
+    logger.error(message)
+    return {
+      'status': 500,
+      'message': message
+    }
+
+  # Check the shard is one of the shards the asset is split into
+  shardCount = event.get('shardCount', 1)
+  shardIndex = event.get('shardIndex', 0)
+  if not isinstance(shardCount, int) or not isinstance(shardIndex, int) or shardCount < 1 or not 0 <= shardIndex < shardCount:
+    message = "Fatal: Invalid shard %s of %s. 'shardIndex' must be at least 0 and less than 'shardCount'" % (shardIndex, shardCount)
+    logger.error(message)
+    return {
+      'status': 500,
+      'message': message
+    }
+
+  # Check the upload stage settings
+  for param in ( 'uploadThreads', 'uploadBufferBytes', 'spillBytes' ):
+    value = event.get(param, 0)
+    if not isinstance(value, int) or value < 0:
+      message = "Fatal: Invalid %s '%s'. '%s' must be a whole number of at least 0" % (param, value, param)
+      logger.error(message)
+      return {
+        'status': 500,
+        'message': message
+      }
+
+  # Check the profile mode is supported
+  profileMode = event.get('profile')
+  if profileMode and profileMode is not True and profileMode not in ( 'cpu', 'memory', 'all' ):
+    message = "Fatal: Unsupported profile '%s'. Profile must be 'cpu', 'memory' or 'all'" % profileMode
     logger.error(message)
     return {
       'status': 500,
@@ -490,7 +1766,11 @@ def parseCmdLine():
   # Command-line options (order unimportant)
 
   # -o <origin-url> [Required]
-  # -d <destination-bucket> [Required]
+  # -b <destination-bucket> [Required unless -D is given]
+  # -D <destination-directory>
+  # -d <destination-path> [Required]
+  # -J <jobs-file> (batch mode, -i and -d are then given by each job)
+  # -R <results-file>
   # -a <asset-ID> [Required]
   # -t <thread-count>
   # -r <rps-max>
@@ -503,10 +1783,15 @@ def parseCmdLine():
   
   # List of tuples:  (option, dispname, type, action, helptext, required)
   
-  argdefs.append(('-i', 'URL', str, 'store', 'URL for HLS endpoint on origin server', True))
-  argdefs.append(('-b', 'bucket', str, 'store', 'Destination S3 bucket name', True))
-  argdefs.append(('-d', 'path', str, 'store', 'Destination path', True))
+  argdefs.append(('-i', 'URL', str, 'store', 'URL for HLS endpoint on origin server', False))
+  argdefs.append(('-b', 'bucket', str, 'store', 'Destination S3 bucket name', False))
+  argdefs.append(('-D', 'directory', str, 'store', 'Local destination directory, used instead of an S3 bucket', False))
+  argdefs.append(('-d', 'path', str, 'store', 'Destination path', False))
   argdefs.append(('-p', 'packaging-config', str, 'store', 'Packaging Configuration name', False))
+  argdefs.append(('-P', 'profile', str, 'store', "Profile the download: 'cpu', 'memory' or 'all'", False))
+  argdefs.append(('-O', 'profile-output', str, 'store', 'S3 prefix (s3://bucket/prefix/) or local directory for profile reports', False))
+  argdefs.append(('-J', 'jobs-file', str, 'store', 'JSONL file of jobs to download as a batch, one event per line', False))
+  argdefs.append(('-R', 'results-file', str, 'store', 'JSONL file the result of each job in the batch is written to', False))
   # argdefs.append(('-r', None, None, 'store_true', 'Removes ad content, leaving markers intact', False))
   
   for arg in argdefs:
@@ -519,11 +1804,30 @@ def parseCmdLine():
   
   event = {}
   
-  event['source_url']         = args.i
-  event['destination_bucket'] = args.b
-  event['destination_path']   = args.d
+  if args.J:
+    # Each job gives its source and destination, any given here are used as defaults
+    event['jobsFile']           = args.J
+    if args.R:
+      event['resultsFile']      = args.R
+    for ( key, value ) in ( ('source_url', args.i), ('destination_bucket', args.b), ('destination_path', args.d) ):
+      if value:
+        event[key]              = value
+  else:
+    if not args.i or not args.d:
+      parser.error('-i and -d are required unless -J is given')
+    if not args.b and not args.D:
+      parser.error('one of -b or -D is required')
+    event['source_url']         = args.i
+    event['destination_bucket'] = args.b
+    event['destination_path']   = args.d
+  if args.D:
+    event['destination_dir']    = args.D
   event['numThreads']         = 5
   event['rpsLimit']           = 1000
+  if args.P:
+    event['profile']          = args.P
+  if args.O:
+    event['profileOutput']    = args.O
 
   return event
 
@@ -534,7 +1838,10 @@ if __name__ == '__main__':  # Lambda __name__ isn't '__main__'
   event = parseCmdLine()
 
   context = None
-  result = fetchStream(event, context)
+  if 'jobsFile' in event:
+    result = fetchBatch(event, context)
+  else:
+    result = fetchStream(event, context)
   pprint(result)
   if result['status'] != 200:
     logger.info(result['message'])
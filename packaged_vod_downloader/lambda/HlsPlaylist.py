@@ -0,0 +1,106 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# HlsPlaylist.py
+# Building blocks of the HLS playlist parsers in HlsVodAsset.py:
+# - parseAttributeList splits the attribute list of a tag (e.g. the part of
+#   '#EXT-X-MEDIA:TYPE=AUDIO,NAME="English, UK",URI="audio.m3u8"' after the ':') in a
+#   single pass. Each character is looked at once, so the time taken is linear in the
+#   length of the list even when quoted values contain commas.
+# - UriResolver turns the URIs in a playlist into absolute URLs. The playlist URL is
+#   parsed once, and the '..' and '.' components of each directory are resolved once
+#   rather than for every segment in it.
+
+import os
+from urllib.parse import urlparse
+
+# URIs containing any of these characters are resolved by normalizeUrl, as urlparse
+# treats them specially
+SPECIAL_URI_CHARACTERS = ( '?', '#', ';', '\t' )
+
+# Returns a dict of the attributes in an attribute list. Quotes around values are removed.
+def parseAttributeList( text ):
+
+  attributes = {}
+  length = len(text)
+  position = 0
+  while position < length:
+    equals = text.find( '=', position )
+    if equals < 0:
+      break
+    end = equals + 1
+    if end < length and text[end] == '"':
+      # Commas inside a quoted value do not separate attributes
+      closingQuote = text.find( '"', end + 1 )
+      end = text.find( ',', closingQuote + 1 ) if closingQuote >= 0 else -1
+    else:
+      end = text.find( ',', end )
+    if end < 0:
+      end = length
+    attributes[ text[position:equals] ] = text[equals+1:end].strip('"')
+
+    # Whitespace after a comma is not part of the next attribute name
+    position = end + 1
+    while position < length and text[position].isspace():
+      position += 1
+
+  return attributes
+
+
+# Normalises url and removes additional '..' notations
+def normalizeUrl( url ):
+
+  o = urlparse(url)
+  absPath = os.path.normpath( o.path )
+  absUrl = "%s://%s%s" % (o.scheme, o.netloc, absPath)
+
+  return absUrl
+
+
+class UriResolver:
+  # Resolves the URIs in the playlist at 'playlistUrl'. URIs starting with 'http' are
+  # used as they are, other URIs are relative to the directory of the playlist. The
+  # result is the same as normalizeUrl("<playlist directory>/<uri>").
+  def __init__(self, playlistUrl):
+    self.baseUrl = os.path.dirname(playlistUrl)
+    parsedBase = urlparse(self.baseUrl)
+    self.origin = "%s://%s" % (parsedBase.scheme, parsedBase.netloc)
+    self.basePath = parsedBase.path
+    # Relative URIs can be appended to the path of the playlist directory unless the
+    # directory has a query or similar (or is not a URL with a host)
+    self.simpleBase = bool(parsedBase.netloc) and not any( character in self.baseUrl for character in SPECIAL_URI_CHARACTERS )
+    # Normalised directory paths (ending with '/') by directory
+    self.directories = {}
+
+  def resolve( self, uri ):
+
+    if uri.startswith("http"):
+      return uri
+    if not self.simpleBase or any( character in uri for character in SPECIAL_URI_CHARACTERS ):
+      return normalizeUrl( "%s/%s" % (self.baseUrl, uri) )
+
+    path = self.basePath + '/' + uri
+    ( directory, separator, fileName ) = path.rpartition('/')
+    if fileName in ( '', '.', '..' ):
+      return self.origin + os.path.normpath(path)
+
+    normalizedDirectory = self.directories.get(directory)
+    if normalizedDirectory is None:
+      # Normalising the directory with a placeholder file name keeps the '/' between
+      # the directory and the file name (and the leading '//' kept by normpath)
+      normalizedDirectory = os.path.normpath( directory + '/x' )[:-1]
+      self.directories[directory] = normalizedDirectory
+    return self.origin + normalizedDirectory + fileName
@@ -15,85 +15,142 @@
 # SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
 
 import os
-import urllib3
+import time
+import concurrent.futures
 from pprint import pprint
-from urllib.parse import urlparse
 import re
+from ResourceTable import ResourceTable, ResourceSizes
+from PerformanceMetrics import recordMetric, timeMetric
+from HttpTransport import HttpTransport, MANIFEST_RETRIES
+from HlsPlaylist import parseAttributeList, UriResolver
 
-http = urllib3.PoolManager()
+# Number of variant manifests fetched from origin at the same time
+DEFAULT_MANIFEST_CONCURRENCY = 10
 
 class HlsVodAsset:
-  def __init__(self, masterManifest, authHeaders=None):
+  def __init__(self, masterManifest, authHeaders=None, manifestConcurrency=DEFAULT_MANIFEST_CONCURRENCY, deferParse=False, http=None):
     self.masterManifest = masterManifest
     self.masterManifestContentType = None
+    # ETag and Last-Modified of the master manifest, used to validate cached copies of the asset
+    self.masterManifestValidators = {}
     self.variantManifests   = None
     self.variantManifestsData = {}
-    self.mediaSegmentList  = []
     self.commonPrefix = None
-    self.allResources = None
+    self.allResources = ResourceTable()
+    # Size in bytes of each resource where it is known (see ResourceSizes).
+    # Used to detect truncated objects at the destination.
+    self.resourceSizes = ResourceSizes()
+    # Resources referenced with EXT-X-BYTERANGE (e.g. single file packaging) and the
+    # end of the last byte range referenced in each. These are large files which are
+    # fetched using parallel ranged requests.
+    self.rangedResources = {}
     self.authHeaders = authHeaders
-
-    self.parseHlsVodAsset()
+    self.manifestConcurrency = max(1, manifestConcurrency)
+    # HTTP transport for manifest requests, normally shared with the segment downloads
+    self.http = http if http else HttpTransport( maxConnectionsPerHost=self.manifestConcurrency )
+
+    # With deferParse only the master manifest is parsed by the constructor. The caller
+    # then consumes 'iterResourceBatches' to receive the resources of each variant as
+    # soon as it has been parsed.
+    if deferParse:
+      self.parseMaster()
+    else:
+      self.parseHlsVodAsset()
 
 # Function will parse variant manifest and extract a list of all media and init segments
-# media and init segments will store absolute URLs for segments in mediaSegmentList
+# media and init segments are added to the allResources resource table
   def parseHlsVodAsset( self ):
 
-    # Retrieve Master Manifest
-    (masterManifestBody, self.masterManifestContentType) = getManifest( self.masterManifest, self.authHeaders )
-    #TODO: If manifest is None, raise error
-
-    # Parse Master Manifest
-    self.variantManifests = parseMasterManifest( self.masterManifest, masterManifestBody )
-
-    # For each variant manifest
-    for variant in self.variantManifests:
-
-      # Retrieve Variant Manifest
-      (variantManifestBody, variantContentType) = getManifest( variant, self.authHeaders )
-      self.variantManifestsData[variant] = {
-        "body": variantManifestBody,
-        "contentType": variantContentType
-      }
-
-      # Parse Variant Manifest
-      segments = parseVariantManifest( variant, variantManifestBody )
-      self.mediaSegmentList.extend(segments)
-
-    # Determine commonPrefix across all resource
-    allResources = [ self.masterManifest ]
-    allResources.extend(self.variantManifests)
-    allResources.extend(self.mediaSegmentList)
-
-    # Duplicates need to be removed from the list of all segments.
-    # This may not strictly be necessary for HLS/CMAF streams but cannot hurt.
-    allResourcesSet = set(allResources)
-    uniqueResources = list(allResourcesSet)
-
-    self.allResources = uniqueResources
-
-    # Set common prefix
-    # The common prefix must end with '/' to indicate this is a path and does not include
-    # the start of the name of the files. For example, if all the resources of an asset start
-    # with 'asset1' and the content is stored in 'my/asset/path' the common prefix should be
-    # 'my/asset/path/' not 'my/asset/path/asset1'
-    commonPrefix = os.path.commonprefix( uniqueResources )
-    if not commonPrefix.endswith('/'):
-      # Strip off anything to the right of the last '/' because this component represents
-      # the common string at the start of the filenames
-      unwantedPathSuffix = os.path.basename(commonPrefix)
-      pathSuffix = re.compile( unwantedPathSuffix + '$' )
-      commonPrefix = pathSuffix.sub('', commonPrefix)
-    self.commonPrefix = commonPrefix
+    self.parseMaster()
+    for newIndexes in self.iterResourceBatches():
+      pass
 
     return
 
+  def parseMaster( self ):
+
+    # Retrieve Master Manifest
+    (masterManifestBody, self.masterManifestContentType) = getManifest( self.http, self.masterManifest, self.authHeaders, self.masterManifestValidators )
+    #TODO: If manifest is None, raise error
 
-def getManifest( url, authHeaders ):
+    # Parse Master Manifest
+    with timeMetric('manifestParse'):
+      self.variantManifests = parseMasterManifest( self.masterManifest, masterManifestBody )
+
+    # Provisional common prefix based on the manifests only. Segments are normally found
+    # below this prefix, in which case it is the same as the final common prefix.
+    self.commonPrefix = getCommonPrefix( [ self.masterManifest ] + self.variantManifests )
+
+  # Generator adding resources to allResources: first the master and variant manifests,
+  # then the segments of each variant in master manifest order as each variant is parsed.
+  # Yields the range of indexes of the resources added by each step. Duplicates are not
+  # added. Once all variants have been parsed the final commonPrefix is set.
+  def iterResourceBatches( self ):
+
+    firstIndex = len(self.allResources)
+    self.allResources.extend( [ self.masterManifest ] + self.variantManifests )
+    yield range( firstIndex, len(self.allResources) )
+
+    # Retrieve Variant Manifests
+    # Variant manifests (including audio, subtitle and I-frame playlists) are independent
+    # of each other so are fetched concurrently. Origin latency can be high so fetching
+    # them one after another would delay the start of the download considerably.
+    # Results are returned in the order of the master manifest.
+    numWorkers = min( self.manifestConcurrency, max(1, len(self.variantManifests)) )
+    with concurrent.futures.ThreadPoolExecutor(max_workers=numWorkers) as executor:
+      variantResponses = executor.map( lambda variant: getManifest( self.http, variant, self.authHeaders ),
+                                       self.variantManifests )
+
+      # For each variant manifest
+      for variant, (variantManifestBody, variantContentType) in zip(self.variantManifests, variantResponses):
+
+        self.variantManifestsData[variant] = {
+          "body": variantManifestBody,
+          "contentType": variantContentType
+        }
+
+        # Parse Variant Manifest
+        with timeMetric('manifestParse'):
+          (segments, byteRangeEnds) = parseVariantManifest( variant, variantManifestBody )
+        firstIndex = len(self.allResources)
+        self.allResources.extend(segments)
+        # A file accessed using byte ranges is at least as large as the end of the last
+        # byte range referenced in it
+        for resource, byteRangeEnd in byteRangeEnds.items():
+          self.rangedResources[resource] = max( byteRangeEnd, self.rangedResources.get(resource, 0) )
+          self.resourceSizes.setMinimum( self.allResources.indexes[resource], byteRangeEnd )
+        yield range( firstIndex, len(self.allResources) )
+
+    # Duplicates are not needed to be detected any more
+    self.allResources.compact()
+
+    # Determine commonPrefix across all resources. The directory prefixes interned by
+    # the resource table give the same result as considering every resource.
+    self.commonPrefix = getCommonPrefix( self.allResources.prefixes )
+
+
+# The common prefix must end with '/' to indicate this is a path and does not include
+# the start of the name of the files. For example, if all the resources of an asset start
+# with 'asset1' and the content is stored in 'my/asset/path' the common prefix should be
+# 'my/asset/path/' not 'my/asset/path/asset1'
+def getCommonPrefix( resources ):
+
+  commonPrefix = os.path.commonprefix( resources )
+  if not commonPrefix.endswith('/'):
+    # Strip off anything to the right of the last '/' because this component represents
+    # the common string at the start of the filenames
+    unwantedPathSuffix = os.path.basename(commonPrefix)
+    pathSuffix = re.compile( unwantedPathSuffix + '$' )
+    commonPrefix = pathSuffix.sub('', commonPrefix)
+  return commonPrefix
+
+
+def getManifest( http, url, authHeaders, validators=None ):
 
   contentType = None
+  requestStart = time.time()
   try:
-    response = http.request( "GET", url, headers=authHeaders )
+    response = http.request( "GET", url, headers=authHeaders, retries=MANIFEST_RETRIES )
   except IOError as urlErr:
     print("Exception occurred while attempting to get: %s" % url )
     print(repr(urlErr))
@@ -105,7 +162,13 @@ def getManifest( url, authHeaders ):
     print('http error', response.status, 'fetching', url)
   else:
     urlPayload = response.data
+    recordMetric( 'manifestFetch', time.time() - requestStart, len(urlPayload) )
     contentType = response.headers['Content-Type']
+    # Record the cache validators of the manifest if requested
+    if validators is not None:
+      for header in ( 'ETag', 'Last-Modified' ):
+        if header in response.headers:
+          validators[header] = response.headers[header]
     # Some packagers set the manifest type incorrectly.
     # This needs to be corrected if the content type is 'binary/octet-stream'
     if contentType == 'binary/octet-stream':
@@ -130,97 +193,109 @@ def getManifest( url, authHeaders ):
   return ( urlPayload, contentType )
 
 
+# Tags of the master manifest with a URI attribute referring to a playlist
+MASTER_URI_TAGS = ( '#EXT-X-MEDIA', '#EXT-X-I-FRAME-STREAM-INF' )
+# Tags of a variant manifest with a URI attribute referring to a resource
+VARIANT_URI_TAGS = ( '#EXT-X-MAP', '#EXT-X-I-FRAME-STREAM-INF' )
+
 # Function will parse master manifest and extract a list of all the variant manifests
 # Variant manifest URLs will be stored in list in 'variantManifest'
 def parseMasterManifest( masterManifestUrl, masterManifestBody ):
 
+  resolver = UriResolver( masterManifestUrl )
   variantsDict = {}
   for line in masterManifestBody.splitlines():
-    name = None
 
-    # Parse line starting with EXT-X-MEDIA
+    # Skip blank lines
+    if not line:
+      continue
+
+    # Parse the URI of EXT-X-MEDIA (and EXT-X-I-FRAME-STREAM-INF) tags
     # e.g. EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio_0",CHANNELS="2",NAME="und",LANGUAGE="und",DEFAULT=YES, \
     #      AUTOSELECT=YES,URI="bf4fc289ea7a4a9a8030bfdfb6dd8180/75449fe7ed1a492880193067011
-    if line.startswith('#EXT-X-MEDIA:') or line.startswith('#EXT-X-I-FRAME-STREAM-INF:'):
-      line = line.split(':', 1)[1]
-      mediaDict = {}
-
-      # Add EXT-X-MEDIA properties to data set 
-      for keyVal in re.split(r',\s*(?=(?:[^"]*"[^"]*")*[^"]*$)', line):
-        (key, val) = keyVal.split('=', 1)
-        mediaDict[key] = val.strip('"')
-      name = mediaDict['URI']
-
-    elif line == "":
-      # Skip blank lines
-      next
-
-    # Parse lines which do not start with a comment
+    # Tags without a URI (e.g. closed captions carried in the video) are skipped
+    if line[0] == '#':
+      ( tag, separator, attributeList ) = line.partition(':')
+      if not separator or tag not in MASTER_URI_TAGS:
+        continue
+      name = parseAttributeList(attributeList).get('URI')
+      if not name:
+        continue
+
+    # Lines which do not start with a comment are variant playlists
     # e.g. ../../../bf4fc289ea7a4a9a8030bfdfb6dd8180/75449fe7ed1a49288019306701174382/index_1_0.ts
-    elif line[0] != '#':
+    else:
       name = line
 
     # Add key to dict if it has not been seen before
-    absoluteUrl = name
-    if name and name.startswith("http"):
-      absoluteUrl = name
-    elif name:
-      absoluteUrl = normalizeUrl("%s/%s" % (os.path.dirname(masterManifestUrl), name))
-
-    if not (absoluteUrl is None or absoluteUrl in variantsDict.keys()):
+    absoluteUrl = resolver.resolve(name)
+    if absoluteUrl not in variantsDict:
       variantsDict[absoluteUrl] = 1
-    
+
   variants = list(variantsDict.keys())
 
   return variants
 
 
-
-# Normalises url and removes additional '..' notations
-def normalizeUrl( url ):
-
-  o = urlparse(url)
-  absPath = os.path.normpath( o.path )
-  absUrl = "%s://%s%s" % (o.scheme, o.netloc, absPath)
-
-  return absUrl
-
-
 # Function will parse variant manifest and extract a list of all media and init segments
 # media and init segments will store absolute URLs for segments in mediaSegmentList
+# Segments which are byte ranges of the same file (EXT-X-BYTERANGE) are collapsed into a
+# single resource. Returns the list of segments and a dict of the end of the last byte
+# range referenced in each file which is accessed using byte ranges.
 def parseVariantManifest( variantManifestUrl, variantManifestBody ):
 
+  resolver = UriResolver( variantManifestUrl )
   segmentsDict = {}
+  byteRangeEnds = {}
+  byteRange = None
   for line in variantManifestBody.splitlines():
-    name = None
-
-    # Parse line starting with EXT-X-MEDIA
-    # e.g. #EXT-X-MAP:URI="../../../a595fd669f4349e1846efee6e27ccfa8/bba5843ebf8f41619348551669b17f47/index_video_1_init.mp4"
-    if line.startswith('#EXT-X-MAP:') or line.startswith('#EXT-X-I-FRAME-STREAM-INF:'):
-      line = line.split(':', 1)[1]
-      mediaDict = {}
 
-      # Add EXT-X-MEDIA properties to data set 
-      for keyVal in re.split(r',\s*(?=(?:[^"]*"[^"]*")*[^"]*$)', line):
-        (key, val) = keyVal.split('=', 1)
-        mediaDict[key] = val.strip('"')
-      name = mediaDict['URI']
+    # Skip blank lines
+    if not line:
+      continue
+
+    if line[0] == '#':
+      ( tag, separator, value ) = line.partition(':')
+      if not separator:
+        continue
+
+      # Parse byte range which applies to the next segment
+      # e.g. #EXT-X-BYTERANGE:1048576@720 (the offset is optional)
+      if tag == '#EXT-X-BYTERANGE':
+        byteRange = value
+        continue
+
+      # Parse the URI of EXT-X-MAP (and EXT-X-I-FRAME-STREAM-INF) tags
+      # e.g. #EXT-X-MAP:URI="../../../a595fd669f4349e1846efee6e27ccfa8/bba5843ebf8f41619348551669b17f47/index_video_1_init.mp4"
+      # e.g. #EXT-X-MAP:URI="main.mp4",BYTERANGE="720@0"
+      if tag not in VARIANT_URI_TAGS:
+        continue
+      attributes = parseAttributeList(value)
+      name = attributes.get('URI')
+      if not name:
+        continue
+      nameByteRange = attributes.get('BYTERANGE')
 
     # Parse lines which do not start with a comment
     # e.g. ../../../bf4fc289ea7a4a9a8030bfdfb6dd8180/75449fe7ed1a49288019306701174382/index_1_0.ts
-    elif line[0] != '#':
+    else:
       name = line
+      nameByteRange = byteRange
+      byteRange = None
 
     # Add key to dict if it has not been seen before
-    absoluteUrl = name
-    if name and name.startswith("http"):
-      absoluteUrl = name
-    elif name:
-      absoluteUrl = normalizeUrl("%s/%s" % (os.path.dirname(variantManifestUrl), name))
-
-    if not (absoluteUrl is None or absoluteUrl in segmentsDict.keys()):
+    absoluteUrl = resolver.resolve(name)
+    if absoluteUrl not in segmentsDict:
       segmentsDict[absoluteUrl] = 1
-    
+
+    # Track the end of the byte ranges referenced in the file. A byte range without an
+    # offset starts where the previous byte range of the same file ended.
+    if nameByteRange:
+      (length, _, offset) = nameByteRange.partition('@')
+      previousEnd = byteRangeEnds.get(absoluteUrl, 0)
+      start = int(offset) if offset else previousEnd
+      byteRangeEnds[absoluteUrl] = max( previousEnd, start + int(length) )
+
   segments = list(segmentsDict.keys())
 
-  return segments
\ No newline at end of file
+  return (segments, byteRangeEnds)
@@ -0,0 +1,83 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# HttpTransport.py
+# HTTP transport shared by all requests sent to origin during a download: manifest
+# fetches (HlsVodAsset, DashVodAsset), the asset cache check and the segment
+# transfers of DownloadVod.py. Requests to the same host share one pool of keep-alive
+# connections so connections (and TLS handshakes) are reused between manifests and
+# segments.
+#
+# Each host has a pool of up to maxConnectionsPerHost connections. Pools block when
+# every connection is in use, so a request waits for a connection to be returned
+# rather than opening a connection which is discarded after a single request.
+#
+# The number of connections opened and reused is reported by 'getSummary'.
+
+import threading
+import urllib3
+
+DEFAULT_MAX_CONNECTIONS_PER_HOST = 10
+DEFAULT_CONNECT_TIMEOUT = 10 # seconds
+DEFAULT_READ_TIMEOUT = 60 # seconds
+
+# Manifests are only fetched once per download so connection errors are retried by
+# urllib3. Segment transfers are retried by the RetryPolicy of DownloadVod.py instead.
+MANIFEST_RETRIES = urllib3.Retry(3)
+
+class CountingPoolManager(urllib3.PoolManager):
+  # Keeps a reference to every connection pool it creates, so the connections
+  # opened by pools which have since been evicted are still counted
+
+  def __init__(self, **kwargs):
+    super().__init__(**kwargs)
+    self.createdPools = []
+    self.createdPoolsLock = threading.Lock()
+
+  def _new_pool(self, scheme, host, port, request_context=None):
+    pool = super()._new_pool(scheme, host, port, request_context)
+    with self.createdPoolsLock:
+      self.createdPools.append(pool)
+    return pool
+
+
+class HttpTransport:
+  def __init__(self, maxConnectionsPerHost=DEFAULT_MAX_CONNECTIONS_PER_HOST, connectTimeout=DEFAULT_CONNECT_TIMEOUT,
+               readTimeout=DEFAULT_READ_TIMEOUT, retries=None, block=True):
+    self.maxConnectionsPerHost = maxConnectionsPerHost
+    self.poolManager = CountingPoolManager(
+      maxsize=maxConnectionsPerHost,
+      block=block,
+      timeout=urllib3.Timeout( connect=connectTimeout, read=readTimeout ),
+      retries=retries
+    )
+
+  # Same arguments as urllib3.PoolManager.request
+  def request( self, method, url, **kwargs ):
+    return self.poolManager.request( method, url, **kwargs )
+
+  def getSummary( self ):
+    with self.poolManager.createdPoolsLock:
+      pools = list(self.poolManager.createdPools)
+    # Every request (including redirects and retries made by urllib3) which did not
+    # open a new connection reused a keep-alive connection
+    numRequests = sum( pool.num_requests for pool in pools )
+    numConnections = sum( pool.num_connections for pool in pools )
+    return {
+      'originRequests': numRequests,
+      'originConnectionsOpened': numConnections,
+      'originConnectionsReused': max( 0, numRequests - numConnections )
+    }
@@ -0,0 +1,199 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# LocalWriter.py
+# Destination writer which writes objects to a local directory rather than S3 (see
+# S3Writer.py for the methods a destination writer provides). Used when downloading
+# to local disk from the command line, e.g. before a bulk transfer.
+#
+# - Object keys are paths relative to rootDir. The bucket is ignored.
+# - Objects are written to a temporary file in the same directory which is renamed
+#   once complete, so a partially written object is never visible under its key.
+#   Temporary files start with '.' and end with TEMP_SUFFIX and are ignored (and
+#   replaced) by later downloads.
+# - Space for each file is preallocated before it is written, where supported, and
+#   files are written through a WRITE_BUFFER_SIZE buffer to reduce fragmentation and
+#   the number of system calls.
+# - A multipart upload is a single temporary file. Parts may arrive in any order so
+#   each part is written at its offset in the file with pwrite, and completing the
+#   upload renames the file. Every object is therefore only written once.
+# - Files are fsync'ed before they are renamed, so an object visible under its key
+#   is complete on disk.
+#
+# The latency and size of every write is recorded as the 's3Put' performance metric
+# so the metrics of local and S3 downloads can be compared.
+
+import os
+import time
+import tempfile
+from datetime import datetime, timezone
+from PerformanceMetrics import recordMetric
+
+TEMP_SUFFIX = '.part'
+WRITE_BUFFER_SIZE = 1024 * 1024 # bytes
+
+# Temporary files are created readable only by the owner. Files are given the mode
+# they would have been created with once complete.
+UMASK = os.umask(0)
+os.umask(UMASK)
+FILE_MODE = 0o666 & ~UMASK
+
+class LocalWriter:
+  def __init__(self, rootDir):
+    self.rootDir = os.path.abspath(rootDir)
+
+  def getPath( self, key ):
+    return os.path.join( self.rootDir, *key.strip('/').split('/') )
+
+  # Local files have no ETag, so None is returned
+  def putObject( self, bucket, key, body, contentType, acl ):
+
+    writeStart = time.time()
+    self.writeFile( self.getPath(key), body )
+    recordMetric( 's3Put', time.time() - writeStart, len(body) )
+    return None
+
+  # Returns the upload ID of a new multipart upload (the path of the temporary file)
+  def createMultipartUpload( self, bucket, key, contentType, acl ):
+
+    ( fd, tempPath ) = self.createTempFile( self.getPath(key) )
+    os.close(fd)
+    return tempPath
+
+  # Writes the part at 'offset' (the number of bytes before the part in the object).
+  # Returns the part in the format expected by completeMultipartUpload.
+  def uploadPart( self, bucket, key, uploadId, partNumber, body, offset ):
+
+    writeStart = time.time()
+    fd = os.open( uploadId, os.O_WRONLY )
+    try:
+      preallocate( fd, len(body), offset )
+      view = memoryview(body)
+      written = 0
+      while written < len(body):
+        written += os.pwrite( fd, view[written:], offset + written )
+    finally:
+      os.close(fd)
+    recordMetric( 's3Put', time.time() - writeStart, len(body) )
+    return { 'PartNumber': partNumber, 'Size': len(body) }
+
+  def completeMultipartUpload( self, bucket, key, uploadId, parts ):
+
+    fd = os.open( uploadId, os.O_WRONLY )
+    try:
+      os.fsync(fd)
+    finally:
+      os.close(fd)
+    os.replace( uploadId, self.getPath(key) )
+    return None
+
+  def abortMultipartUpload( self, bucket, key, uploadId ):
+    try:
+      os.remove(uploadId)
+    except FileNotFoundError:
+      pass
+
+  # Yields a tuple of ( key, size, None, LastModified ) for each file under 'prefix'.
+  # Local files have no ETag.
+  def listObjects( self, bucket, prefix ):
+
+    directories = [ ( self.getPath(prefix), prefix.rstrip('/') + '/' ) ]
+    while directories:
+      ( directory, keyPrefix ) = directories.pop()
+      try:
+        entries = os.scandir(directory)
+      except FileNotFoundError:
+        continue
+      with entries:
+        for entry in entries:
+          if isTemporary(entry.name):
+            continue
+          if entry.is_dir(follow_symlinks=False):
+            directories.append( ( entry.path, keyPrefix + entry.name + '/' ) )
+          elif entry.is_file():
+            stat = entry.stat()
+            lastModified = datetime.fromtimestamp( stat.st_mtime, timezone.utc )
+            yield ( keyPrefix + entry.name, stat.st_size, None, lastModified )
+
+  def moveObject( self, bucket, oldKey, newKey, acl ):
+    newPath = self.getPath(newKey)
+    os.makedirs( os.path.dirname(newPath), exist_ok=True )
+    os.replace( self.getPath(oldKey), newPath )
+
+  # Returns the body of the file or None if it does not exist
+  def getObject( self, bucket, key ):
+    try:
+      with open( self.getPath(key), 'rb' ) as objectFile:
+        return objectFile.read()
+    except FileNotFoundError:
+      return None
+
+  def putStateObject( self, bucket, key, body ):
+    self.writeFile( self.getPath(key), body )
+
+  def deleteObject( self, bucket, key ):
+    try:
+      os.remove( self.getPath(key) )
+    except FileNotFoundError:
+      pass
+
+  def getLocation( self, bucket, key ):
+    return self.getPath(key) + ( '/' if key.endswith('/') else '' )
+
+  def checkDestination( self, bucket ):
+    os.makedirs( self.rootDir, exist_ok=True )
+    if not os.access( self.rootDir, os.W_OK ):
+      raise PermissionError( "'%s' is not writable" % self.rootDir )
+
+  # Returns a tuple of ( file descriptor, path ) of a new temporary file for 'path'
+  def createTempFile( self, path ):
+
+    directory = os.path.dirname(path)
+    os.makedirs( directory, exist_ok=True )
+    ( fd, tempPath ) = tempfile.mkstemp( dir=directory, prefix='.' + os.path.basename(path) + '.', suffix=TEMP_SUFFIX )
+    os.fchmod( fd, FILE_MODE )
+    return ( fd, tempPath )
+
+  # Writes 'body' to a temporary file which is then renamed to 'path'
+  def writeFile( self, path, body ):
+
+    ( fd, tempPath ) = self.createTempFile(path)
+    try:
+      with os.fdopen( fd, 'wb', buffering=WRITE_BUFFER_SIZE ) as tempFile:
+        preallocate( fd, len(body) )
+        tempFile.write(body)
+        tempFile.flush()
+        os.fsync(fd)
+      os.replace( tempPath, path )
+    except BaseException:
+      try:
+        os.remove(tempPath)
+      except OSError:
+        pass
+      raise
+
+
+def isTemporary( name ):
+  return name.startswith('.') and name.endswith(TEMP_SUFFIX)
+
+def preallocate( fd, size, offset=0 ):
+  # Not every platform or filesystem supports preallocation, the file is then
+  # extended as it is written
+  if size and hasattr(os, 'posix_fallocate'):
+    try:
+      os.posix_fallocate( fd, offset, size )
+    except OSError:
+      pass
@@ -0,0 +1,163 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# PerformanceMetrics.py
+# Latency histograms and byte counts for each phase of a download:
+# - manifestFetch: GET of each manifest from origin
+# - manifestParse: parsing of each manifest into resources
+# - destinationListing: listing the objects already at the destination
+# - originGet: GET of each resource (or range) from origin
+# - s3Put: each PUT (or multipart part upload) to the destination
+#
+# Latencies are counted in logarithmic buckets (each about 5% wider than the last)
+# so memory does not grow with the number of segments and percentiles are accurate
+# to within one bucket.
+#
+# The summary is included in the Lambda result and written to the log in CloudWatch
+# Embedded Metric Format (EMF) so the metrics are extracted without any API calls.
+#
+# Modules record metrics with 'recordMetric' and 'timeMetric', which do nothing
+# unless a PerformanceMetrics instance has been activated with 'setActiveMetrics'.
+
+import json
+import math
+import time
+import threading
+from contextlib import contextmanager
+
+BUCKET_GROWTH = 1.05
+MIN_LATENCY = 0.0001 # seconds, smaller latencies are counted in the first bucket
+
+activeMetrics = None
+
+class LatencyHistogram:
+  def __init__(self):
+    self.buckets = {}
+    self.count = 0
+    self.totalSeconds = 0.0
+    self.maxSeconds = 0.0
+    self.bytes = 0
+
+  def add( self, seconds, numBytes=0 ):
+    bucket = int( math.log( max(seconds, MIN_LATENCY) / MIN_LATENCY, BUCKET_GROWTH ) )
+    self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+    self.count += 1
+    self.totalSeconds += seconds
+    self.maxSeconds = max( self.maxSeconds, seconds )
+    self.bytes += numBytes
+
+  def getPercentile( self, percentile ):
+    # Returns the upper bound of the bucket containing the percentile
+    if not self.count:
+      return None
+    rank = math.ceil( self.count * percentile / 100.0 )
+    seen = 0
+    for bucket in sorted(self.buckets):
+      seen += self.buckets[bucket]
+      if seen >= rank:
+        return min( self.maxSeconds, MIN_LATENCY * BUCKET_GROWTH ** (bucket + 1) )
+    return self.maxSeconds
+
+
+class PerformanceMetrics:
+  def __init__(self):
+    self.histograms = {}
+    self.startTime = time.time()
+    self.lock = threading.Lock()
+
+  def record( self, name, seconds, numBytes=0 ):
+    with self.lock:
+      histogram = self.histograms.get(name)
+      if histogram is None:
+        histogram = self.histograms[name] = LatencyHistogram()
+      histogram.add( seconds, numBytes )
+
+  def getSummary( self ):
+    # Throughput is the bytes transferred over the elapsed time of the invocation,
+    # which accounts for requests made in parallel
+    elapsed = time.time() - self.startTime
+    summary = { 'elapsedSeconds': round(elapsed, 3) }
+    with self.lock:
+      for name, histogram in sorted(self.histograms.items()):
+        phase = {
+          'count': histogram.count,
+          'totalSeconds': round(histogram.totalSeconds, 3),
+          'p50Ms': toMilliseconds( histogram.getPercentile(50) ),
+          'p95Ms': toMilliseconds( histogram.getPercentile(95) ),
+          'p99Ms': toMilliseconds( histogram.getPercentile(99) ),
+          'maxMs': toMilliseconds( histogram.maxSeconds )
+        }
+        if histogram.bytes:
+          phase['bytes'] = histogram.bytes
+          phase['megabytesPerSecond'] = round( histogram.bytes / elapsed / 1000000, 3 ) if elapsed else None
+        summary[name] = phase
+    return summary
+
+  # Writes the summary to stdout as a CloudWatch Embedded Metric Format log line
+  def emitEmf( self, namespace, dimensions, summary=None ):
+
+    if summary is None:
+      summary = self.getSummary()
+
+    record = dict(dimensions)
+    metrics = []
+    for name, phase in summary.items():
+      if not isinstance(phase, dict):
+        continue
+      for key, unit in ( ('count', 'Count'), ('p50Ms', 'Milliseconds'), ('p95Ms', 'Milliseconds'),
+                         ('p99Ms', 'Milliseconds'), ('bytes', 'Bytes'), ('megabytesPerSecond', 'Megabytes/Second') ):
+        if phase.get(key) is not None:
+          metricName = name + key[0].upper() + key[1:]
+          record[metricName] = phase[key]
+          metrics.append({ 'Name': metricName, 'Unit': unit })
+    record['elapsedSeconds'] = summary['elapsedSeconds']
+    metrics.append({ 'Name': 'elapsedSeconds', 'Unit': 'Seconds' })
+
+    record['_aws'] = {
+      'Timestamp': int(time.time() * 1000),
+      'CloudWatchMetrics': [{
+        'Namespace': namespace,
+        'Dimensions': [ list(dimensions.keys()) ],
+        'Metrics': metrics
+      }]
+    }
+    print( json.dumps(record, separators=(',', ':')) )
+
+
+def toMilliseconds( seconds ):
+  if seconds is None:
+    return None
+  return round( seconds * 1000, 2 )
+
+def setActiveMetrics( metrics ):
+  global activeMetrics
+  activeMetrics = metrics
+
+def recordMetric( name, seconds, numBytes=0 ):
+  if activeMetrics:
+    activeMetrics.record( name, seconds, numBytes )
+
+@contextmanager
+def timeMetric( name ):
+  # Records the time taken by the body of a 'with' statement
+  if not activeMetrics:
+    yield
+    return
+  start = time.time()
+  try:
+    yield
+  finally:
+    activeMetrics.record( name, time.time() - start )
@@ -0,0 +1,145 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# Profiler.py
+# On-demand profiling of a single invocation, enabled with the 'profile' option of
+# DownloadVod.py:
+# - 'cpu': cProfile of the invocation including the worker threads. Saved as
+#   'cpu.pstats' (load with pstats or a viewer such as snakeviz) and as 'cpu.txt'
+#   listing the functions with the highest cumulative and internal time.
+# - 'memory': tracemalloc of the invocation. Saved as 'memory.txt' listing the peak
+#   traced memory and the sites which allocated the most memory still in use at
+#   the end of the invocation.
+# - 'all': both of the above
+#
+# Reports are saved under an S3 prefix ('s3://bucket/prefix/') or a local directory.
+# Nothing is imported or hooked unless profiling is requested.
+
+import io
+import os
+import sys
+import time
+import marshal
+import pstats
+import cProfile
+import threading
+import tracemalloc
+
+PROFILE_MODES = ( 'cpu', 'memory', 'all' )
+TOP_FUNCTIONS = 50
+TOP_ALLOCATIONS = 30
+TOP_ALLOCATION_TRACEBACKS = 5
+TRACEMALLOC_FRAMES = 10
+
+class InvocationProfiler:
+  def __init__(self, mode):
+    self.profileCpu = mode in ( 'cpu', 'all' )
+    self.profileMemory = mode in ( 'memory', 'all' )
+    self.profiles = []
+    self.mainProfile = None
+    self.snapshot = None
+    self.peakMemory = None
+    self.lock = threading.Lock()
+
+  def start( self ):
+    if self.profileMemory:
+      tracemalloc.start( TRACEMALLOC_FRAMES )
+    if self.profileCpu:
+      # Before Python 3.12 a profiler only sees the thread which enabled it, so every
+      # thread started while profiling (e.g. the fetch workers and manifest fetches)
+      # enables a profiler of its own. From Python 3.12 a profiler sees every thread.
+      if sys.version_info < (3, 12):
+        threading.setprofile( self.profileThread )
+      self.mainProfile = self.addProfile()
+
+  def stop( self ):
+    if self.profileCpu:
+      threading.setprofile( None )
+      self.mainProfile.disable()
+    if self.profileMemory:
+      self.snapshot = tracemalloc.take_snapshot()
+      ( currentMemory, self.peakMemory ) = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+
+  def addProfile( self ):
+    profile = cProfile.Profile()
+    with self.lock:
+      self.profiles.append(profile)
+    profile.enable()
+    return profile
+
+  def profileThread( self, frame, event, arg ):
+    # Called for the first event of each new thread. Enabling the thread's profiler
+    # replaces this function.
+    self.addProfile()
+
+  # Returns a dict mapping report names to report bodies
+  def getReports( self ):
+
+    reports = {}
+    if self.profileCpu:
+      with self.lock:
+        profiles = list(self.profiles)
+      output = io.StringIO()
+      stats = pstats.Stats( *profiles, stream=output )
+      reports['cpu.pstats'] = marshal.dumps( stats.stats )
+      output.write( "Profiled %d threads\n" % len(profiles) )
+      stats.sort_stats('cumulative').print_stats(TOP_FUNCTIONS)
+      stats.sort_stats('tottime').print_stats(TOP_FUNCTIONS)
+      reports['cpu.txt'] = output.getvalue().encode('utf-8')
+
+    if self.profileMemory:
+      lines = [ "Peak traced memory: %.1f MiB" % (self.peakMemory / (1024 * 1024)), "" ]
+      snapshot = self.snapshot.filter_traces( [ tracemalloc.Filter(False, tracemalloc.__file__) ] )
+      lines.append( "Top %d allocation sites (memory in use at the end of the invocation):" % TOP_ALLOCATIONS )
+      lines.extend( str(stat) for stat in snapshot.statistics('lineno')[:TOP_ALLOCATIONS] )
+      for stat in snapshot.statistics('traceback')[:TOP_ALLOCATION_TRACEBACKS]:
+        lines.append( "" )
+        lines.append( "%d blocks, %.1f KiB allocated from:" % (stat.count, stat.size / 1024) )
+        lines.extend( stat.traceback.format() )
+      reports['memory.txt'] = ( "\n".join(lines) + "\n" ).encode('utf-8')
+
+    return reports
+
+
+# Saves each report as <location><runId>/<report name>. 'location' is either an S3
+# prefix ('s3://bucket/prefix/') or a local directory. Returns where the reports were saved.
+def saveProfileReports( reports, location, runId, s3Client ):
+
+  if not location.endswith('/'):
+    location += '/'
+  location += runId + '/'
+
+  if location.startswith('s3://'):
+    ( bucket, separator, prefix ) = location[len('s3://'):].partition('/')
+    for name, body in reports.items():
+      s3Client.put_object( Bucket=bucket, Key=prefix + name, Body=body )
+  else:
+    os.makedirs( location, exist_ok=True )
+    for name, body in reports.items():
+      with open( os.path.join(location, name), 'wb' ) as reportFile:
+        reportFile.write( body )
+
+  return location
+
+
+def getProfileRunId( context ):
+  # The Lambda request ID identifies the invocation the reports belong to. Outside
+  # Lambda the time the reports were saved is used.
+  requestId = getattr( context, 'aws_request_id', None )
+  if requestId:
+    return requestId
+  return time.strftime( '%Y%m%dT%H%M%SZ', time.gmtime() )
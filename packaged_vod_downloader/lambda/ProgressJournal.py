@@ -0,0 +1,201 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ProgressJournal.py
+# Durable checkpoint of a download stored alongside the output at the destination. The
+# checkpoint contains the resolved resource table for the asset (see ResourceTable),
+# a cursor, a bitmap of the resources which have been copied to the destination and
+# the size and ETag of each resource copied.
+#
+# When a download stops with LAMBDA_TIMEOUT the next invocation loads the
+# checkpoint instead of re-fetching and re-parsing the asset manifests and
+# re-listing the destination prefix. While resources are being copied the checkpoint
+# is also saved every saveInterval seconds, so if the invocation crashes (e.g. runs
+# out of memory) the next one only repeats the work done since the last save.
+
+import gzip
+import json
+import base64
+import logging
+import threading
+import time
+from ResourceTable import ResourceTable, ResourceSizes
+
+logger = logging.getLogger()
+
+JOURNAL_VERSION = 4
+DEFAULT_SAVE_INTERVAL = 30 # seconds
+
+# Minimal stand-in for HlsVodAsset/DashVodAsset rebuilt from a checkpoint
+class JournalVodAsset:
+  def __init__(self, masterManifest, commonPrefix, allResources, resourceSizes, rangedResources, masterManifestValidators=None):
+    self.masterManifest = masterManifest
+    self.commonPrefix = commonPrefix
+    self.allResources = allResources
+    self.resourceSizes = resourceSizes
+    self.rangedResources = rangedResources
+    self.masterManifestValidators = masterManifestValidators if masterManifestValidators else {}
+
+
+class ProgressJournal:
+  def __init__(self, writer, destBucket, destPath, sourceUrl, vodAssetType, vodAsset, mode='copy'):
+    self.writer = writer
+    self.destBucket = destBucket
+    self.key = getJournalKey(destPath)
+    self.sourceUrl = sourceUrl
+    self.mode = mode
+    self.vodAssetType = vodAssetType
+    # The resource table and sizes are shared with the asset rather than copied
+    self.vodAsset = JournalVodAsset( vodAsset.masterManifest, vodAsset.commonPrefix, vodAsset.allResources,
+                                     vodAsset.resourceSizes, vodAsset.rangedResources,
+                                     getattr(vodAsset, 'masterManifestValidators', None) )
+    self.cursor = 0
+    self.completed = bytearray( (len(self.vodAsset.allResources) + 7) // 8 )
+    self.numCompleted = 0
+    # Periodic saves (see saveIfDue) are only enabled once the resource table is complete
+    self.saveInterval = None
+    self.lastSaved = time.time()
+    self.lock = threading.Lock()
+
+  # Loads the checkpoint for destPath. Returns None if there is no checkpoint or
+  # the checkpoint was created for a different source or mode, or by an incompatible version.
+  @classmethod
+  def load( cls, writer, destBucket, destPath, sourceUrl, mode='copy' ):
+
+    key = getJournalKey(destPath)
+    body = writer.getObject( destBucket, key )
+    if body is None:
+      return None
+
+    data = json.loads( gzip.decompress( body ) )
+    if data.get('version') != JOURNAL_VERSION or data.get('sourceUrl') != sourceUrl or data.get('mode', 'copy') != mode:
+      logger.info("Ignoring checkpoint %s as it does not match this download" % writer.getLocation(destBucket, key))
+      return None
+
+    vodAsset = JournalVodAsset( data['masterManifest'], data['commonPrefix'],
+                                ResourceTable.fromDict( data['resources'] ), ResourceSizes.fromDict( data['resourceSizes'] ),
+                                data['rangedResources'], data['masterManifestValidators'] )
+    journal = cls( writer, destBucket, destPath, sourceUrl, data['vodAssetType'], vodAsset, mode )
+    journal.cursor = data['cursor']
+    journal.completed = bytearray( base64.b64decode( data['completed'] ) )
+    journal.numCompleted = sum( bin(byte).count('1') for byte in journal.completed )
+
+    logger.info("Loaded checkpoint %s (%d of %d resources complete)" %
+                (writer.getLocation(destBucket, key), journal.numCompleted, len(vodAsset.allResources)))
+    return journal
+
+  def save( self ):
+
+    with self.lock:
+      data = {
+        'version': JOURNAL_VERSION,
+        'sourceUrl': self.sourceUrl,
+        'mode': self.mode,
+        'vodAssetType': self.vodAssetType,
+        'masterManifest': self.vodAsset.masterManifest,
+        'commonPrefix': self.vodAsset.commonPrefix,
+        'resources': self.vodAsset.allResources.toDict(),
+        'resourceSizes': self.vodAsset.resourceSizes.toDict(),
+        'rangedResources': self.vodAsset.rangedResources,
+        'masterManifestValidators': self.vodAsset.masterManifestValidators,
+        'cursor': self.cursor,
+        'completed': base64.b64encode( bytes(self.completed) ).decode('ascii')
+      }
+    body = gzip.compress( json.dumps(data, separators=(',', ':')).encode('utf-8') )
+    self.writer.putStateObject( self.destBucket, self.key, body )
+    self.lastSaved = time.time()
+    logger.info("Saved checkpoint to %s (%d bytes)" % (self.writer.getLocation(self.destBucket, self.key), len(body)))
+
+  def isSaveDue( self ):
+    return self.saveInterval is not None and time.time() - self.lastSaved >= self.saveInterval
+
+  # Saves the checkpoint if it has not been saved for saveInterval seconds. A failure is
+  # only logged as the checkpoint is saved again at the end of the invocation.
+  def saveIfDue( self ):
+    if not self.isSaveDue():
+      return
+    try:
+      self.save()
+    except Exception as e:
+      logger.warning("Unable to save checkpoint to %s: %s" % (self.writer.getLocation(self.destBucket, self.key), repr(e)))
+      self.lastSaved = time.time()
+
+  def delete( self ):
+    self.writer.deleteObject( self.destBucket, self.key )
+
+  # Called when resources are added to the resource table after the journal was
+  # created (i.e. while the asset manifests are still being parsed)
+  def resourcesAdded( self ):
+    with self.lock:
+      numBytes = (len(self.vodAsset.allResources) + 7) // 8
+      if numBytes > len(self.completed):
+        self.completed.extend( bytes(numBytes - len(self.completed)) )
+
+  # Marks every resource as not complete
+  def reset( self ):
+    with self.lock:
+      self.completed = bytearray( len(self.completed) )
+      self.numCompleted = 0
+
+  # Marks a resource as copied to the destination. 'size' and 'eTag' are the size and
+  # ETag (if known) of the object written, if the resource has been written.
+  def markComplete( self, index, size=None, eTag=None ):
+    if size is not None:
+      self.vodAsset.resourceSizes.set( index, size, eTag )
+    with self.lock:
+      mask = 1 << (index & 7)
+      if not self.completed[index >> 3] & mask:
+        self.completed[index >> 3] |= mask
+        self.numCompleted += 1
+
+  def isComplete( self, index ):
+    return bool( self.completed[index >> 3] & (1 << (index & 7)) )
+
+  def isAllComplete( self ):
+    return self.numCompleted == len(self.vodAsset.allResources)
+
+  # Yields the indexes of resources which have not been completed. Iteration starts
+  # at the cursor left by the previous invocation and wraps around so resources
+  # skipped by earlier invocations are retried after the untried ones.
+  def pendingIndexes( self ):
+    numResources = len(self.vodAsset.allResources)
+    start = self.cursor
+    for offset in range(numResources):
+      index = (start + offset) % numResources
+      if not self.isComplete(index):
+        yield index
+
+  # Returns the pending (not completed) resources as a compact list of inclusive
+  # [ first, last ] index ranges. When maxRanges is given only the first maxRanges
+  # ranges are returned.
+  def getPendingRanges( self, maxRanges=None ):
+    ranges = []
+    for index in range(len(self.vodAsset.allResources)):
+      if self.isComplete(index):
+        continue
+      if ranges and ranges[-1][1] == index - 1:
+        ranges[-1][1] = index
+      elif maxRanges is not None and len(ranges) == maxRanges:
+        break
+      else:
+        ranges.append([ index, index ])
+    return ranges
+
+
+def getJournalKey( destPath ):
+  # The checkpoint is stored next to (not inside) the destination path so it is not
+  # counted as one of the downloaded objects
+  return "%s.checkpoint.json.gz" % destPath
@@ -0,0 +1,89 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# RateLimiter.py
+# Token bucket rate limiting shared by all the workers of a download. Workers
+# consult the limiter immediately before every origin request (including retries)
+# so the limit applies to the requests actually sent rather than to the rate at
+# which work is queued.
+
+import time
+import threading
+
+class TokenBucket:
+  def __init__(self, rate, burst):
+    self.rate = float(rate)
+    self.burst = float(burst)
+    self.tokens = float(burst)
+    self.lastRefill = time.monotonic()
+    self.lock = threading.Lock()
+
+  # Takes 'tokens' from the bucket and returns the number of seconds the caller
+  # must wait before it is allowed to proceed. The bucket is allowed to go into
+  # debt so concurrent callers are queued behind each other rather than all
+  # waking at the same time when tokens become available.
+  def reserve( self, tokens=1 ):
+
+    with self.lock:
+      now = time.monotonic()
+      self.tokens = min( self.burst, self.tokens + (now - self.lastRefill) * self.rate )
+      self.lastRefill = now
+      self.tokens -= tokens
+      if self.tokens >= 0:
+        return 0.0
+      return -self.tokens / self.rate
+
+  def acquire( self, tokens=1 ):
+    delay = self.reserve(tokens)
+    if delay > 0:
+      time.sleep(delay)
+
+
+class RateLimiter:
+  def __init__(self, rpsLimit=0, rpsBurst=1, bytesPerSecondLimit=0, bytesBurst=None):
+    # A limit of zero (or less) disables the corresponding bucket
+    self.requestBucket = None
+    self.byteBucket = None
+
+    if rpsLimit > 0:
+      self.requestBucket = TokenBucket( rpsLimit, max(1, rpsBurst) )
+    if bytesPerSecondLimit > 0:
+      # Default to allowing one second worth of bytes as a burst
+      if bytesBurst is None:
+        bytesBurst = bytesPerSecondLimit
+      self.byteBucket = TokenBucket( bytesPerSecondLimit, bytesBurst )
+
+  # Blocks until another origin request may be sent
+  def acquireRequest( self ):
+    if self.requestBucket:
+      self.requestBucket.acquire(1)
+
+  # Accounts for 'numBytes' received from origin, blocking if the byte rate has been exceeded
+  def acquireBytes( self, numBytes ):
+    if self.byteBucket and numBytes > 0:
+      self.byteBucket.acquire(numBytes)
+
+  # Non-blocking equivalents used by the asyncio engine. These return the number of
+  # seconds the caller should wait (e.g. using asyncio.sleep).
+  def reserveRequest( self ):
+    if self.requestBucket:
+      return self.requestBucket.reserve(1)
+    return 0.0
+
+  def reserveBytes( self, numBytes ):
+    if self.byteBucket and numBytes > 0:
+      return self.byteBucket.reserve(numBytes)
+    return 0.0
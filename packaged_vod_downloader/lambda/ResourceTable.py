@@ -0,0 +1,342 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# ResourceTable.py
+# Compact, indexable table of the resource URLs of an asset. It is used in place
+# of a list of URL strings and supports len(), indexing and iteration. URLs are
+# only built when a resource is accessed.
+#
+# Resources are stored in blocks:
+# - ListBlock: individual URLs (manifests, init segments and HLS segments) stored
+#   as an interned directory prefix id and the remainder of the URL.
+# - TemplateBlock: the segments of a DASH SegmentTemplate stored as the template
+#   and the timeline as runs of ( first value, step, count ). Memory therefore scales
+#   with the number of timeline entries rather than the number of segments.
+#
+# ResourceSizes holds the size and destination ETag of the resources of a table by index.
+
+import bisect
+import threading
+import zlib
+from array import array
+
+class ListBlock:
+  def __init__(self):
+    self.prefixIds = array('l')
+    self.suffixes = []
+
+  def __len__( self ):
+    return len(self.suffixes)
+
+  def getResource( self, prefixes, offset ):
+    return prefixes[self.prefixIds[offset]] + self.suffixes[offset]
+
+  def iterResources( self, prefixes ):
+    for prefixId, suffix in zip(self.prefixIds, self.suffixes):
+      yield prefixes[prefixId] + suffix
+
+  def toDict( self ):
+    return { 'prefixIds': list(self.prefixIds), 'suffixes': self.suffixes }
+
+  @classmethod
+  def fromDict( cls, data ):
+    block = cls()
+    block.prefixIds = array('l', data['prefixIds'])
+    block.suffixes = data['suffixes']
+    return block
+
+
+class TemplateBlock:
+  def __init__(self, prefixId, template, placeholder):
+    self.prefixId = prefixId
+    self.template = template         # Last component of the URL containing the placeholder
+    self.placeholder = placeholder   # e.g. '$Time$' or '$Number$'
+    self.starts = array('q')
+    self.steps = array('q')
+    self.ends = array('q')           # Offset of the end of each run within the block
+    # True while every value is larger than the values before it, so runs can be found
+    # by a binary search of their start values
+    self.ordered = True
+
+  def __len__( self ):
+    return self.ends[-1] if self.ends else 0
+
+  def appendValue( self, value ):
+    # Extends the last run if the value continues it, otherwise starts a new run
+    if self.ends:
+      count = self.ends[-1] - (self.ends[-2] if len(self.ends) > 1 else 0)
+      if count == 1 and value > self.starts[-1]:
+        self.steps[-1] = value - self.starts[-1]
+        self.ends[-1] += 1
+        return
+      if value == self.starts[-1] + count * self.steps[-1]:
+        self.ends[-1] += 1
+        return
+      if value <= self.starts[-1] + (count - 1) * self.steps[-1]:
+        self.ordered = False
+    self.starts.append(value)
+    self.steps.append(1)
+    self.ends.append( len(self) + 1 )
+
+  def getValue( self, offset ):
+    run = bisect.bisect_right(self.ends, offset)
+    runOffset = offset - (self.ends[run - 1] if run else 0)
+    return self.starts[run] + runOffset * self.steps[run]
+
+  def containsValue( self, value ):
+    if self.ordered:
+      run = bisect.bisect_right(self.starts, value) - 1
+      return run >= 0 and self.runContainsValue( run, value )
+    return any( self.runContainsValue( run, value ) for run in range(len(self.starts)) )
+
+  def runContainsValue( self, run, value ):
+    count = self.ends[run] - (self.ends[run - 1] if run else 0)
+    delta = value - self.starts[run]
+    return delta >= 0 and delta % self.steps[run] == 0 and delta // self.steps[run] < count
+
+  def getResource( self, prefixes, offset ):
+    return prefixes[self.prefixId] + self.template.replace(self.placeholder, str(self.getValue(offset)))
+
+  def iterResources( self, prefixes ):
+    prefix = prefixes[self.prefixId]
+    runStart = 0
+    for start, step, end in zip(self.starts, self.steps, self.ends):
+      for runOffset in range(end - runStart):
+        yield prefix + self.template.replace(self.placeholder, str(start + runOffset * step))
+      runStart = end
+
+  def toDict( self ):
+    return {
+      'prefixId': self.prefixId,
+      'template': self.template,
+      'placeholder': self.placeholder,
+      'starts': list(self.starts),
+      'steps': list(self.steps),
+      'ends': list(self.ends),
+      'ordered': self.ordered
+    }
+
+  @classmethod
+  def fromDict( cls, data ):
+    block = cls( data['prefixId'], data['template'], data['placeholder'] )
+    block.starts = array('q', data['starts'])
+    block.steps = array('q', data['steps'])
+    block.ends = array('q', data['ends'])
+    block.ordered = data.get('ordered', True)
+    return block
+
+
+class ResourceTable:
+  def __init__(self):
+    self.prefixes = []
+    self.prefixIds = {}
+    self.blocks = []
+    self.blockOffsets = []
+    self.numResources = 0
+    # Index of each individually added URL. Used to drop duplicates, for example init
+    # segments which are shared by several DASH periods.
+    self.indexes = {}
+
+  def __len__( self ):
+    return self.numResources
+
+  def __getitem__( self, index ):
+    if index < 0:
+      index += self.numResources
+    if index < 0 or index >= self.numResources:
+      raise IndexError('resource index out of range')
+    blockNumber = bisect.bisect_right(self.blockOffsets, index) - 1
+    return self.blocks[blockNumber].getResource( self.prefixes, index - self.blockOffsets[blockNumber] )
+
+  def __iter__( self ):
+    for block in self.blocks:
+      yield from block.iterResources( self.prefixes )
+
+  def internPrefix( self, prefix ):
+    prefixId = self.prefixIds.get(prefix)
+    if prefixId is None:
+      prefixId = len(self.prefixes)
+      self.prefixes.append(prefix)
+      self.prefixIds[prefix] = prefixId
+    return prefixId
+
+  def appendBlock( self, block ):
+    self.blocks.append(block)
+    self.blockOffsets.append(self.numResources)
+    return block
+
+  # Adds a single URL. Returns the index of the resource or None if the URL is already
+  # in the table (duplicates are only detected until the table is compacted).
+  def add( self, url ):
+    if url in self.indexes:
+      return None
+
+    (prefix, suffix) = splitUrl(url)
+    if self.blocks and isinstance(self.blocks[-1], ListBlock):
+      block = self.blocks[-1]
+    else:
+      block = self.appendBlock( ListBlock() )
+    block.prefixIds.append( self.internPrefix(prefix) )
+    block.suffixes.append( suffix )
+
+    index = self.numResources
+    self.indexes[url] = index
+    self.numResources += 1
+    return index
+
+  # Adds a list of URLs and returns the indexes of the URLs which were not already in the table
+  def extend( self, urls ):
+    newIndexes = []
+    for url in urls:
+      index = self.add(url)
+      if index is not None:
+        newIndexes.append(index)
+    return newIndexes
+
+  # Adds a resource for each value in 'values' (e.g. segment times or numbers). The
+  # URL of each resource is urlTemplate with the placeholder replaced by the value.
+  # Returns the indexes of the new resources.
+  def addTemplate( self, urlTemplate, placeholder, values ):
+
+    (prefix, template) = splitUrl(urlTemplate)
+    if placeholder not in template:
+      # Placeholder is in the path (or missing), so URLs cannot share a prefix
+      return self.extend( urlTemplate.replace(placeholder, str(value)) for value in values )
+
+    prefixId = self.internPrefix(prefix)
+    # Earlier blocks with the same template (e.g. from an earlier period) may
+    # already contain some of the resources, as may this block if a value is repeated
+    block = TemplateBlock( prefixId, template, placeholder )
+    sameTemplateBlocks = [ earlierBlock for earlierBlock in self.blocks if isinstance(earlierBlock, TemplateBlock)
+                           and earlierBlock.prefixId == prefixId and earlierBlock.template == template
+                           and earlierBlock.placeholder == placeholder ]
+    sameTemplateBlocks.append(block)
+
+    for value in values:
+      if any( sameTemplateBlock.containsValue(value) for sameTemplateBlock in sameTemplateBlocks ):
+        continue
+      block.appendValue(value)
+
+    firstIndex = self.numResources
+    if len(block):
+      self.appendBlock(block)
+      self.numResources += len(block)
+    return range(firstIndex, self.numResources)
+
+  # Drops the index used to detect duplicate URLs once all resources have been added
+  def compact( self ):
+    self.indexes = {}
+
+  def toDict( self ):
+    blocks = []
+    for block in self.blocks:
+      data = block.toDict()
+      data['type'] = 'template' if isinstance(block, TemplateBlock) else 'list'
+      blocks.append(data)
+    return { 'prefixes': self.prefixes, 'blocks': blocks }
+
+  @classmethod
+  def fromDict( cls, data ):
+    table = cls()
+    for prefix in data['prefixes']:
+      table.internPrefix(prefix)
+    for blockData in data['blocks']:
+      if blockData['type'] == 'template':
+        block = TemplateBlock.fromDict(blockData)
+      else:
+        block = ListBlock.fromDict(blockData)
+      table.appendBlock(block)
+      table.numResources += len(block)
+    return table
+
+
+class ResourceSizes:
+  # Size in bytes and destination ETag of each resource of a ResourceTable, by index.
+  # They are recorded when a resource is written to the destination and used to detect
+  # objects at the destination which do not match what was copied (e.g. a truncated
+  # object left behind by an earlier run).
+  # Sizes and ETags are kept in arrays which are only allocated once a size is known. An
+  # unknown size is stored as -1. ETags are stored as their crc32, or -1 if not known.
+  #
+  # The manifests give the minimum size of some resources (the end of the byte ranges of
+  # a file). These are kept separately, by index, as the file may be larger.
+  def __init__(self):
+    self.sizes = array('q')
+    self.eTags = array('q')
+    self.minimumSizes = {}
+    # Set when a size is recorded, so callers know the sizes need to be saved
+    self.changed = False
+    self.lock = threading.Lock()
+
+  # Returns the size of the resource (or the minimum size if the resource has not been
+  # copied) or None if it is not known
+  def get( self, index ):
+    if index < len(self.sizes) and self.sizes[index] >= 0:
+      return self.sizes[index]
+    return self.minimumSizes.get(index)
+
+  # Records the size and ETag of the object written for a resource
+  def set( self, index, size, eTag=None ):
+    with self.lock:
+      if index >= len(self.sizes):
+        self.sizes.extend( array('q', [-1]) * (index + 1 - len(self.sizes)) )
+        self.eTags.extend( array('q', [-1]) * (index + 1 - len(self.eTags)) )
+      self.sizes[index] = size
+      self.eTags[index] = hashETag(eTag) if eTag else -1
+      self.changed = True
+
+  # Records a size the resource is known to be at least
+  def setMinimum( self, index, size ):
+    with self.lock:
+      if size > self.minimumSizes.get(index, -1):
+        self.minimumSizes[index] = size
+        self.changed = True
+
+  # True unless the object at the destination (of 'size' bytes with ETag 'eTag', if
+  # known) differs from the object written for the resource or is smaller than the
+  # minimum size of the resource
+  def matches( self, index, size, eTag=None ):
+    if index < len(self.sizes) and self.sizes[index] >= 0:
+      if size != self.sizes[index]:
+        return False
+      return not eTag or self.eTags[index] < 0 or hashETag(eTag) == self.eTags[index]
+    return size >= self.minimumSizes.get(index, 0)
+
+  def toDict( self ):
+    return {
+      'sizes': list(self.sizes),
+      'eTags': list(self.eTags),
+      'minimumSizes': [ [ index, size ] for index, size in self.minimumSizes.items() ]
+    }
+
+  @classmethod
+  def fromDict( cls, data ):
+    resourceSizes = cls()
+    resourceSizes.sizes = array('q', data['sizes'])
+    resourceSizes.eTags = array('q', data['eTags'])
+    resourceSizes.minimumSizes = { index: size for index, size in data['minimumSizes'] }
+    return resourceSizes
+
+
+def hashETag( eTag ):
+  return zlib.crc32( eTag.encode('utf-8') )
+
+def splitUrl( url ):
+  # Splits a URL into the directory prefix (ending in '/') and the remainder of the URL.
+  # Any query string is kept in the remainder.
+  path = url.split('?')[0]
+  splitAt = path.rfind('/') + 1
+  return ( url[:splitAt], url[splitAt:] )
@@ -0,0 +1,103 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# RetryPolicy.py
+# Decides whether and when a failed origin request is retried.
+# - Only failures which may succeed on retry are retried (by default timeouts,
+#   connection errors, truncated bodies, HTTP 408, 429 and 5xx). Permanent errors
+#   such as HTTP 404 fail immediately.
+# - The delay before a retry uses exponential backoff with full jitter so workers
+#   do not retry in lock step. A 'Retry-After' header sent by origin is honoured.
+# - A retry budget limits the total number of retries in an invocation so an
+#   unhealthy origin cannot consume the whole invocation with retries.
+# - The number of retries is recorded per failure reason (e.g. HTTP status code).
+
+import time
+import random
+import threading
+from email.utils import parsedate_to_datetime
+
+# Failure reasons which are not HTTP status codes
+CONNECTION_ERROR = 'connectionError'
+LENGTH_MISMATCH = 'lengthMismatch'
+
+DEFAULT_RETRYABLE_STATUSES = [ 408, 429, 500, 502, 503, 504 ]
+MAX_RETRY_AFTER = 60 # seconds
+
+class RetryPolicy:
+  def __init__(self, maxAttempts=3, baseDelay=0.5, maxDelay=20, retryableStatuses=None, retryBudget=1000):
+    self.maxAttempts = maxAttempts
+    self.baseDelay = baseDelay
+    self.maxDelay = maxDelay
+    if retryableStatuses is None:
+      retryableStatuses = DEFAULT_RETRYABLE_STATUSES
+    self.retryableStatuses = set(retryableStatuses)
+    self.retryBudget = retryBudget
+    self.retriesByReason = {}
+    self.budgetExhausted = False
+    self.lock = threading.Lock()
+
+  def isRetryable( self, reason ):
+    if reason in ( CONNECTION_ERROR, LENGTH_MISMATCH ):
+      return True
+    return reason in self.retryableStatuses
+
+  # Returns the number of seconds to wait before retrying, or None if the request
+  # should not be retried. 'attempt' is the number of attempts made so far.
+  def getRetryDelay( self, reason, attempt, retryAfter=None ):
+
+    if attempt >= self.maxAttempts or not self.isRetryable(reason):
+      return None
+
+    with self.lock:
+      if self.retryBudget is not None:
+        if self.retryBudget <= 0:
+          self.budgetExhausted = True
+          return None
+        self.retryBudget -= 1
+      key = str(reason)
+      self.retriesByReason[key] = self.retriesByReason.get(key, 0) + 1
+
+    # Exponential backoff with full jitter
+    delay = random.uniform( 0, min( self.maxDelay, self.baseDelay * (2 ** (attempt - 1)) ) )
+
+    retryAfterSeconds = parseRetryAfter(retryAfter)
+    if retryAfterSeconds is not None:
+      delay = max( delay, min( retryAfterSeconds, MAX_RETRY_AFTER ) )
+
+    return delay
+
+  def getSummary( self ):
+    with self.lock:
+      return {
+        'retriesByStatus': dict(self.retriesByReason),
+        'totalRetries': sum(self.retriesByReason.values()),
+        'retryBudgetExhausted': self.budgetExhausted
+      }
+
+
+def parseRetryAfter( retryAfter ):
+  # Retry-After may be a number of seconds or an HTTP date
+  if not retryAfter:
+    return None
+  try:
+    return max( 0.0, float(retryAfter) )
+  except ValueError:
+    pass
+  try:
+    return max( 0.0, parsedate_to_datetime(retryAfter).timestamp() - time.time() )
+  except (TypeError, ValueError):
+    return None
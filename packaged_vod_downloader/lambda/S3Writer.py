@@ -0,0 +1,145 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# S3Writer.py
+# Writes objects to the destination bucket using a single low-level S3 client.
+#
+# S3Writer is the default destination writer of DownloadVod.py. LocalWriter writes
+# to a local directory instead and implements the same methods:
+# - putObject, createMultipartUpload, uploadPart, completeMultipartUpload and
+#   abortMultipartUpload write the downloaded resources. putObject and
+#   completeMultipartUpload return the ETag of the object written, or None if the
+#   writer does not know it.
+# - listObjects and moveObject inspect and rearrange the destination
+# - getObject, putStateObject and deleteObject read and write the checkpoint,
+#   sync index and asset cache kept next to the destination path
+# - getLocation returns a printable location for log messages and results
+# - checkDestination raises an exception if the destination cannot be written to
+#
+# - The connection pool of the client is sized for the number of workers writing at
+#   the same time (botocore defaults to 10 connections, which are shared by every
+#   thread using the client)
+# - Throttling (503 SlowDown) is handled by botocore's 'adaptive' retry mode, which
+#   also slows down the rate requests are sent at
+# - Bodies of TRANSFER_MULTIPART_THRESHOLD bytes or more are uploaded by the transfer
+#   manager as parallel multipart uploads. boto3 uses the AWS CRT transfer client
+#   for these when awscrt is installed and supported on the host.
+#
+# The latency and size of every PUT (or part upload) is recorded as the 's3Put'
+# performance metric.
+
+import io
+import time
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+from PerformanceMetrics import recordMetric
+
+DEFAULT_MAX_POOL_CONNECTIONS = 50
+S3_MAX_ATTEMPTS = 5
+TRANSFER_MULTIPART_THRESHOLD = 16 * 1024 * 1024 # bytes
+TRANSFER_CHUNK_SIZE = 8 * 1024 * 1024 # bytes
+TRANSFER_MAX_CONCURRENCY = 4
+
+class S3Writer:
+  def __init__(self, maxPoolConnections=DEFAULT_MAX_POOL_CONNECTIONS):
+    self.maxPoolConnections = maxPoolConnections
+    self.client = boto3.client( 's3', config=Config(
+      max_pool_connections=maxPoolConnections,
+      retries={ 'mode': 'adaptive', 'max_attempts': S3_MAX_ATTEMPTS }
+    ))
+    self.transferConfig = TransferConfig(
+      multipart_threshold=TRANSFER_MULTIPART_THRESHOLD,
+      multipart_chunksize=TRANSFER_CHUNK_SIZE,
+      max_concurrency=TRANSFER_MAX_CONCURRENCY
+    )
+
+  def putObject( self, bucket, key, body, contentType, acl ):
+
+    extraArgs = { 'ACL': acl }
+    if contentType:
+      extraArgs['ContentType'] = contentType
+
+    # The transfer manager does not return the ETag of the object
+    putStart = time.time()
+    eTag = None
+    if len(body) >= TRANSFER_MULTIPART_THRESHOLD:
+      self.client.upload_fileobj( io.BytesIO(body), bucket, key, ExtraArgs=extraArgs, Config=self.transferConfig )
+    else:
+      eTag = self.client.put_object( Bucket=bucket, Key=key, Body=body, **extraArgs ).get('ETag')
+    recordMetric( 's3Put', time.time() - putStart, len(body) )
+    return eTag
+
+  # Returns the upload ID of a new multipart upload
+  def createMultipartUpload( self, bucket, key, contentType, acl ):
+
+    createArgs = { 'Bucket': bucket, 'Key': key, 'ACL': acl }
+    if contentType:
+      createArgs['ContentType'] = contentType
+    return self.client.create_multipart_upload( **createArgs )['UploadId']
+
+  # Returns the part in the format expected by completeMultipartUpload. 'offset' is the
+  # position of the part in the object, which S3 derives from the part number.
+  def uploadPart( self, bucket, key, uploadId, partNumber, body, offset ):
+
+    uploadStart = time.time()
+    part = self.client.upload_part( Bucket=bucket, Key=key, UploadId=uploadId,
+                                    PartNumber=partNumber, Body=body )
+    recordMetric( 's3Put', time.time() - uploadStart, len(body) )
+    return { 'ETag': part['ETag'], 'PartNumber': partNumber }
+
+  def completeMultipartUpload( self, bucket, key, uploadId, parts ):
+    response = self.client.complete_multipart_upload( Bucket=bucket, Key=key, UploadId=uploadId,
+                                                      MultipartUpload={ 'Parts': parts } )
+    return response.get('ETag')
+
+  def abortMultipartUpload( self, bucket, key, uploadId ):
+    self.client.abort_multipart_upload( Bucket=bucket, Key=key, UploadId=uploadId )
+
+  # Yields a tuple of ( key, size, ETag, LastModified ) for each object under 'prefix'
+  def listObjects( self, bucket, prefix ):
+    # Use the low level client paginator to avoid creating a resource object per key
+    paginator = self.client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+      for obj in page.get('Contents', []):
+        yield ( obj['Key'], obj['Size'], obj['ETag'], obj['LastModified'] )
+
+  # A server side copy is used so the object is not transferred again
+  def moveObject( self, bucket, oldKey, newKey, acl ):
+    self.client.copy( { 'Bucket': bucket, 'Key': oldKey }, bucket, newKey, ExtraArgs={ 'ACL': acl } )
+    self.client.delete_object( Bucket=bucket, Key=oldKey )
+
+  # Returns the body of the object or None if it does not exist
+  def getObject( self, bucket, key ):
+    try:
+      response = self.client.get_object( Bucket=bucket, Key=key )
+    except self.client.exceptions.NoSuchKey:
+      return None
+    return response['Body'].read()
+
+  # State objects are gzip compressed JSON
+  def putStateObject( self, bucket, key, body ):
+    self.client.put_object( Bucket=bucket, Key=key, Body=body,
+                            ContentType='application/json', ContentEncoding='gzip' )
+
+  def deleteObject( self, bucket, key ):
+    self.client.delete_object( Bucket=bucket, Key=key )
+
+  def getLocation( self, bucket, key ):
+    return "s3://%s/%s" % (bucket, key)
+
+  def checkDestination( self, bucket ):
+    self.client.list_objects_v2( Bucket=bucket, MaxKeys=1 )
@@ -0,0 +1,153 @@
+# Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+# SPDX-License-Identifier: MIT-0
+#
+# Permission is hereby granted, free of charge, to any person obtaining a copy of this
+# software and associated documentation files (the "Software"), to deal in the Software
+# without restriction, including without limitation the rights to use, copy, modify,
+# merge, publish, distribute, sublicense, and/or sell copies of the Software, and to
+# permit persons to whom the Software is furnished to do so.
+#
+# THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLIED,
+# INCLUDING BUT NOT LIMITED TO THE WARRANTIES OF MERCHANTABILITY, FITNESS FOR A
+# PARTICULAR PURPOSE AND NONINFRINGEMENT. IN NO EVENT SHALL THE AUTHORS OR COPYRIGHT
+# HOLDERS BE LIABLE FOR ANY CLAIM, DAMAGES OR OTHER LIABILITY, WHETHER IN AN ACTION
+# OF CONTRACT, TORT OR OTHERWISE, ARISING FROM, OUT OF OR IN CONNECTION WITH THE
+# SOFTWARE OR THE USE OR OTHER DEALINGS IN THE SOFTWARE.
+
+# SyncIndex.py
+# Index of the validators ('ETag', 'Last-Modified' and 'Content-Length') origin
+# returned for each resource copied to the destination. The index is stored
+# alongside the output at the destination and is used by the 'sync' mode of DownloadVod.py to
+# re-fetch resources with conditional GETs, so only resources which are new or have
+# changed at origin are transferred again.
+#
+# Validators are staged while a resource is transferred and only recorded once the
+# resource has been written to the destination, so the index never describes an
+# object which failed to be written.
+#
+# Resources are identified by their index in the asset (see ResourceTable) rather
+# than their URL, which keeps the index small for assets with many segments. The
+# crc32 of the URL is kept with the validators, so validators recorded for another
+# resource (e.g. after resources were added to the asset) are never used.
+
+import gzip
+import json
+import logging
+import threading
+import zlib
+from email.utils import formatdate
+
+logger = logging.getLogger()
+
+SYNC_INDEX_VERSION = 2
+
+# Raised by the origin request functions when origin responds '304 Not Modified'
+# to a conditional request
+class NotModifiedError(Exception):
+  pass
+
+
+class SyncIndex:
+  def __init__(self, writer, destBucket, destPath):
+    self.writer = writer
+    self.destBucket = destBucket
+    self.key = getSyncIndexKey(destPath)
+    self.validators = {}       # resource index -> [ crc32 of URL, ETag, Last-Modified, Content-Length ]
+    self.stagedValidators = {}
+    # Destination index (see listObjectsAtDestination), only set in sync mode
+    self.existingObjects = {}
+    self.changed = False
+    self.lock = threading.Lock()
+
+  # Loads the index for destPath. Returns an empty index if there is no index or it
+  # was created by an incompatible version.
+  @classmethod
+  def load( cls, writer, destBucket, destPath ):
+
+    syncIndex = cls( writer, destBucket, destPath )
+    body = writer.getObject( destBucket, syncIndex.key )
+    if body is None:
+      return syncIndex
+
+    data = json.loads( gzip.decompress( body ) )
+    if data.get('version') != SYNC_INDEX_VERSION:
+      logger.info("Ignoring sync index %s as it was created by an incompatible version" % writer.getLocation(destBucket, syncIndex.key))
+      return syncIndex
+
+    syncIndex.validators = { row[0]: row[1:] for row in data['validators'] }
+    logger.info("Loaded sync index %s (%d resources)" % (writer.getLocation(destBucket, syncIndex.key), len(syncIndex.validators)))
+    return syncIndex
+
+  # Saves the index if any validators have been recorded since it was loaded
+  def save( self ):
+
+    with self.lock:
+      if not self.changed:
+        return
+      data = {
+        'version': SYNC_INDEX_VERSION,
+        'validators': [ [ index ] + validators for index, validators in self.validators.items() ]
+      }
+      self.changed = False
+    body = gzip.compress( json.dumps(data, separators=(',', ':')).encode('utf-8') )
+    self.writer.putStateObject( self.destBucket, self.key, body )
+    logger.info("Saved sync index to %s (%d bytes)" % (self.writer.getLocation(self.destBucket, self.key), len(body)))
+
+  # Called with the headers of a successful origin response. 'contentLength' is the
+  # full size of the resource (which differs from 'Content-Length' for ranged requests).
+  def stageValidators( self, index, url, headers, contentLength ):
+    eTag = headers.get('ETag')
+    lastModified = headers.get('Last-Modified')
+    if eTag or lastModified:
+      with self.lock:
+        self.stagedValidators[index] = [ hashUrl(url), eTag, lastModified, contentLength ]
+
+  # Called once resource 'index' has been written to the destination (commit=True) or
+  # has failed to be copied (commit=False)
+  def recordValidators( self, index, commit=True ):
+    with self.lock:
+      validators = self.stagedValidators.pop(index, None)
+      if commit and validators:
+        self.validators[index] = validators
+        self.changed = True
+
+  # Returns the conditional request headers used to re-fetch resource 'index' from
+  # 'url' or None if the resource needs to be fetched unconditionally. 'objectName' is
+  # the name of the object at the destination (relative to the destination path). The
+  # object is fetched unconditionally if it does not match the object recorded in
+  # 'resourceSizes' when the resource was copied.
+  def getConditionalHeaders( self, index, url, objectName, resourceSizes=None ):
+
+    existingObject = self.existingObjects.get(objectName)
+    if existingObject is None:
+      return None
+    ( size, eTag, lastModified ) = existingObject
+    if resourceSizes is not None and not resourceSizes.matches( index, size, eTag ):
+      return None
+
+    with self.lock:
+      validators = self.validators.get(index)
+    if validators and validators[0] == hashUrl(url):
+      ( urlHash, originETag, originLastModified, originLength ) = validators
+      # Object at the destination is not what origin returned when it was copied
+      if originLength is not None and originLength != size:
+        return None
+      headers = {}
+      if originETag:
+        headers['If-None-Match'] = originETag
+      if originLastModified:
+        headers['If-Modified-Since'] = originLastModified
+      return headers
+
+    # Nothing recorded for this resource (e.g. copied by an earlier version). The
+    # object at the destination was written after it was fetched from origin.
+    return { 'If-Modified-Since': formatdate( lastModified.timestamp(), usegmt=True ) }
+
+
+def hashUrl( url ):
+  return zlib.crc32( url.encode('utf-8') )
+
+def getSyncIndexKey( destPath ):
+  # Stored next to (not inside) the destination path so it is not counted as one of
+  # the downloaded objects
+  return "%s.sync.json.gz" % destPath
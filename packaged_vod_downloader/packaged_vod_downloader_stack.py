@@ -205,10 +205,12 @@ class PackagedVodDownloaderStack(Stack):
             resources=[ destinationBucket.bucket_arn ]
         ))
         # Download Lambda needs to be able to write to S3.
+        # DeleteObject is required to remove the download checkpoint once an asset is complete.
         vodDownloadLambdaRole.add_to_policy(iam.PolicyStatement(
             actions=[
                 "s3:PutObject",
-                "s3:GetObject"
+                "s3:GetObject",
+                "s3:DeleteObject"
                 ],
             resources=[ "%s/*" % destinationBucket.bucket_arn ]
         ))
@@ -0,0 +1,253 @@
+"""End-to-end throughput benchmark for DownloadVod.fetchStream.
+
+Serves a synthetic HLS or DASH asset from a local origin (see synthetic_origin.py)
+and downloads it into a moto server standing in for S3. The benchmark reports:
+
+- segments per second and MB per second for an uninterrupted download
+- peak RSS of the process running fetchStream
+- restart overhead: the extra time taken when the same download is split across
+  several invocations by a simulated Lambda deadline
+
+Results are written as JSON so they can be compared between commits.
+
+Example:
+
+    python -m tests.benchmark.benchmark --format hls --variants 4 --segments 200 \\
+        --segment-size 200000 --latency 0.02 --output bench_output.json
+
+Each scenario runs fetchStream in a fresh child process, so its peak RSS is not
+inflated by earlier scenarios. moto also runs in its own process, so the stored
+objects are not counted either.
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAMBDA_DIR = os.path.join(REPO_ROOT, 'packaged_vod_downloader', 'lambda')
+sys.path.insert(0, REPO_ROOT)
+
+from tests.benchmark.synthetic_origin import AssetConfig, SyntheticOrigin  # noqa: E402
+
+BUCKET = 'benchmark-bucket'
+MAX_INVOCATIONS = 50
+
+
+class FakeLambdaContext:
+    """Reports the Lambda deadline as reached 'timeBudget' seconds after creation."""
+
+    def __init__(self, timeBudget, minTimeRemainingMs):
+        self.deadline = time.time() + timeBudget
+        self.minTimeRemainingMs = minTimeRemainingMs
+
+    def get_remaining_time_in_millis(self):
+        return self.minTimeRemainingMs + int((self.deadline - time.time()) * 1000)
+
+
+def freePort():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def startMotoServer():
+    port = freePort()
+    process = subprocess.Popen([sys.executable, '-m', 'moto.server', '-H', '127.0.0.1', '-p', str(port)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    endpoint = 'http://127.0.0.1:%d' % port
+    for _ in range(100):
+        try:
+            urllib.request.urlopen(endpoint + '/moto-api/')
+            return process, endpoint
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError('moto server did not start')
+
+
+def serveOrigin(config, connection):
+    # Runs in a child process so the origin does not compete with fetchStream for the GIL
+    with SyntheticOrigin(config) as origin:
+        connection.send(origin.url)
+        connection.recv()
+
+
+def runScenario(endpoint, sourceUrl, destinationPath, eventOptions, timeBudget, connection):
+    # Runs in a child process. Invokes fetchStream until the download completes, or
+    # fails, and sends the measurements back to the parent.
+    os.environ['AWS_ENDPOINT_URL'] = endpoint
+    sys.path.insert(0, LAMBDA_DIR)
+    # fetchStream reports progress with print, keep stdout for the JSON results
+    sys.stdout = open(os.devnull, 'w')
+    import logging
+    import boto3
+    import DownloadVod
+    logging.getLogger().setLevel(logging.WARNING)
+
+    event = {
+        'source_url': sourceUrl,
+        'destination_bucket': BUCKET,
+        'destination_path': destinationPath,
+        'rpsLimit': 0
+    }
+    event.update(eventOptions)
+
+    invocations = []
+    status = None
+    start = time.time()
+    while len(invocations) < MAX_INVOCATIONS:
+        context = None
+        if timeBudget:
+            context = FakeLambdaContext(timeBudget, DownloadVod.LAMBDA_MIN_TIME_REMAINING_TRIGGER)
+        invocationStart = time.time()
+        response = DownloadVod.fetchStream(event, context)
+        result = response.get('result', {})
+        status = result.get('status')
+        invocations.append({
+            'seconds': round(time.time() - invocationStart, 3),
+            'status': status,
+            'downloadedSegments': result.get('totalDownloadedSegments'),
+            'skippedSegments': result.get('totalSkippedSegments'),
+            'totalRetries': result.get('totalRetries'),
+            'performance': result.get('performance')
+        })
+        if status != 'LAMBDA_TIMEOUT':
+            break
+    elapsed = time.time() - start
+
+    # Bytes at the destination, excluding the checkpoint and other files stored next to it
+    s3Client = boto3.client('s3')
+    objects = 0
+    totalBytes = 0
+    for page in s3Client.get_paginator('list_objects_v2').paginate(Bucket=BUCKET, Prefix=destinationPath + '/'):
+        for obj in page.get('Contents', []):
+            objects += 1
+            totalBytes += obj['Size']
+
+    connection.send({
+        'status': status,
+        'seconds': round(elapsed, 3),
+        'invocations': invocations,
+        'objectsAtDestination': objects,
+        'bytesAtDestination': totalBytes,
+        'segmentsPerSecond': round(objects / elapsed, 2) if elapsed else None,
+        'megabytesPerSecond': round(totalBytes / elapsed / 1e6, 3) if elapsed else None,
+        # ru_maxrss is reported in KiB on Linux and bytes on macOS
+        'peakRssMb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                           (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+    })
+
+
+def runInChild(target, *args):
+    parentConnection, childConnection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=target, args=args + (childConnection,))
+    process.start()
+    # The child exits without sending a result if the scenario raises
+    while not parentConnection.poll(0.5):
+        if not process.is_alive():
+            raise RuntimeError('benchmark scenario failed with exit code %s' % process.exitcode)
+    result = parentConnection.recv()
+    process.join()
+    return result
+
+
+def runBenchmark(config, eventOptions=None, restartBudget=None, repeat=1):
+    """Runs the benchmark scenarios and returns the results as a dict."""
+    eventOptions = eventOptions or {}
+    multiprocessing.set_start_method('spawn', force=True)
+
+    motoProcess, endpoint = startMotoServer()
+    originConnection, originChildConnection = multiprocessing.Pipe()
+    originProcess = multiprocessing.Process(target=serveOrigin, args=(config, originChildConnection))
+    originProcess.start()
+    previousEndpoint = os.environ.get('AWS_ENDPOINT_URL')
+    try:
+        sourceUrl = originConnection.recv()
+        os.environ['AWS_ENDPOINT_URL'] = endpoint
+        import boto3
+        boto3.client('s3').create_bucket(Bucket=BUCKET)
+
+        runs = []
+        for run in range(repeat):
+            runs.append(runInChild(runScenario, endpoint, sourceUrl, 'full-%d' % run, eventOptions, None))
+        results = {'full': runs}
+
+        if restartBudget:
+            restart = runInChild(runScenario, endpoint, sourceUrl, 'restart', eventOptions, restartBudget)
+            best = min(runs, key=lambda r: r['seconds'])
+            restart['restartOverheadSeconds'] = round(restart['seconds'] - best['seconds'], 3)
+            restart['restartOverheadPerInvocationSeconds'] = round(
+                restart['restartOverheadSeconds'] / max(1, len(restart['invocations']) - 1), 3)
+            results['restart'] = restart
+    finally:
+        if previousEndpoint is None:
+            os.environ.pop('AWS_ENDPOINT_URL', None)
+        else:
+            os.environ['AWS_ENDPOINT_URL'] = previousEndpoint
+        originConnection.send('stop')
+        originProcess.join()
+        motoProcess.terminate()
+        motoProcess.wait()
+
+    return {
+        'benchmark': 'fetchStream',
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'gitCommit': gitCommit(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpuCount': os.cpu_count(),
+        'asset': config.toDict(),
+        'expectedResources': config.totalResources,
+        'eventOptions': eventOptions,
+        'results': results
+    }
+
+
+def gitCommit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='End-to-end throughput benchmark for DownloadVod.fetchStream')
+    parser.add_argument('--format', choices=['hls', 'dash'], default='hls', help='Synthetic asset format')
+    parser.add_argument('--variants', type=int, default=3, help='Number of variants/representations')
+    parser.add_argument('--segments', type=int, default=100, help='Segments per variant')
+    parser.add_argument('--segment-size', dest='segmentSize', type=int, default=100000, help='Segment size in bytes')
+    parser.add_argument('--latency', type=float, default=0.0, help='Origin latency per request in seconds')
+    parser.add_argument('--error-rate', dest='errorRate', type=float, default=0.0, help='Fraction of segment requests failing with HTTP 503')
+    parser.add_argument('--event', default='{}', help='JSON object of extra fetchStream event options, e.g. \'{"numThreads": 10}\'')
+    parser.add_argument('--repeat', type=int, default=1, help='Number of uninterrupted runs')
+    parser.add_argument('--restart-budget', dest='restartBudget', type=float, default=None,
+                        help='Seconds each invocation may run before the simulated Lambda deadline (enables the restart scenario)')
+    parser.add_argument('--output', default=None, help='File to write the JSON results to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    config = AssetConfig(assetFormat=args.format, variants=args.variants, segments=args.segments,
+                         segmentSize=args.segmentSize, latency=args.latency, errorRate=args.errorRate)
+    report = runBenchmark(config, json.loads(args.event), args.restartBudget, args.repeat)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(output + '\n')
+    print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+"""Micro-benchmark for the HLS playlist parsers in HlsVodAsset.py.
+
+Generates a synthetic master playlist and variant playlist of '--lines' lines each
+and times parseMasterManifest and parseVariantManifest against the regex based
+parsers they replaced (kept below as the reference implementation). Both parsers
+must produce the same output; the benchmark reports the time taken by each and the
+speedup.
+
+Example:
+
+    python -m tests.benchmark.playlist_benchmark --lines 100000 --output playlist_bench.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+from urllib.parse import urlparse
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAMBDA_DIR = os.path.join(REPO_ROOT, 'packaged_vod_downloader', 'lambda')
+sys.path.insert(0, REPO_ROOT)
+sys.path.insert(0, LAMBDA_DIR)
+
+from HlsVodAsset import parseMasterManifest, parseVariantManifest  # noqa: E402
+
+MASTER_URL = 'https://origin.example.com/out/v1/6f1b4c2d/index.m3u8'
+VARIANT_URL = 'https://origin.example.com/out/v1/6f1b4c2d/video/index_1.m3u8'
+ATTRIBUTE_SPLIT = re.compile(r',\s*(?=(?:[^"]*"[^"]*")*[^"]*$)')
+
+
+def legacyNormalizeUrl(url):
+    parsed = urlparse(url)
+    return '%s://%s%s' % (parsed.scheme, parsed.netloc, os.path.normpath(parsed.path))
+
+
+def legacyAttributes(line):
+    attributes = {}
+    for keyValue in ATTRIBUTE_SPLIT.split(line.split(':', 1)[1]):
+        (key, value) = keyValue.split('=', 1)
+        attributes[key] = value.strip('"')
+    return attributes
+
+
+def legacyResolve(playlistUrl, name):
+    if name.startswith('http'):
+        return name
+    return legacyNormalizeUrl('%s/%s' % (os.path.dirname(playlistUrl), name))
+
+
+def legacyParseMasterManifest(masterUrl, body):
+    variants = {}
+    for line in body.splitlines():
+        name = None
+        if line.startswith('#EXT-X-MEDIA:') or line.startswith('#EXT-X-I-FRAME-STREAM-INF:'):
+            name = legacyAttributes(line)['URI']
+        elif line and line[0] != '#':
+            name = line
+        if name:
+            variants.setdefault(legacyResolve(masterUrl, name), 1)
+    return list(variants)
+
+
+def legacyParseVariantManifest(variantUrl, body):
+    segments = {}
+    byteRangeEnds = {}
+    byteRange = None
+    for line in body.splitlines():
+        name = None
+        nameByteRange = None
+        if line.startswith('#EXT-X-MAP:') or line.startswith('#EXT-X-I-FRAME-STREAM-INF:'):
+            attributes = legacyAttributes(line)
+            name = attributes['URI']
+            nameByteRange = attributes.get('BYTERANGE')
+        elif line.startswith('#EXT-X-BYTERANGE:'):
+            byteRange = line.split(':', 1)[1]
+        elif line[0] != '#':
+            name = line
+            nameByteRange = byteRange
+            byteRange = None
+        if not name:
+            continue
+        absoluteUrl = legacyResolve(variantUrl, name)
+        segments.setdefault(absoluteUrl, 1)
+        if nameByteRange:
+            (length, _, offset) = nameByteRange.partition('@')
+            previousEnd = byteRangeEnds.get(absoluteUrl, 0)
+            start = int(offset) if offset else previousEnd
+            byteRangeEnds[absoluteUrl] = max(previousEnd, start + int(length))
+    return (list(segments), byteRangeEnds)
+
+
+def syntheticMasterPlaylist(lines):
+    """Returns a master playlist of about 'lines' lines of renditions with long attribute lists."""
+    playlist = ['#EXTM3U', '#EXT-X-VERSION:6', '#EXT-X-INDEPENDENT-SEGMENTS']
+    index = 0
+    while len(playlist) < lines:
+        playlist.append('#EXT-X-MEDIA:TYPE=AUDIO,GROUP-ID="audio_%d",CHANNELS="2",NAME="Audio, track %d",'
+                        'LANGUAGE="en",DEFAULT=NO,AUTOSELECT=YES,CHARACTERISTICS="public.accessibility,x",'
+                        'URI="../../audio/%d/index.m3u8"' % (index, index, index))
+        playlist.append('#EXT-X-STREAM-INF:BANDWIDTH=%d,AVERAGE-BANDWIDTH=%d,CODECS="avc1.640029,mp4a.40.2",'
+                        'RESOLUTION=1920x1080,FRAME-RATE=29.970,AUDIO="audio_%d"' % (5000000 + index, 4000000 + index, index))
+        playlist.append('video/%d/index.m3u8' % index)
+        index += 1
+    return '\n'.join(playlist[:lines]) + '\n'
+
+
+def syntheticVariantPlaylist(lines):
+    """Returns a variant playlist of about 'lines' lines of segments, some of them byte ranges."""
+    playlist = ['#EXTM3U', '#EXT-X-VERSION:7', '#EXT-X-TARGETDURATION:6', '#EXT-X-PLAYLIST-TYPE:VOD',
+                '#EXT-X-MAP:URI="../../../init/9c0e1a7b/index_video_init.mp4"']
+    index = 0
+    while len(playlist) < lines:
+        playlist.append('#EXTINF:6.006,')
+        if index % 10 == 0:
+            playlist.append('#EXT-X-BYTERANGE:1048576@%d' % (index // 10 * 1048576))
+            playlist.append('../../../bf4fc289/75449fe7/ranges_%d.mp4' % (index // 1000))
+        else:
+            playlist.append('../../../bf4fc289/75449fe7/segments/%d/index_1_%d.ts' % (index // 1000, index))
+        index += 1
+    playlist.append('#EXT-X-ENDLIST')
+    return '\n'.join(playlist) + '\n'
+
+
+def timeParser(parse, url, body, repeat):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = parse(url, body)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return (output, best)
+
+
+def runPlaylistBenchmark(lines, repeat=3):
+    cases = [
+        ('master', MASTER_URL, syntheticMasterPlaylist(lines),
+         legacyParseMasterManifest, parseMasterManifest),
+        ('variant', VARIANT_URL, syntheticVariantPlaylist(lines),
+         legacyParseVariantManifest, parseVariantManifest),
+    ]
+    results = {}
+    for (name, url, body, legacyParse, parse) in cases:
+        (legacyOutput, legacySeconds) = timeParser(legacyParse, url, body, repeat)
+        (output, seconds) = timeParser(parse, url, body, repeat)
+        results[name] = {
+            'lines': len(body.splitlines()),
+            'outputMatches': output == legacyOutput,
+            'legacySeconds': round(legacySeconds, 4),
+            'seconds': round(seconds, 4),
+            'speedup': round(legacySeconds / seconds, 2),
+        }
+    return {
+        'python': platform.python_version(),
+        'repeat': repeat,
+        'results': results,
+    }
+
+
+def parseArgs(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmark for the HLS playlist parsers')
+    parser.add_argument('--lines', type=int, default=100000, help='Lines in each synthetic playlist')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs of each parser, the fastest is reported')
+    parser.add_argument('--output', default=None, help='File to write the JSON results to')
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parseArgs(argv)
+    report = runPlaylistBenchmark(args.lines, args.repeat)
+    output = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as outputFile:
+            outputFile.write(output + '\n')
+    print(output)
+    return report
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,196 @@
+"""Local HTTP origin serving synthetic HLS and DASH assets for benchmarks.
+
+Segment bodies are slices of one shared random buffer, so large assets can be
+served without holding every segment in memory. Each segment still has its own
+ETag, and the origin supports Range and If-None-Match requests like a real
+packager or CDN.
+"""
+
+import http.server
+import os
+import random
+import re
+import threading
+import time
+import zlib
+
+HLS_MASTER_PATH = '/out/hls/master.m3u8'
+DASH_MANIFEST_PATH = '/out/dash/index.mpd'
+DASH_SEGMENT_DURATION = 2  # seconds
+
+
+class AssetConfig:
+
+    def __init__(self, assetFormat='hls', variants=3, segments=100, segmentSize=100000,
+                 latency=0.0, errorRate=0.0):
+        self.assetFormat = assetFormat
+        self.variants = variants
+        self.segments = segments
+        self.segmentSize = segmentSize
+        self.latency = latency          # seconds added to every response
+        self.errorRate = errorRate    # fraction of segment requests answered with HTTP 503
+
+    def toDict(self):
+        return dict(vars(self))
+
+    @property
+    def manifestPath(self):
+        return HLS_MASTER_PATH if self.assetFormat == 'hls' else DASH_MANIFEST_PATH
+
+    @property
+    def totalResources(self):
+        # The top level manifest, then for each variant the segments plus either
+        # the variant playlist (HLS) or the init segment (DASH)
+        return 1 + self.variants * (1 + self.segments)
+
+    @property
+    def totalBytes(self):
+        return self.variants * self.segments * self.segmentSize
+
+
+def buildManifests(config):
+    """Returns a dict mapping manifest paths to manifest bodies."""
+    if config.assetFormat == 'hls':
+        master = ['#EXTM3U']
+        manifests = {}
+        for variant in range(config.variants):
+            master.append('#EXT-X-STREAM-INF:BANDWIDTH=%d,CODECS="avc1.64001f,mp4a.40.2"' % ((variant + 1) * 1000000))
+            master.append('v%d/index.m3u8' % variant)
+            playlist = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6', '#EXT-X-PLAYLIST-TYPE:VOD']
+            for segment in range(config.segments):
+                playlist.append('#EXTINF:6.0,')
+                playlist.append('seg_%d.ts' % segment)
+            playlist.append('#EXT-X-ENDLIST')
+            manifests['/out/hls/v%d/index.m3u8' % variant] = ('\n'.join(playlist) + '\n').encode()
+        manifests[HLS_MASTER_PATH] = ('\n'.join(master) + '\n').encode()
+        return manifests
+
+    representations = ''.join(
+        '<Representation id="v%d" bandwidth="%d" width="1280" height="720"/>' % (variant, (variant + 1) * 1000000)
+        for variant in range(config.variants))
+    mpd = (
+        '<?xml version="1.0" encoding="UTF-8"?>\n'
+        '<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" '
+        'mediaPresentationDuration="PT%dS" minBufferTime="PT2S" '
+        'profiles="urn:mpeg:dash:profile:isoff-live:2011">\n'
+        '<Period id="1" start="PT0S" duration="PT%dS">\n'
+        '<AdaptationSet mimeType="video/mp4" segmentAlignment="true">\n'
+        '<SegmentTemplate timescale="1" duration="%d" startNumber="1" '
+        'media="$RepresentationID$/seg_$Number$.mp4" initialization="$RepresentationID$/init.mp4"/>\n'
+        '%s\n'
+        '</AdaptationSet>\n'
+        '</Period>\n'
+        '</MPD>\n'
+    ) % (config.segments * DASH_SEGMENT_DURATION, config.segments * DASH_SEGMENT_DURATION,
+         DASH_SEGMENT_DURATION, representations)
+    return {DASH_MANIFEST_PATH: mpd.encode()}
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        config = server.config
+        if config.latency:
+            time.sleep(config.latency)
+
+        path = self.path.split('?')[0]
+        body = server.manifests.get(path)
+        if body is not None:
+            contentType = 'application/dash+xml' if path.endswith('.mpd') else 'application/x-mpegURL'
+        else:
+            body = server.getSegment(path)
+            if body is None:
+                self.sendEmpty(404)
+                return
+            if config.errorRate and random.random() < config.errorRate:
+                self.sendEmpty(503, {'Retry-After': '0'})
+                return
+            contentType = 'video/MP2T' if path.endswith('.ts') else 'video/mp4'
+
+        etag = '"%08x-%d"' % (zlib.crc32(path.encode()), len(body))
+        if self.headers.get('If-None-Match') == etag:
+            self.sendEmpty(304, {'ETag': etag})
+            return
+
+        status = 200
+        headers = {'Content-Type': contentType, 'ETag': etag}
+        byteRange = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if byteRange:
+            first = int(byteRange.group(1))
+            last = min(int(byteRange.group(2) or len(body) - 1), len(body) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (first, last, len(body))
+            body = body[first:last + 1]
+            status = 206
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendEmpty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+class SyntheticOrigin:
+    """Threaded HTTP server for one synthetic asset. Use as a context manager."""
+
+    SEGMENT_PATTERN = re.compile(r'^/out/(hls|dash)/v(\d+)/(seg_(\d+)\.(ts|mp4)|init\.mp4)$')
+
+    def __init__(self, config, host='127.0.0.1', port=0):
+        self.config = config
+        self.server = http.server.ThreadingHTTPServer((host, port), OriginHandler)
+        self.server.daemon_threads = True
+        self.server.config = config
+        self.server.manifests = buildManifests(config)
+        self.server.getSegment = self.getSegment
+        # Each segment is a different slice of a buffer twice the segment size
+        self.buffer = os.urandom(max(2 * config.segmentSize, 1024))
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, self.config.manifestPath)
+
+    def getSegment(self, path):
+        match = self.SEGMENT_PATTERN.match(path)
+        if not match or match.group(1) != self.config.assetFormat:
+            return None
+        variant = int(match.group(2))
+        if variant >= self.config.variants:
+            return None
+        if match.group(4) is None:
+            return self.buffer[:1024]
+        segment = int(match.group(4))
+        if self.config.assetFormat == 'dash':
+            segment -= 1  # $Number$ starts at 1
+        if not 0 <= segment < self.config.segments:
+            return None
+        offset = (variant * 7919 + segment * 104729) % self.config.segmentSize
+        return self.buffer[offset:offset + self.config.segmentSize]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -0,0 +1,26 @@
+import pytest
+
+pytest.importorskip('moto.server')
+
+from tests.benchmark.benchmark import runBenchmark
+from tests.benchmark.synthetic_origin import AssetConfig
+
+
+@pytest.mark.parametrize('assetFormat', ['hls', 'dash'])
+def test_benchmarkDownloadsWholeAsset(assetFormat, monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    config = AssetConfig(assetFormat=assetFormat, variants=2, segments=5, segmentSize=2000)
+
+    report = runBenchmark(config, {'numThreads': 2}, restartBudget=0.2)
+
+    full = report['results']['full'][0]
+    assert full['status'] == 'COMPLETE'
+    assert full['objectsAtDestination'] == config.totalResources
+    assert full['segmentsPerSecond'] > 0
+    assert full['peakRssMb'] > 0
+    restart = report['results']['restart']
+    assert restart['status'] == 'COMPLETE'
+    assert restart['objectsAtDestination'] == config.totalResources
+    assert 'restartOverheadSeconds' in restart
@@ -0,0 +1,11 @@
+from tests.benchmark.playlist_benchmark import runPlaylistBenchmark
+
+
+def test_playlistParsersMatchLegacyOutput():
+    report = runPlaylistBenchmark(lines=5000, repeat=1)
+
+    for name in ('master', 'variant'):
+        result = report['results'][name]
+        assert result['outputMatches']
+        assert result['lines'] >= 5000
+        assert result['speedup'] > 0
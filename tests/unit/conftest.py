@@ -0,0 +1,132 @@
+# Fixtures shared by the unit tests of the download lambda.
+#
+# The lambda modules import each other by name (as they do in the Lambda runtime),
+# so the lambda directory is added to the module search path.
+
+import http.server
+import os
+import re
+import sys
+import threading
+import zlib
+
+import pytest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+LAMBDA_DIR = os.path.join(REPO_ROOT, 'packaged_vod_downloader', 'lambda')
+sys.path.insert(0, LAMBDA_DIR)
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    # Serves the files of a TestOrigin. Like a packager or CDN the origin returns an
+    # ETag with every file and supports If-None-Match and Range requests.
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        path = self.path.split('?')[0]
+        self.server.requests.append((path, self.headers.get('Range')))
+        body = self.server.files.get(path)
+        if body is None:
+            self.sendEmpty(404)
+            return
+
+        eTag = '"%08x-%d"' % (zlib.crc32(body), len(body))
+        if self.headers.get('If-None-Match') == eTag:
+            self.sendEmpty(304, {'ETag': eTag})
+            return
+
+        status = 200
+        headers = {'Content-Type': getContentType(path), 'ETag': eTag}
+        byteRange = re.match(r'bytes=(\d+)-(\d*)$', self.headers.get('Range', ''))
+        if byteRange:
+            firstByte = int(byteRange.group(1))
+            lastByte = min(int(byteRange.group(2) or len(body) - 1), len(body) - 1)
+            headers['Content-Range'] = 'bytes %d-%d/%d' % (firstByte, lastByte, len(body))
+            body = body[firstByte:lastByte + 1]
+            status = 206
+
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def sendEmpty(self, status, headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+
+def getContentType(path):
+    if path.endswith('.m3u8'):
+        return 'application/x-mpegURL'
+    if path.endswith('.mpd'):
+        return 'application/dash+xml'
+    return 'video/MP2T' if path.endswith('.ts') else 'video/mp4'
+
+
+class TestOrigin:
+    # Local HTTP origin serving the bodies in 'files' (a dict of path to bytes). Files
+    # can be added, changed or removed while the origin is running. Each request is
+    # recorded in 'requests' as a tuple of ( path, Range header ).
+    __test__ = False
+
+    def __init__(self):
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), OriginHandler)
+        self.server.daemon_threads = True
+        self.server.files = {}
+        self.server.requests = []
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def files(self):
+        return self.server.files
+
+    @property
+    def requests(self):
+        return self.server.requests
+
+    def url(self, path):
+        host, port = self.server.server_address[:2]
+        return 'http://%s:%d%s' % (host, port, path)
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def addHlsAsset(origin, variants=2, segments=4, segmentSize=1000, root='/out/asset'):
+    # Adds an HLS asset of 'variants' variant playlists of 'segments' segments each and
+    # returns the URL of the master playlist
+    master = ['#EXTM3U']
+    for variant in range(variants):
+        master.append('#EXT-X-STREAM-INF:BANDWIDTH=%d' % ((variant + 1) * 1000000))
+        master.append('v%d/index.m3u8' % variant)
+        setHlsVariant(origin, variant, segments, segmentSize, root)
+    origin.files[root + '/master.m3u8'] = ('\n'.join(master) + '\n').encode()
+    return origin.url(root + '/master.m3u8')
+
+
+def setHlsVariant(origin, variant, segments, segmentSize=1000, root='/out/asset'):
+    # Adds (or replaces) a variant playlist and its segments
+    playlist = ['#EXTM3U', '#EXT-X-VERSION:3', '#EXT-X-TARGETDURATION:6', '#EXT-X-PLAYLIST-TYPE:VOD']
+    for segment in range(segments):
+        playlist.append('#EXTINF:6.0,')
+        playlist.append('s%d.ts' % segment)
+        origin.files['%s/v%d/s%d.ts' % (root, variant, segment)] = bytes([variant, segment]) * (segmentSize // 2)
+    playlist.append('#EXT-X-ENDLIST')
+    origin.files['%s/v%d/index.m3u8' % (root, variant)] = ('\n'.join(playlist) + '\n').encode()
+
+
+@pytest.fixture
+def origin():
+    testOrigin = TestOrigin()
+    yield testOrigin
+    testOrigin.stop()
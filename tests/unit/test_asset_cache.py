@@ -0,0 +1,62 @@
+import urllib3
+
+from AssetCache import loadAssetCache, saveAssetCache
+from LocalWriter import LocalWriter
+from ProgressJournal import JournalVodAsset
+from ResourceTable import ResourceSizes, ResourceTable
+from tests.unit.conftest import addHlsAsset
+
+
+def makeAsset(origin, sourceUrl, validators):
+    resources = ResourceTable()
+    resources.extend([sourceUrl, origin.url('/out/asset/v0/index.m3u8'), origin.url('/out/asset/v0/s0.ts')])
+    sizes = ResourceSizes()
+    sizes.set(2, 1000)
+    return JournalVodAsset(sourceUrl, origin.url('/out/asset/'), resources, sizes, [], validators)
+
+
+def getETag(sourceUrl):
+    return urllib3.PoolManager().request('GET', sourceUrl).headers['ETag']
+
+
+def test_cacheIsUsedWhileMasterManifestIsUnchanged(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=1, segments=1)
+    writer = LocalWriter(str(tmp_path))
+    saveAssetCache(writer, None, 'asset', sourceUrl, 'hls', makeAsset(origin, sourceUrl, {'ETag': getETag(sourceUrl)}))
+
+    cachedAsset = loadAssetCache(writer, None, 'asset', sourceUrl, urllib3.PoolManager(), None)
+
+    ( vodAsset, vodAssetType ) = cachedAsset
+    assert vodAssetType == 'hls'
+    assert list(vodAsset.allResources)[2] == origin.url('/out/asset/v0/s0.ts')
+    assert vodAsset.resourceSizes.get(2) == 1000
+    # The master manifest was only validated, not fetched again
+    assert len(origin.requests) == 2
+
+
+def test_cacheIsIgnoredWhenMasterManifestChanges(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=1, segments=1)
+    writer = LocalWriter(str(tmp_path))
+    saveAssetCache(writer, None, 'asset', sourceUrl, 'hls', makeAsset(origin, sourceUrl, {'ETag': getETag(sourceUrl)}))
+
+    addHlsAsset(origin, variants=2, segments=1)
+
+    assert loadAssetCache(writer, None, 'asset', sourceUrl, urllib3.PoolManager(), None) is None
+
+
+def test_cacheIsIgnoredForAnotherSource(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=1, segments=1)
+    writer = LocalWriter(str(tmp_path))
+    saveAssetCache(writer, None, 'asset', sourceUrl, 'hls', makeAsset(origin, sourceUrl, {'ETag': getETag(sourceUrl)}))
+
+    assert loadAssetCache(writer, None, 'asset', sourceUrl + '?v=2', urllib3.PoolManager(), None) is None
+
+
+def test_assetWithoutValidatorsIsNotCached(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=1, segments=1)
+    writer = LocalWriter(str(tmp_path))
+
+    # There would be no way to tell whether the cache is stale
+    saveAssetCache(writer, None, 'asset', sourceUrl, 'hls', makeAsset(origin, sourceUrl, {}))
+
+    assert not (tmp_path / 'asset.asset.json.gz').exists()
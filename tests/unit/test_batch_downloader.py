@@ -0,0 +1,82 @@
+import os
+
+import DownloadVod
+from BatchDownloader import MAX_SLICES_WITHOUT_PROGRESS, SliceContext, runBatch
+from tests.unit.test_download_vod import addSingleFileAsset, getDestPath
+
+
+def makeFetchStream(slicesByJob):
+    # Returns a fetchStream which takes 'slicesByJob[source_url]' slices to finish each
+    # job, copying one segment per slice. A count of None never copies anything.
+    calls = []
+
+    def fetchStream(event, context, shared):
+        sourceUrl = event['source_url']
+        calls.append(sourceUrl)
+        slices = slicesByJob[sourceUrl]
+        if slices is None:
+            return {'status': 200, 'result': {'status': 'LAMBDA_TIMEOUT', 'totalDownloadedSegments': 0}}
+        slicesByJob[sourceUrl] -= 1
+        status = 'COMPLETE' if slices == 1 else 'LAMBDA_TIMEOUT'
+        return {'status': 200, 'result': {'status': status, 'totalDownloadedSegments': 1}}
+
+    return fetchStream, calls
+
+
+def test_jobsTakeTurns():
+    fetchStream, calls = makeFetchStream({'a': 3, 'b': 1, 'c': 2})
+    results = []
+
+    summary = runBatch([{'source_url': 'a'}, {'source_url': 'b'}, {'source_url': 'c'}], {},
+                       fetchStream, results.append, 60, 0)
+
+    assert calls == ['a', 'b', 'c', 'a', 'c', 'a']
+    assert [(result['source_url'], result['slices']) for result in results] == [('b', 1), ('c', 2), ('a', 3)]
+    assert results[2]['totalDownloadedSegments'] == 3
+    assert summary['status'] == 'COMPLETE'
+    assert summary['completeJobs'] == 3
+
+
+def test_jobWithoutProgressIsFinished():
+    fetchStream, calls = makeFetchStream({'stuck': None, 'ok': 2})
+    results = []
+
+    summary = runBatch([{'source_url': 'stuck'}, {'source_url': 'ok'}], {}, fetchStream, results.append, 60, 0)
+
+    assert calls.count('stuck') == MAX_SLICES_WITHOUT_PROGRESS
+    stuckResult = [result for result in results if result['source_url'] == 'stuck'][0]
+    assert stuckResult['status'] == 'INCOMPLETE'
+    assert 'message' in stuckResult
+    assert summary['status'] == 'INCOMPLETE'
+    assert summary['completeJobs'] == 1
+
+
+def test_sliceContextEndsWithSlice():
+    context = SliceContext(10, 5000)
+
+    assert 14000 < context.get_remaining_time_in_millis() <= 15000
+    assert context.invocationContext is None
+    assert SliceContext(0, 5000).get_remaining_time_in_millis() == float('inf')
+
+
+def test_largeFileIsCopiedAcrossSliceEnd(origin, tmp_path):
+    # The byte rate limit means copying the file takes longer than a slice, and the
+    # ranges are fetched one at a time so the later ones start after the slice has ended
+    body = os.urandom(32 * 1024 * 1024)
+    sourceUrl = addSingleFileAsset(origin, body)
+
+    output = DownloadVod.fetchBatch({
+        'jobs': [{'source_url': sourceUrl, 'destination_path': 'asset'}],
+        'destination_dir': str(tmp_path),
+        'sliceSeconds': 1,
+        'rpsLimit': 0,
+        'bytesPerSecondLimit': 12 * 1024 * 1024,
+        'rangeConcurrency': 1,
+        'emitMetrics': False
+    }, None)
+
+    assert output['result']['status'] == 'COMPLETE'
+    with open(getDestPath(tmp_path, '/out/asset/main.mp4'), 'rb') as destFile:
+        assert destFile.read() == body
+    # The ranges were only fetched once
+    assert len([path for path, byteRange in origin.requests if byteRange]) == 4
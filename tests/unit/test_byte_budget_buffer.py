@@ -0,0 +1,74 @@
+import os
+import threading
+import time
+
+from ByteBudgetBuffer import ByteBudgetBuffer
+
+
+def test_bodiesAreReturnedInOrder():
+    buffer = ByteBudgetBuffer(1000)
+    buffer.put('a', b'1' * 100)
+    buffer.put('b', b'2' * 200)
+    buffer.close()
+
+    assert buffer.get() == ('a', b'1' * 100)
+    assert buffer.get() == ('b', b'2' * 200)
+    # Closed and empty
+    assert buffer.get() is None
+
+
+def test_producerWaitsUntilMemoryIsReleased():
+    buffer = ByteBudgetBuffer(300)
+    buffer.put('a', b'1' * 200)
+    added = threading.Event()
+
+    def producer():
+        buffer.put('b', b'2' * 200)
+        added.set()
+
+    thread = threading.Thread(target=producer)
+    thread.start()
+    # Taking a body does not free its memory, only releasing it does
+    ( item, body ) = buffer.get()
+    time.sleep(0.1)
+    assert not added.is_set()
+
+    buffer.release(len(body))
+    thread.join(5)
+    assert added.is_set()
+    assert buffer.getSummary()['uploadBufferPeakBytes'] == 200
+
+
+def test_largeBodyIsAcceptedWhenMemoryIsEmpty():
+    buffer = ByteBudgetBuffer(100)
+
+    buffer.put('a', b'1' * 1000)
+
+    assert buffer.get() == ('a', b'1' * 1000)
+
+
+def test_bodiesSpillToDiskWhenMemoryIsFull(tmp_path):
+    buffer = ByteBudgetBuffer(100, str(tmp_path), spillBytes=1000)
+    buffer.put('a', b'1' * 100)
+    buffer.put('b', b'2' * 300)
+
+    assert len(os.listdir(str(tmp_path))) == 1
+    assert buffer.get() == ('a', b'1' * 100)
+    assert buffer.get() == ('b', b'2' * 300)
+    # The spill file is removed once the body has been read back
+    assert os.listdir(str(tmp_path)) == []
+    summary = buffer.getSummary()
+    assert summary['uploadBufferSpilledObjects'] == 1
+    assert summary['uploadBufferSpilledBytes'] == 300
+
+
+def test_closeWakesWaitingConsumers():
+    buffer = ByteBudgetBuffer(100)
+    results = []
+    thread = threading.Thread(target=lambda: results.append(buffer.get()))
+    thread.start()
+
+    buffer.close()
+    thread.join(5)
+
+    assert results == [None]
@@ -0,0 +1,86 @@
+import threading
+import time
+
+from ConcurrencyController import AimdConcurrencyController
+
+
+def test_healthyWindowIncreasesLimit():
+    controller = AimdConcurrencyController(minConcurrency=2, maxConcurrency=10)
+
+    for _ in range(10):
+        controller.recordResult(0.05, 200)
+
+    assert controller.limit == 3
+    assert controller.getSummary()['concurrencyTrajectory'][-1]['reason'] == 'healthy'
+
+
+def test_slowWindowDecreasesLimit():
+    controller = AimdConcurrencyController(minConcurrency=2, maxConcurrency=10, initialConcurrency=6,
+                                           latencyTargetMs=100)
+
+    for _ in range(12):
+        controller.recordResult(0.5, 200)
+
+    assert controller.limit == 5
+
+
+def test_congestionBacksOffOncePerWindow():
+    controller = AimdConcurrencyController(minConcurrency=1, maxConcurrency=64, initialConcurrency=64)
+
+    # Requests already in flight when origin started throttling do not collapse the limit
+    for _ in range(5):
+        controller.recordResult(0.05, 503)
+
+    assert controller.limit == 32
+
+
+def test_sustainedCongestionKeepsBackingOff():
+    controller = AimdConcurrencyController(minConcurrency=1, maxConcurrency=64, initialConcurrency=64)
+
+    # Throttled requests count towards each window, so the limit is reduced again
+    # after every window rather than only once
+    for _ in range(200):
+        controller.recordResult(0.05, 429)
+
+    assert controller.limit == 1
+    reasons = [entry['reason'] for entry in controller.getSummary()['concurrencyTrajectory']]
+    assert reasons.count('congestion') >= 3
+
+
+def test_timeoutsCountAsCongestion():
+    controller = AimdConcurrencyController(minConcurrency=2, maxConcurrency=10, initialConcurrency=8)
+
+    controller.recordResult(10, None)
+
+    assert controller.limit == 4
+
+
+def test_acquireWaitsForRelease():
+    controller = AimdConcurrencyController(minConcurrency=1, maxConcurrency=1)
+    controller.acquire()
+    acquired = threading.Event()
+
+    def worker():
+        controller.acquire()
+        acquired.set()
+        controller.release()
+
+    thread = threading.Thread(target=worker)
+    thread.start()
+    time.sleep(0.1)
+    assert not acquired.is_set()
+
+    controller.release()
+    thread.join(5)
+    assert acquired.is_set()
+
+
+def test_acquireTimesOut():
+    controller = AimdConcurrencyController(minConcurrency=1, maxConcurrency=1)
+    assert controller.acquire()
+
+    # No slot is released before the timeout
+    start = time.time()
+    assert not controller.acquire(timeout=0.1)
+    assert time.time() - start < 5
+    assert controller.active == 1
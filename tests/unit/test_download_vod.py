@@ -0,0 +1,287 @@
+# End to end tests of DownloadVod.fetchStream copying assets from a local test origin
+# to a local destination directory
+
+import json
+import os
+import threading
+
+import DownloadVod
+from tests.unit.conftest import addHlsAsset, setHlsVariant
+
+
+def makeEvent(sourceUrl, destDir, **options):
+    event = {
+        'source_url': sourceUrl,
+        'destination_dir': str(destDir),
+        'destination_path': 'asset',
+        'rpsLimit': 0,
+        'numThreads': 2,
+        'emitMetrics': False
+    }
+    event.update(options)
+    return event
+
+
+def getDestPath(destDir, originPath, root='/out/asset'):
+    return os.path.join(str(destDir), 'asset', *originPath[len(root) + 1:].split('/'))
+
+
+def truncate(path, size):
+    with open(path, 'r+b') as destFile:
+        destFile.truncate(size)
+
+
+def addSingleFileAsset(origin, body):
+    # An HLS asset with one variant whose segments are byte ranges of a single file
+    origin.files['/out/asset/main.mp4'] = body
+    origin.files['/out/asset/master.m3u8'] = b'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000000\nindex.m3u8\n'
+    segmentSize = (len(body) - 1000) // 2
+    origin.files['/out/asset/index.m3u8'] = (
+        '#EXTM3U\n#EXT-X-VERSION:4\n#EXT-X-MAP:URI="main.mp4",BYTERANGE="1000@0"\n'
+        '#EXTINF:6.0,\n#EXT-X-BYTERANGE:%d@1000\nmain.mp4\n'
+        '#EXTINF:6.0,\n#EXT-X-BYTERANGE:%d\nmain.mp4\n#EXT-X-ENDLIST\n' % (segmentSize, segmentSize)).encode()
+    return origin.url('/out/asset/master.m3u8')
+
+
+def test_copiesAsset(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+
+    output = DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path), None)
+
+    assert output['status'] == 200
+    assert output['result']['status'] == 'COMPLETE'
+    assert output['result']['objectsAtS3Dest'] == 9
+    for path, body in origin.files.items():
+        with open(getDestPath(tmp_path, path), 'rb') as destFile:
+            assert destFile.read() == body
+    # Validators of the resources are only kept in sync mode
+    assert not (tmp_path / 'asset.sync.json.gz').exists()
+
+
+def test_truncatedObjectIsFetchedAgain(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+    event = makeEvent(sourceUrl, tmp_path)
+    assert DownloadVod.fetchStream(event, None)['result']['status'] == 'COMPLETE'
+
+    # The size of every resource copied is kept with the cached asset
+    segmentPath = getDestPath(tmp_path, '/out/asset/v1/s2.ts')
+    truncate(segmentPath, 10)
+    output = DownloadVod.fetchStream(event, None)
+
+    assert output['result']['status'] == 'COMPLETE'
+    assert output['result']['totalDownloadedSegments'] == 1
+    with open(segmentPath, 'rb') as destFile:
+        assert destFile.read() == origin.files['/out/asset/v1/s2.ts']
+
+
+def test_largerObjectIsFetchedAgain(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+    event = makeEvent(sourceUrl, tmp_path)
+    assert DownloadVod.fetchStream(event, None)['result']['status'] == 'COMPLETE'
+
+    # e.g. the object was overwritten by another copy of the asset
+    segmentPath = getDestPath(tmp_path, '/out/asset/v0/s1.ts')
+    with open(segmentPath, 'ab') as destFile:
+        destFile.write(b'extra')
+    output = DownloadVod.fetchStream(event, None)
+
+    assert output['result']['totalDownloadedSegments'] == 1
+    with open(segmentPath, 'rb') as destFile:
+        assert destFile.read() == origin.files['/out/asset/v0/s1.ts']
+
+
+def test_truncatedByteRangeFileIsFetchedAgain(origin, tmp_path):
+    # The end of the byte ranges of a file is known from the playlist
+    body = os.urandom(30000)
+    sourceUrl = addSingleFileAsset(origin, body)
+    event = makeEvent(sourceUrl, tmp_path, assetCache=False)
+    assert DownloadVod.fetchStream(event, None)['result']['status'] == 'COMPLETE'
+
+    filePath = getDestPath(tmp_path, '/out/asset/main.mp4')
+    truncate(filePath, 20000)
+    output = DownloadVod.fetchStream(event, None)
+
+    assert output['result']['totalDownloadedSegments'] == 1
+    with open(filePath, 'rb') as destFile:
+        assert destFile.read() == body
+
+
+def test_destinationErrorIsNotRetriedAsOriginFailure(origin, tmp_path, monkeypatch):
+    # The segment is larger than a part, so it is streamed using a multipart upload
+    sourceUrl = addHlsAsset(origin, variants=1, segments=1, segmentSize=DownloadVod.STREAM_PART_SIZE + 1000)
+    exitCodes = []
+
+    def failPart(*args):
+        raise OSError(28, 'No space left on device')
+
+    def exit(code):
+        exitCodes.append(code)
+        raise SystemExit(code)
+
+    monkeypatch.setattr(DownloadVod.LocalWriter, 'uploadPart', failPart)
+    monkeypatch.setattr(DownloadVod.os, '_exit', exit)
+    try:
+        DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path, transferMode='stream', rangeThreshold=0), None)
+    except SystemExit:
+        pass
+
+    # The segment was fetched once and the write failure was fatal
+    assert exitCodes == [3]
+    assert [path for path, byteRange in origin.requests].count('/out/asset/v0/s0.ts') == 1
+
+
+def test_missingVariantManifestFailsWhenPipelined(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=3, segments=3)
+    del origin.files['/out/asset/v2/index.m3u8']
+    outputs = []
+
+    # The variant manifest fails while the workers are already fetching segments
+    thread = threading.Thread(target=lambda: outputs.append(
+        DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path, pipelineManifests=True), None)), daemon=True)
+    thread.start()
+    thread.join(20)
+
+    assert not thread.is_alive()
+    assert outputs[0]['status'] == 500
+    assert outputs[0]['result']['status'] == 'FAILED'
+
+
+def test_largeSegmentIsRangedOnFirstDownload(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=1, segments=2, segmentSize=20 * 1024 * 1024)
+
+    for transferMode in ('buffered', 'stream'):
+        del origin.requests[:]
+        event = makeEvent(sourceUrl, tmp_path / transferMode, transferMode=transferMode, uploadThreads=2)
+        output = DownloadVod.fetchStream(event, None)
+
+        # The first GET of each segment reports its size, the segment is then copied in 3 ranges
+        assert output['result']['status'] == 'COMPLETE'
+        for segment in ('s0.ts', 's1.ts'):
+            byteRanges = [byteRange for path, byteRange in origin.requests if path == '/out/asset/v0/' + segment]
+            assert byteRanges.count(None) == 1
+            assert len(byteRanges) == 4
+            with open(getDestPath(tmp_path / transferMode, '/out/asset/v0/' + segment), 'rb') as destFile:
+                assert destFile.read() == origin.files['/out/asset/v0/' + segment]
+
+
+def test_smallSegmentsAreNotRanged(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+
+    output = DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path, uploadThreads=2), None)
+
+    assert output['result']['status'] == 'COMPLETE'
+    assert all(byteRange is None for path, byteRange in origin.requests)
+    # Segments went through the upload buffer
+    assert output['result']['uploadBufferPeakBytes'] > 0
+
+
+def test_rangesAreLimitedByRangeBuffer(origin, tmp_path):
+    body = os.urandom(20 * 1024 * 1024)
+    sourceUrl = addSingleFileAsset(origin, body)
+
+    # Only one range may be held in memory, so the ranges are fetched one at a time
+    output = DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path, rangeConcurrency=4, rangeBufferBytes=1), None)
+
+    assert output['result']['status'] == 'COMPLETE'
+    assert len([path for path, byteRange in origin.requests if byteRange]) == 3
+    with open(getDestPath(tmp_path, '/out/asset/main.mp4'), 'rb') as destFile:
+        assert destFile.read() == body
+
+
+def test_rangesCountTowardsAdaptiveConcurrency(origin, tmp_path, monkeypatch):
+    body = os.urandom(20 * 1024 * 1024)
+    sourceUrl = addSingleFileAsset(origin, body)
+    active = []
+    maxActive = []
+    lock = threading.Lock()
+    loadRangeWorker = DownloadVod.loadRangeWorker
+
+    def countingLoadRangeWorker(*args):
+        with lock:
+            active.append(1)
+            maxActive.append(len(active))
+        try:
+            return loadRangeWorker(*args)
+        finally:
+            with lock:
+                active.pop()
+
+    monkeypatch.setattr(DownloadVod, 'loadRangeWorker', countingLoadRangeWorker)
+    event = makeEvent(sourceUrl, tmp_path, rangeConcurrency=4, concurrencyMode='adaptive', minThreads=1, maxThreads=1)
+    output = DownloadVod.fetchStream(event, None)
+
+    # The controller only allows one request to origin at a time
+    assert output['result']['status'] == 'COMPLETE'
+    assert len(maxActive) == 3
+    assert max(maxActive) == 1
+
+
+def test_shardResultIsSmall(origin, tmp_path):
+    # The segments are never fetched, so only the playlists are added to the origin
+    origin.files['/out/asset/master.m3u8'] = b'#EXTM3U\n#EXT-X-STREAM-INF:BANDWIDTH=1000000\nindex.m3u8\n'
+    origin.files['/out/asset/index.m3u8'] = ('#EXTM3U\n#EXT-X-TARGETDURATION:6\n%s#EXT-X-ENDLIST\n' % ''.join(
+        '#EXTINF:6.0,\ns%d.ts\n' % segment for segment in range(100000))).encode()
+    sourceUrl = origin.url('/out/asset/master.m3u8')
+
+    class DeadlineReachedContext:
+        def get_remaining_time_in_millis(self):
+            return 0
+
+    # Nothing is copied before the deadline, so every resource of the shard is pending
+    event = makeEvent(sourceUrl, tmp_path, shardCount=4, shardIndex=1)
+    output = DownloadVod.fetchStream(event, DeadlineReachedContext())
+
+    assert output['result']['status'] == 'LAMBDA_TIMEOUT'
+    assert output['result']['totalPendingResources'] == output['result']['shardResources'] > 20000
+    assert len(output['result']['pendingResourceRanges']) == DownloadVod.MAX_SHARD_PENDING_RANGES
+    assert output['result']['pendingResourceRangesTruncated']
+    assert len(json.dumps(output)) < 16 * 1024
+
+
+def test_shardsReadThePreparedAsset(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+
+    output = DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path, mode='sync', shardCount=2, prepareAsset=True), None)
+    assert output['result'] == {'status': 'PREPARED', 'totalResources': 9}
+    assert (tmp_path / 'asset.asset.json.gz').exists()
+
+    for shardIndex in range(2):
+        event = makeEvent(sourceUrl, tmp_path, mode='sync', shardCount=2, shardIndex=shardIndex, assetPrepared=True)
+        assert DownloadVod.fetchStream(event, None)['result']['status'] == 'COMPLETE'
+
+    # The variant playlists were parsed once by the prepare step and copied once by their shard
+    paths = [path for path, byteRange in origin.requests]
+    assert paths.count('/out/asset/v0/index.m3u8') == 2
+    assert paths.count('/out/asset/v1/index.m3u8') == 2
+
+
+def test_syncCopiesSegmentsAddedToVariant(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+    event = makeEvent(sourceUrl, tmp_path, mode='sync')
+    assert DownloadVod.fetchStream(event, None)['result']['status'] == 'COMPLETE'
+
+    # The master manifest (and therefore the cached asset) is unchanged
+    setHlsVariant(origin, 1, segments=5)
+    output = DownloadVod.fetchStream(event, None)
+
+    assert output['result']['status'] == 'COMPLETE'
+    assert output['result']['totalDownloadedSegments'] == 3
+    for segment in (3, 4):
+        assert os.path.exists(getDestPath(tmp_path, '/out/asset/v1/s%d.ts' % segment))
+    # Unchanged segments were only validated
+    assert output['result']['totalUnchangedSegments'] == 8
+
+
+def test_verifyWithoutRpsLimit(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+    assert DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path), None)['result']['status'] == 'COMPLETE'
+    os.remove(getDestPath(tmp_path, '/out/asset/v0/s1.ts'))
+
+    # The same payload as the 'Verify Asset Download' state of the workflow
+    event = makeEvent(sourceUrl, tmp_path, mode='verify')
+    del event['rpsLimit']
+    output = DownloadVod.fetchStream(event, None)
+
+    assert output['status'] == 200
+    assert output['result']['status'] == 'INCOMPLETE'
+    assert not os.path.exists(getDestPath(tmp_path, '/out/asset/v0/s1.ts'))
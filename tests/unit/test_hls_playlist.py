@@ -0,0 +1,62 @@
+from HlsPlaylist import UriResolver, normalizeUrl, parseAttributeList
+from HlsVodAsset import parseVariantManifest
+
+PLAYLIST_URL = 'https://origin.example.com/out/v1/asset/index.m3u8'
+
+
+def test_attributesAreSplitOnCommas():
+    assert parseAttributeList('BANDWIDTH=2000000,RESOLUTION=1280x720,FRAME-RATE=29.970') == {
+        'BANDWIDTH': '2000000', 'RESOLUTION': '1280x720', 'FRAME-RATE': '29.970'}
+
+
+def test_quotedValuesKeepCommas():
+    attributes = parseAttributeList('TYPE=AUDIO,NAME="English, UK",CODECS="mp4a.40.2,ec-3",URI="audio.m3u8"')
+
+    assert attributes == {'TYPE': 'AUDIO', 'NAME': 'English, UK', 'CODECS': 'mp4a.40.2,ec-3', 'URI': 'audio.m3u8'}
+
+
+def test_whitespaceAfterCommaIsIgnored():
+    assert parseAttributeList('METHOD=AES-128, URI="key.bin",  IV=0x1') == {
+        'METHOD': 'AES-128', 'URI': 'key.bin', 'IV': '0x1'}
+
+
+def test_malformedListsDoNotFail():
+    assert parseAttributeList('') == {}
+    assert parseAttributeList('NONE') == {}
+    # An unterminated quote runs to the end of the list
+    assert parseAttributeList('URI="a.m3u8,NAME=x') == {'URI': 'a.m3u8,NAME=x'}
+    assert parseAttributeList('A=1,') == {'A': '1'}
+
+
+def test_longQuotedValuesAreParsedInLinearTime():
+    # A quadratic tokenizer takes seconds for a value this long
+    value = ','.join(['x'] * 200000)
+
+    assert parseAttributeList('NAME="%s",URI="a.m3u8"' % value) == {'NAME': value, 'URI': 'a.m3u8'}
+
+
+def test_resolverMatchesNormalizeUrl():
+    resolver = UriResolver(PLAYLIST_URL)
+
+    for uri in ('s1.ts', 'video/s1.ts', '../other/s1.ts', './s1.ts', 'a/../b/s1.ts', 's1.ts?token=1', '..'):
+        assert resolver.resolve(uri) == normalizeUrl('https://origin.example.com/out/v1/asset/' + uri)
+    assert resolver.resolve('https://cdn.example.com/s1.ts') == 'https://cdn.example.com/s1.ts'
+
+
+def test_variantManifestRecordsEndOfByteRanges():
+    # A range without an offset starts where the previous range of the file ended
+    playlist = '\n'.join([
+        '#EXTM3U',
+        '#EXT-X-MAP:URI="main.mp4",BYTERANGE="1000@0"',
+        '#EXTINF:6.0,',
+        '#EXT-X-BYTERANGE:5000@1000',
+        'main.mp4',
+        '#EXTINF:6.0,',
+        '#EXT-X-BYTERANGE:5000',
+        'main.mp4',
+        '#EXT-X-ENDLIST'])
+
+    ( segments, byteRangeEnds ) = parseVariantManifest(PLAYLIST_URL, playlist)
+
+    assert segments == ['https://origin.example.com/out/v1/asset/main.mp4']
+    assert byteRangeEnds == {'https://origin.example.com/out/v1/asset/main.mp4': 11000}
@@ -0,0 +1,69 @@
+import os
+
+from LocalWriter import LocalWriter
+
+
+def listFiles(root):
+    return sorted(os.path.relpath(os.path.join(directory, name), str(root))
+                  for directory, _, names in os.walk(str(root)) for name in names)
+
+
+def test_putObjectWritesFile(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+
+    writer.putObject(None, 'asset/v0/s0.ts', b'segment', 'video/MP2T', 'private')
+
+    assert (tmp_path / 'asset' / 'v0' / 's0.ts').read_bytes() == b'segment'
+    # No temporary file is left behind
+    assert listFiles(tmp_path) == ['asset/v0/s0.ts']
+
+
+def test_partsAreWrittenInPlaceInAnyOrder(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    body = os.urandom(3000)
+    uploadId = writer.createMultipartUpload(None, 'asset/main.mp4', 'video/mp4', 'private')
+
+    parts = [writer.uploadPart(None, 'asset/main.mp4', uploadId, partNumber, body[offset:offset + 1000], offset)
+             for partNumber, offset in ((3, 2000), (1, 0), (2, 1000))]
+    # The object is not visible until the upload is complete
+    assert writer.getObject(None, 'asset/main.mp4') is None
+    assert list(writer.listObjects(None, 'asset/')) == []
+
+    writer.completeMultipartUpload(None, 'asset/main.mp4', uploadId, parts)
+
+    assert writer.getObject(None, 'asset/main.mp4') == body
+    assert listFiles(tmp_path) == ['asset/main.mp4']
+
+
+def test_abortRemovesUpload(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    uploadId = writer.createMultipartUpload(None, 'asset/main.mp4', 'video/mp4', 'private')
+    writer.uploadPart(None, 'asset/main.mp4', uploadId, 1, b'part', 0)
+
+    writer.abortMultipartUpload(None, 'asset/main.mp4', uploadId)
+
+    assert listFiles(tmp_path) == []
+
+
+def test_listObjectsSkipsTemporaryFiles(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    writer.putObject(None, 'asset/a.ts', b'aa', None, 'private')
+    writer.putObject(None, 'asset/v0/b.ts', b'bbb', None, 'private')
+    writer.createMultipartUpload(None, 'asset/c.ts', None, 'private')
+
+    objects = sorted((key, size) for key, size, eTag, lastModified in writer.listObjects(None, 'asset/'))
+
+    assert objects == [('asset/a.ts', 2), ('asset/v0/b.ts', 3)]
+
+
+def test_moveAndDeleteObjects(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    writer.putObject(None, 'old/a.ts', b'a', None, 'private')
+
+    writer.moveObject(None, 'old/a.ts', 'new/a.ts', 'private')
+    writer.deleteObject(None, 'missing.ts')
+
+    assert writer.getObject(None, 'old/a.ts') is None
+    assert writer.getObject(None, 'new/a.ts') == b'a'
+    writer.deleteObject(None, 'new/a.ts')
+    assert writer.getObject(None, 'new/a.ts') is None
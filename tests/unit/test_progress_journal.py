@@ -0,0 +1,118 @@
+import time
+
+import DownloadVod
+from LocalWriter import LocalWriter
+from ProgressJournal import JournalVodAsset, ProgressJournal
+from ResourceTable import ResourceSizes, ResourceTable
+from tests.unit.test_download_vod import makeEvent
+from tests.unit.conftest import addHlsAsset
+
+SOURCE_URL = 'https://origin.example.com/out/asset/master.m3u8'
+
+
+def makeJournal(writer, numResources=10, mode='copy'):
+    resources = ResourceTable()
+    resources.extend(['https://origin.example.com/out/asset/s%d.ts' % n for n in range(numResources)])
+    vodAsset = JournalVodAsset(SOURCE_URL, 'https://origin.example.com/out/asset/', resources, ResourceSizes(), [])
+    return ProgressJournal(writer, None, 'asset', SOURCE_URL, 'hls', vodAsset, mode)
+
+
+def test_saveAndLoad(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    journal = makeJournal(writer)
+    journal.markComplete(2, 1000)
+    journal.markComplete(3)
+    journal.cursor = 4
+    journal.save()
+
+    loaded = ProgressJournal.load(writer, None, 'asset', SOURCE_URL)
+
+    assert loaded.numCompleted == 2
+    assert loaded.cursor == 4
+    assert loaded.vodAsset.allResources[9] == 'https://origin.example.com/out/asset/s9.ts'
+    assert loaded.vodAsset.resourceSizes.get(2) == 1000
+    assert loaded.vodAsset.resourceSizes.get(3) is None
+
+
+def test_checkpointForAnotherDownloadIsIgnored(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    makeJournal(writer).save()
+
+    assert ProgressJournal.load(writer, None, 'asset', SOURCE_URL + '?v=2') is None
+    assert ProgressJournal.load(writer, None, 'asset', SOURCE_URL, mode='sync') is None
+    assert ProgressJournal.load(writer, None, 'other', SOURCE_URL) is None
+
+
+def test_pendingIndexesStartAtCursor():
+    journal = makeJournal(None, numResources=6)
+    journal.markComplete(1)
+    journal.markComplete(4)
+    journal.cursor = 3
+
+    # Resources after the cursor are tried before the ones skipped by earlier invocations
+    assert list(journal.pendingIndexes()) == [3, 5, 0, 2]
+    assert journal.getPendingRanges() == [[0, 0], [2, 3], [5, 5]]
+    assert journal.getPendingRanges(2) == [[0, 0], [2, 3]]
+
+
+def test_checkpointIsDiscardedWhenDestinationIsCleared(origin, tmp_path):
+    sourceUrl = addHlsAsset(origin, variants=1, segments=3)
+    writer = LocalWriter(str(tmp_path))
+    ( vodAsset, vodAssetType ) = DownloadVod.parseVodAssetManifests(sourceUrl, None)
+
+    # A checkpoint recording every resource as copied, but nothing at the destination
+    journal = ProgressJournal(writer, None, 'asset', sourceUrl, vodAssetType, vodAsset)
+    for index in range(len(vodAsset.allResources)):
+        journal.markComplete(index)
+    journal.save()
+
+    output = DownloadVod.fetchStream(makeEvent(sourceUrl, tmp_path, assetCache=False), None)
+
+    assert output['result']['status'] == 'COMPLETE'
+    assert output['result']['objectsAtS3Dest'] == 5
+    assert (tmp_path / 'asset' / 'v0' / 's2.ts').exists()
+
+
+def test_saveIfDue(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    journal = makeJournal(writer)
+
+    # Periodic saves are disabled until an interval is set
+    journal.saveIfDue()
+    assert not (tmp_path / 'asset.checkpoint.json.gz').exists()
+
+    journal.saveInterval = 0
+    journal.markComplete(1)
+    journal.saveIfDue()
+    assert ProgressJournal.load(writer, None, 'asset', SOURCE_URL).numCompleted == 1
+
+    journal.saveInterval = 3600
+    journal.markComplete(2)
+    journal.saveIfDue()
+    assert ProgressJournal.load(writer, None, 'asset', SOURCE_URL).numCompleted == 1
+
+
+def test_checkpointIsSavedWhileCopying(origin, tmp_path, monkeypatch):
+    sourceUrl = addHlsAsset(origin, variants=2, segments=3)
+    event = makeEvent(sourceUrl, tmp_path, numThreads=1, pipelineManifests=False, checkpointInterval=0)
+    putObject = LocalWriter.putObject
+
+    def slowPutObject(writer, bucket, key, *args):
+        # The invocation crashes (e.g. runs out of memory) writing the last segment
+        if key.endswith('v1/s2.ts'):
+            raise SystemExit(3)
+        time.sleep(0.2)
+        return putObject(writer, bucket, key, *args)
+
+    monkeypatch.setattr(LocalWriter, 'putObject', slowPutObject)
+    try:
+        DownloadVod.fetchStream(event, None)
+    except SystemExit:
+        pass
+    monkeypatch.setattr(LocalWriter, 'putObject', putObject)
+    output = DownloadVod.fetchStream(event, None)
+
+    # Only the resources copied since the last save are copied again
+    assert output['result']['status'] == 'COMPLETE'
+    assert output['result']['resumedFromCheckpoint']
+    assert output['result']['totalDownloadedSegments'] <= 3
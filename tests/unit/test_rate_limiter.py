@@ -0,0 +1,60 @@
+import threading
+import time
+
+from RateLimiter import RateLimiter, TokenBucket
+
+
+def test_burstIsAvailableImmediately():
+    bucket = TokenBucket(rate=1, burst=5)
+
+    # The bucket starts full, so a burst of requests does not wait
+    assert [bucket.reserve() for _ in range(5)] == [0.0] * 5
+    assert bucket.reserve() > 0
+
+
+def test_reserveQueuesCallersBehindEachOther():
+    bucket = TokenBucket(rate=10, burst=1)
+    bucket.reserve()
+
+    # The bucket goes into debt, so each caller waits one token longer than the last
+    delays = [bucket.reserve() for _ in range(3)]
+    assert delays == sorted(delays)
+    assert abs(delays[0] - 0.1) < 0.02
+    assert abs(delays[2] - 0.3) < 0.02
+
+
+def test_requestRateIsLimitedAcrossThreads():
+    limiter = RateLimiter(rpsLimit=50, rpsBurst=1)
+
+    def sendRequests():
+        for _ in range(5):
+            limiter.acquireRequest()
+
+    start = time.monotonic()
+    threads = [threading.Thread(target=sendRequests) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    # 20 requests at 50 per second, the first of which is the burst
+    assert time.monotonic() - start >= 19 / 50.0 * 0.9
+
+
+def test_byteRateIsLimited():
+    limiter = RateLimiter(bytesPerSecondLimit=100000)
+
+    # One second of bytes is allowed as a burst by default
+    assert limiter.reserveBytes(100000) == 0.0
+    assert abs(limiter.reserveBytes(50000) - 0.5) < 0.05
+
+
+def test_zeroLimitsDisableLimiting():
+    limiter = RateLimiter(rpsLimit=0, bytesPerSecondLimit=0)
+
+    assert limiter.reserveRequest() == 0.0
+    assert limiter.reserveBytes(10 ** 12) == 0.0
+    start = time.monotonic()
+    for _ in range(1000):
+        limiter.acquireRequest()
+    assert time.monotonic() - start < 0.5
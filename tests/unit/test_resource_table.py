@@ -0,0 +1,131 @@
+import json
+
+from DashVodAsset import DashVodAsset
+from ResourceTable import ResourceSizes, ResourceTable, TemplateBlock
+
+BASE_URL = 'https://origin.example.com/out/asset/'
+
+
+def test_listResourcesAreIndexedInOrder():
+    table = ResourceTable()
+
+    assert table.extend([BASE_URL + 'v0/s0.ts', BASE_URL + 'v0/s1.ts?token=a', BASE_URL + 'v1/s0.ts']) == [0, 1, 2]
+    # Duplicates are dropped
+    assert table.add(BASE_URL + 'v0/s0.ts') is None
+
+    assert len(table) == 3
+    assert table[1] == BASE_URL + 'v0/s1.ts?token=a'
+    assert table[-1] == BASE_URL + 'v1/s0.ts'
+    assert list(table) == [BASE_URL + 'v0/s0.ts', BASE_URL + 'v0/s1.ts?token=a', BASE_URL + 'v1/s0.ts']
+    # Directory prefixes are only stored once
+    assert table.prefixes == [BASE_URL + 'v0/', BASE_URL + 'v1/']
+
+
+def test_templateResourcesAreStoredAsRuns():
+    table = ResourceTable()
+    table.add(BASE_URL + 'video/init.mp4')
+
+    times = [0, 2000, 4000, 6000, 7000, 8000]
+    assert list(table.addTemplate(BASE_URL + 'video/seg_$Time$.mp4', '$Time$', times)) == list(range(1, 7))
+
+    assert len(table) == 7
+    assert table[3] == BASE_URL + 'video/seg_4000.mp4'
+    assert list(table)[1:] == [BASE_URL + 'video/seg_%d.mp4' % time for time in times]
+    block = table.blocks[-1]
+    assert isinstance(block, TemplateBlock)
+    assert list(block.starts) == [0, 7000]
+
+
+def test_templateResourcesOfEarlierPeriodsAreNotRepeated():
+    table = ResourceTable()
+    table.addTemplate(BASE_URL + 'seg_$Number$.mp4', '$Number$', range(1, 6))
+
+    newIndexes = table.addTemplate(BASE_URL + 'seg_$Number$.mp4', '$Number$', range(4, 9))
+
+    assert list(newIndexes) == [5, 6, 7]
+    assert table[7] == BASE_URL + 'seg_8.mp4'
+
+
+def test_repeatedTemplateValuesAreStoredOnce():
+    table = ResourceTable()
+
+    # e.g. a SegmentTimeline with an entry repeated by the packager
+    newIndexes = table.addTemplate(BASE_URL + 'seg_$Time$.mp4', '$Time$', [0, 2000, 4000, 4000, 6000, 2000])
+
+    assert list(newIndexes) == [0, 1, 2, 3]
+    assert list(table) == [BASE_URL + 'seg_%d.mp4' % time for time in (0, 2000, 4000, 6000)]
+
+
+def test_repeatedTimelineEntryIsListedOnce(origin):
+    origin.files['/out/asset/index.mpd'] = b'''<?xml version="1.0"?>
+<MPD xmlns="urn:mpeg:dash:schema:mpd:2011" type="static" mediaPresentationDuration="PT8S">
+  <Period id="1" duration="PT8S">
+    <AdaptationSet mimeType="video/mp4">
+      <SegmentTemplate timescale="1000" media="video_$Time$.mp4" initialization="video_init.mp4">
+        <SegmentTimeline>
+          <S t="0" d="2000" r="2"/>
+          <S t="4000" d="2000" r="1"/>
+        </SegmentTimeline>
+      </SegmentTemplate>
+      <Representation id="1" bandwidth="1000000"/>
+    </AdaptationSet>
+  </Period>
+</MPD>
+'''
+
+    vodAsset = DashVodAsset(origin.url('/out/asset/index.mpd'))
+
+    assert [resource[len(vodAsset.commonPrefix):] for resource in vodAsset.allResources] == [
+        'index.mpd', 'video_0.mp4', 'video_2000.mp4', 'video_4000.mp4', 'video_6000.mp4', 'video_init.mp4']
+
+
+def test_roundTripThroughJson():
+    table = ResourceTable()
+    table.extend([BASE_URL + 'master.m3u8', BASE_URL + 'init.mp4'])
+    table.addTemplate(BASE_URL + 'seg_$Number$.mp4', '$Number$', range(1, 101))
+    table.add(BASE_URL + 'subtitles.vtt')
+
+    loaded = ResourceTable.fromDict(json.loads(json.dumps(table.toDict())))
+
+    assert len(loaded) == len(table)
+    assert list(loaded) == list(table)
+
+
+def test_resourceSizes():
+    sizes = ResourceSizes()
+    assert sizes.get(5) is None
+    assert not sizes.changed
+
+    sizes.set(3, 1000)
+    sizes.setMinimum(3, 500)
+    sizes.setMinimum(4, 2000)
+
+    assert sizes.get(3) == 1000
+    assert sizes.get(4) == 2000
+    assert sizes.get(0) is None
+    assert sizes.changed
+    assert ResourceSizes.fromDict(sizes.toDict()).get(4) == 2000
+
+
+def test_objectsMustMatchTheObjectCopied():
+    sizes = ResourceSizes()
+    sizes.set(0, 1000, '"abc"')
+    sizes.set(1, 1000)
+    sizes.setMinimum(2, 1000)
+
+    assert sizes.matches(0, 1000, '"abc"')
+    # Truncated, larger or replaced objects do not match
+    assert not sizes.matches(0, 999, '"abc"')
+    assert not sizes.matches(0, 1001, '"abc"')
+    assert not sizes.matches(0, 1000, '"def"')
+    # Only the size is compared when either ETag is not known
+    assert sizes.matches(0, 1000, None)
+    assert sizes.matches(1, 1000, '"def"')
+    # A file referenced using byte ranges may be larger than the last byte range
+    assert sizes.matches(2, 1500)
+    assert not sizes.matches(2, 500)
+    assert sizes.matches(3, 10)
+
+    loaded = ResourceSizes.fromDict(json.loads(json.dumps(sizes.toDict())))
+    assert not loaded.matches(0, 1000, '"def"')
+    assert loaded.matches(2, 1500) and not loaded.matches(2, 500)
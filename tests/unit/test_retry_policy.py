@@ -0,0 +1,60 @@
+import time
+from email.utils import formatdate
+
+from RetryPolicy import CONNECTION_ERROR, LENGTH_MISMATCH, RetryPolicy, parseRetryAfter
+
+
+def test_onlyTransientFailuresAreRetried():
+    policy = RetryPolicy()
+
+    assert policy.getRetryDelay(503, 1) is not None
+    assert policy.getRetryDelay(429, 1) is not None
+    assert policy.getRetryDelay(CONNECTION_ERROR, 1) is not None
+    assert policy.getRetryDelay(LENGTH_MISMATCH, 1) is not None
+    assert policy.getRetryDelay(404, 1) is None
+    assert policy.getRetryDelay(403, 1) is None
+
+
+def test_attemptsAreLimited():
+    policy = RetryPolicy(maxAttempts=3)
+
+    assert policy.getRetryDelay(500, 2) is not None
+    assert policy.getRetryDelay(500, 3) is None
+
+
+def test_backoffIsCappedAndJittered():
+    policy = RetryPolicy(maxAttempts=20, baseDelay=0.5, maxDelay=2)
+
+    # Full jitter picks a delay between zero and the backoff for the attempt
+    delays = [policy.getRetryDelay(500, 10) for _ in range(100)]
+    assert all(0 <= delay <= 2 for delay in delays)
+    assert len(set(delays)) > 1
+    assert policy.getRetryDelay(500, 1) <= 0.5
+
+
+def test_retryAfterIsHonoured():
+    policy = RetryPolicy(baseDelay=0.01)
+
+    assert policy.getRetryDelay(503, 1, '5') >= 5
+    # Very long waits are capped
+    assert policy.getRetryDelay(503, 1, '3600') == 60
+
+
+def test_parseRetryAfter():
+    assert parseRetryAfter('2') == 2.0
+    assert parseRetryAfter(None) is None
+    assert parseRetryAfter('soon') is None
+    assert 8 < parseRetryAfter(formatdate(time.time() + 10, usegmt=True)) <= 10
+
+
+def test_retryBudgetIsSharedAcrossRequests():
+    policy = RetryPolicy(retryBudget=2)
+
+    assert policy.getRetryDelay(500, 1) is not None
+    assert policy.getRetryDelay(CONNECTION_ERROR, 1) is not None
+    assert policy.getRetryDelay(500, 1) is None
+
+    summary = policy.getSummary()
+    assert summary['retriesByStatus'] == {'500': 1, CONNECTION_ERROR: 1}
+    assert summary['totalRetries'] == 2
+    assert summary['retryBudgetExhausted']
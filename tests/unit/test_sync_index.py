@@ -0,0 +1,71 @@
+import datetime
+import zlib
+
+from LocalWriter import LocalWriter
+from ResourceTable import ResourceSizes
+from SyncIndex import SyncIndex
+
+URL = 'https://origin.example.com/out/asset/v0/s0.ts'
+WRITTEN = datetime.datetime(2026, 1, 2, 3, 4, 5, tzinfo=datetime.timezone.utc)
+
+
+def makeIndex(writer=None, size=1000):
+    syncIndex = SyncIndex(writer, None, 'asset')
+    syncIndex.existingObjects = {'v0/s0.ts': (size, '"abc"', WRITTEN)}
+    return syncIndex
+
+
+def test_validatorsAreOnlyRecordedOnceWritten():
+    syncIndex = makeIndex()
+    syncIndex.stageValidators(0, URL, {'ETag': '"e1"'}, 1000)
+
+    # The write failed, so the next sync fetches the resource unconditionally
+    syncIndex.recordValidators(0, commit=False)
+    assert syncIndex.getConditionalHeaders(0, URL, 'v0/s0.ts') == {'If-Modified-Since': 'Fri, 02 Jan 2026 03:04:05 GMT'}
+
+    syncIndex.stageValidators(0, URL, {'ETag': '"e1"', 'Last-Modified': 'Thu, 01 Jan 2026 00:00:00 GMT'}, 1000)
+    syncIndex.recordValidators(0)
+    assert syncIndex.getConditionalHeaders(0, URL, 'v0/s0.ts') == {
+        'If-None-Match': '"e1"', 'If-Modified-Since': 'Thu, 01 Jan 2026 00:00:00 GMT'}
+
+
+def test_validatorsOfAnotherResourceAreNotUsed():
+    syncIndex = makeIndex()
+    syncIndex.stageValidators(0, URL, {'ETag': '"e1"'}, 1000)
+    syncIndex.recordValidators(0)
+
+    # e.g. a segment was inserted before resource 0 since it was copied
+    assert syncIndex.getConditionalHeaders(0, URL.replace('s0.ts', 'init.mp4'), 'v0/s0.ts') == {
+        'If-Modified-Since': 'Fri, 02 Jan 2026 03:04:05 GMT'}
+
+
+def test_missingOrShortObjectsAreFetchedUnconditionally():
+    syncIndex = makeIndex(size=500)
+    syncIndex.stageValidators(0, URL, {'ETag': '"e1"'}, 1000)
+    syncIndex.recordValidators(0)
+
+    assert syncIndex.getConditionalHeaders(0, URL, 'v0/s1.ts') is None
+    # Smaller than the object origin returned when it was copied
+    assert syncIndex.getConditionalHeaders(0, URL, 'v0/s0.ts') is None
+    # Smaller than the size known from the manifests
+    resourceSizes = ResourceSizes()
+    resourceSizes.setMinimum(0, 1000)
+    assert makeIndex(size=500).getConditionalHeaders(0, URL, 'v0/s0.ts', resourceSizes) is None
+    # Not the object written when the resource was copied
+    resourceSizes.set(0, 500, '"def"')
+    assert makeIndex(size=500).getConditionalHeaders(0, URL, 'v0/s0.ts', resourceSizes) is None
+
+
+def test_saveAndLoad(tmp_path):
+    writer = LocalWriter(str(tmp_path))
+    syncIndex = makeIndex(writer)
+    syncIndex.save()
+    # Nothing is written until a validator has been recorded
+    assert not (tmp_path / 'asset.sync.json.gz').exists()
+
+    syncIndex.stageValidators(0, URL, {'ETag': '"e1"'}, 1000)
+    syncIndex.recordValidators(0)
+    syncIndex.save()
+
+    loaded = SyncIndex.load(writer, None, 'asset')
+    assert loaded.validators == {0: [zlib.crc32(URL.encode()), '"e1"', None, 1000]}